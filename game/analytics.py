@@ -0,0 +1,261 @@
+"""
+Card pool analytics, computed with NumPy over whole card pools at once.
+
+The attack, hp and cost columns of the cards are loaded into arrays once. Pairwise results (who wins a trade between
+two monsters) and deck-versus-deck tables are then computed as array operations, a block of rows at a time so that
+memory stays bounded for large pools.
+
+Combat follows the engine rules: two monsters fighting deal their attack to each other at the same time, and a
+monster whose hp reaches 0 is destroyed.
+"""
+import numpy as np
+
+from .models import Deck, MonsterCard
+
+# Hp players start a game with, as in PlayerState.initialize_all
+HERO_HP = 30
+
+# Rows of a pairwise matrix computed at once
+BLOCK_SIZE = 256
+
+# Outcomes of a trade, from the point of view of the first monster
+WIN = 1
+DRAW = 0  # both are destroyed in the same fight, or neither can destroy the other
+LOSS = -1
+
+
+class CardPool:
+    """
+    Columns of a set of MonsterCards, as arrays in the same order.
+    """
+
+    def __init__(self, pks, names, cost, attack, hp):
+        self.pks = np.asarray(pks, dtype=np.int64)
+        self.names = list(names)
+        self.cost = np.asarray(cost, dtype=np.int64)
+        self.attack = np.asarray(attack, dtype=np.int64)
+        self.hp = np.asarray(hp, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.pks)
+
+    @classmethod
+    def load(cls, queryset=None):
+        """
+        Loads a pool with one query.
+        :param queryset: MonsterCards, all of them by default
+        :return: CardPool
+        """
+        if queryset is None:
+            queryset = MonsterCard.objects.all()
+        rows = list(queryset.order_by('pk').values_list('pk', 'name', 'cost', 'attack', 'hp'))
+        if not rows:
+            return cls([], [], [], [], [])
+        pks, names, cost, attack, hp = zip(*rows)
+        return cls(pks, names, cost, attack, hp)
+
+    def indices(self, pks):
+        """
+        Positions of MonsterCard pks in this pool's arrays.
+        :param pks:
+        :return: array
+        """
+        return np.searchsorted(self.pks, np.asarray(pks, dtype=np.int64))
+
+
+def hits_to_kill(attack, hp):
+    """
+    Number of hits with each attack needed to destroy each hp, inf when the attack is 0 or less.
+    Broadcasts, so an attack column and an hp row give a matrix.
+    :param attack: array
+    :param hp: array
+    :return: array of float
+    """
+    attack = np.asarray(attack, dtype=np.float64)
+    hp = np.asarray(hp, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hits = np.ceil(hp / attack)
+    return np.where(attack > 0, np.maximum(hits, 1), np.inf)
+
+
+def trade_matrix(pool, rows=None, columns=None):
+    """
+    Outcome of monster i fighting monster j until one of them is destroyed, for every pair.
+    :param pool: CardPool
+    :param rows: indices of the first monsters, all by default
+    :param columns: indices of the second monsters, all by default
+    :return: array of WIN, DRAW or LOSS, rows by columns
+    """
+    rows = np.arange(len(pool)) if rows is None else np.asarray(rows)
+    columns = np.arange(len(pool)) if columns is None else np.asarray(columns)
+    # Hits i needs to destroy j, and hits j needs to destroy i
+    needs = hits_to_kill(pool.attack[rows, None], pool.hp[None, columns])
+    needed = hits_to_kill(pool.attack[None, columns], pool.hp[rows, None])
+    # The one needing fewer hits wins. Monsters that cannot destroy each other draw.
+    with np.errstate(invalid='ignore'):
+        outcomes = np.sign(needed - needs)
+    return np.nan_to_num(outcomes, nan=DRAW).astype(np.int8)
+
+
+def trade_summary(pool, block_size=BLOCK_SIZE):
+    """
+    Number of monsters in the pool each monster beats, draws with and loses to.
+    A trade only depends on attack and hp, so the matrix is computed between distinct (attack, hp) lines, weighted by
+    how many monsters have each, a block of rows at a time.
+    :param pool: CardPool
+    :param block_size:
+    :return: (wins, draws, losses), arrays of int
+    """
+    size = len(pool)
+    if not size:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    lines, inverse, counts = np.unique(np.stack([pool.attack, pool.hp], axis=1), axis=0, return_inverse=True,
+                                       return_counts=True)
+    inverse = inverse.reshape(-1)
+    distinct = CardPool(np.arange(len(lines)), [''] * len(lines), np.zeros(len(lines)), lines[:, 0], lines[:, 1])
+
+    wins = np.zeros(len(lines), dtype=np.int64)
+    losses = np.zeros(len(lines), dtype=np.int64)
+    for start in range(0, len(lines), block_size):
+        rows = np.arange(start, min(start + block_size, len(lines)))
+        outcomes = trade_matrix(distinct, rows=rows)
+        wins[rows] = (outcomes == WIN) @ counts
+        losses[rows] = (outcomes == LOSS) @ counts
+    wins = wins[inverse]
+    losses = losses[inverse]
+    return wins, size - wins - losses, losses
+
+
+def mana_efficiency(pool):
+    """
+    Attack plus hp per mana. Cards that cost nothing count as costing 1.
+    :param pool: CardPool
+    :return: array of float
+    """
+    return (pool.attack + pool.hp) / np.maximum(pool.cost, 1)
+
+
+def mana_curve(pool):
+    """
+    Average stats and efficiency of the cards at each cost.
+    :param pool: CardPool
+    :return: list of dict, by cost
+    """
+    if not len(pool):
+        return []
+    costs, inverse, counts = np.unique(pool.cost, return_inverse=True, return_counts=True)
+    efficiency = mana_efficiency(pool)
+    max_efficiency = np.full(len(costs), -np.inf)
+    np.maximum.at(max_efficiency, inverse, efficiency)
+    return [{
+        'cost': int(cost),
+        'cards': int(count),
+        'mean_attack': float(mean_attack),
+        'mean_hp': float(mean_hp),
+        'mean_efficiency': float(mean_efficiency),
+        'max_efficiency': float(best),
+    } for cost, count, mean_attack, mean_hp, mean_efficiency, best in zip(
+        costs, counts,
+        np.bincount(inverse, weights=pool.attack) / counts,
+        np.bincount(inverse, weights=pool.hp) / counts,
+        np.bincount(inverse, weights=efficiency) / counts,
+        max_efficiency)]
+
+
+def hero_kill_turns(pool, hero_hp=HERO_HP):
+    """
+    Attacks each monster needs to destroy a hero on its own, and the earliest of its owner's turns it can do so.
+    A monster costing c can be summoned on its owner's turn c at the earliest, and attacks from the next turn.
+    :param pool: CardPool
+    :param hero_hp:
+    :return: (attacks, earliest turn), arrays of float, inf for monsters without attack
+    """
+    attacks = hits_to_kill(pool.attack, hero_hp)
+    return attacks, np.maximum(pool.cost, 1) + attacks
+
+
+def deck_tables(pool, deck_cards, block_size=BLOCK_SIZE):
+    """
+    Deck versus deck tables, for a random monster of one deck fighting a random monster of another:
+    the expected damage it deals, counting no more than the hp of the defender, and its expected trade outcome.
+    The card by card matrices are computed a block of rows at a time, each folded into the decks by cards products.
+    :param pool: CardPool holding every card of the decks
+    :param deck_cards: list of lists of indices into pool, one per deck
+    :param block_size:
+    :return: (expected damage, expected outcome), decks by decks arrays of float
+    """
+    used = np.unique(np.concatenate([np.asarray(cards, dtype=np.int64) for cards in deck_cards]))
+    # Share of each used card in each deck
+    shares = np.zeros((len(deck_cards), len(used)))
+    for deck, cards in enumerate(deck_cards):
+        if len(cards):
+            np.add.at(shares[deck], np.searchsorted(used, cards), 1 / len(cards))
+
+    # shares @ matrix, summed over blocks of the matrix's rows
+    damage = np.zeros(shares.shape)
+    outcomes = np.zeros(shares.shape)
+    for start in range(0, len(used), block_size):
+        rows = used[start:start + block_size]
+        block_shares = shares[:, start:start + block_size]
+        damage += block_shares @ np.minimum(pool.attack[rows, None], pool.hp[None, used])
+        outcomes += block_shares @ trade_matrix(pool, rows=rows, columns=used)
+    return damage @ shares.T, outcomes @ shares.T
+
+
+def report(pool=None, decks=None):
+    """
+    Analytics of a card pool and the decks built from it, as JSON-serializable values.
+    :param pool: CardPool, every MonsterCard by default
+    :param decks: Decks, all of them by default
+    :return: dict
+    """
+    if pool is None:
+        pool = CardPool.load()
+    if decks is None:
+        decks = Deck.objects.all()
+
+    wins, draws, losses = trade_summary(pool)
+    efficiency = mana_efficiency(pool)
+    hero_attacks, hero_turns = hero_kill_turns(pool)
+
+    def number(value):
+        # JSON has no infinity
+        return None if np.isinf(value) else int(value)
+
+    cards = [{
+        'pk': int(pool.pks[i]),
+        'name': pool.names[i],
+        'cost': int(pool.cost[i]),
+        'attack': int(pool.attack[i]),
+        'hp': int(pool.hp[i]),
+        'efficiency': float(efficiency[i]),
+        'wins': int(wins[i]),
+        'draws': int(draws[i]),
+        'losses': int(losses[i]),
+        'attacks_to_kill_hero': number(hero_attacks[i]),
+        'earliest_hero_kill_turn': number(hero_turns[i]),
+    } for i in range(len(pool))]
+
+    deck_pks = []
+    deck_cards = []
+    members = {}
+    in_pool = set(pool.pks.tolist())
+    for deck_id, card_id in Deck.monster_cards.through.objects.filter(deck__in=decks).values_list(
+            'deck_id', 'monstercard_id'):
+        if card_id in in_pool:
+            members.setdefault(deck_id, []).append(card_id)
+    for deck_pk in sorted(members):
+        deck_pks.append(deck_pk)
+        deck_cards.append(pool.indices(members[deck_pk]))
+    expected_damage, expected_outcome = deck_tables(pool, deck_cards) if deck_pks else (np.zeros((0, 0)),) * 2
+
+    return {
+        'cards': cards,
+        'mana_curve': mana_curve(pool),
+        'decks': {
+            'pks': deck_pks,
+            'expected_damage': expected_damage.tolist(),
+            'expected_outcome': expected_outcome.tolist(),
+        },
+    }
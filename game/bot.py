@@ -0,0 +1,297 @@
+"""
+Computer opponent.
+
+A bot plays a PlayerState seat (see GameState.add_bot). It chooses each action by Monte Carlo tree search over
+clones of the engine.Game, within a fixed time budget.
+
+The bot does not see what its opponent cannot: before each search iteration, the cards it cannot see (both decks and
+its opponent's hand) are shuffled. Searching runs in a process pool, and the turns of bots are driven from a thread
+pool, so thinking never blocks the channels worker that serves human players. A bot that fails is logged, and its
+turn is ended so that its opponent is not left waiting.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import close_old_connections
+
+from . import engine, exceptions, protocol, simulator
+
+logger = logging.getLogger(__name__)
+
+# Seconds a bot thinks before each action
+THINKING_SECONDS = 1.0
+
+# Processes searching for bots, and threads driving their turns
+WORKERS = 2
+
+# Turns a rollout is played for before its position is evaluated
+ROLLOUT_TURNS = 6
+
+# Exploration constant of UCT
+EXPLORATION = 1.4
+
+# Hp difference an evaluated position is most sensitive to
+HP_SCALE = 10.0
+
+_search_pool = None
+_turn_pool = None
+_lock = threading.Lock()
+_games_in_turn = {}  # pk of GameState whose bot turn is being driven -> whether it was scheduled again meanwhile
+
+
+class Node:
+    """
+    A node of the search tree: the action that led to it, and how well it did for the player who took it.
+    """
+    __slots__ = ('action', 'user_id', 'parent', 'children', 'visits', 'reward', 'available')
+
+    def __init__(self, action=None, user_id=None, parent=None):
+        self.action = action
+        self.user_id = user_id  # player who took action
+        self.parent = parent
+        self.children = {}  # action -> Node
+        self.visits = 0
+        self.reward = 0.0  # sum of rewards for user_id
+        self.available = 0  # times action was legal when its parent was visited
+
+    def select(self, actions):
+        """
+        Child of the legal actions with the highest UCT score, for the variant of UCT where each child only counts
+        the visits its action was legal in.
+        :param actions: legal actions
+        :return: Node
+        """
+        best, best_score = None, -math.inf
+        for action in actions:
+            child = self.children[action]
+            child.available += 1
+            score = child.reward / child.visits + EXPLORATION * math.sqrt(math.log(child.available) / child.visits)
+            if score > best_score:
+                best, best_score = child, score
+        return best
+
+
+def determinize(game, user_id, rng):
+    """
+    Shuffles the cards a player cannot see: both decks, and the opponent's hand with the opponent's deck.
+    :param game: engine.Game, changed in place
+    :param user_id: player searching
+    :param rng: random.Random
+    :return:
+    """
+    for player in game.players:
+        if player.user_id == user_id:
+            rng.shuffle(player.deck)
+        else:
+            hand_positions = sorted(player.hand)
+            unseen = [player.hand[position] for position in hand_positions] + player.deck
+            rng.shuffle(unseen)
+            for position, card in zip(hand_positions, unseen):
+                card.zone = engine.HAND
+                card.position = position
+                player.hand[position] = card
+            player.deck = unseen[len(hand_positions):]
+            for card in player.deck:
+                card.zone = engine.DECK
+
+
+def evaluate(game, user_id):
+    """
+    How good a position is for a player, from 0 (lost) to 1 (won).
+    :param game: engine.Game
+    :param user_id:
+    :return: float
+    """
+    if game.is_ended:
+        return 1.0 if game.winner_id == user_id else 0.0
+    score = 0.0
+    for player in game.players:
+        board = sum(card.attack + card.hp for card in player.field.values()) / 2
+        sign = 1 if player.user_id == user_id else -1
+        score += sign * (player.hp + board)
+    return 1 / (1 + math.exp(-score / HP_SCALE))
+
+
+def rollout(game, user_id, rng):
+    """
+    Plays a game on for ROLLOUT_TURNS turns with the simulator's quick policies, and evaluates where it ends.
+    :param game: engine.Game, changed in place
+    :param user_id:
+    :param rng: random.Random
+    :return: reward for user_id
+    """
+    policies = (simulator.trade_policy, simulator.random_policy)
+    last_turn = game.turn + ROLLOUT_TURNS
+    while not game.is_ended and game.turn < last_turn:
+        command, args = rng.choice(policies)(game, simulator.legal_actions(game), rng)
+        game.apply(command, args)
+        game.clear_touched()
+    return evaluate(game, user_id)
+
+
+def search(game, user_id, seconds=None, rng=None, iterations=None):
+    """
+    Chooses the next action of a player by Monte Carlo tree search.
+    :param game: engine.Game, not changed
+    :param user_id: player to move
+    :param seconds: time budget, THINKING_SECONDS by default
+    :param rng: random.Random
+    :param iterations: stop after this many iterations, if before the time budget runs out
+    :return: (command, args)
+    """
+    rng = rng or random.Random()
+    if seconds is None:
+        seconds = THINKING_SECONDS
+    root = Node()
+    actions = simulator.legal_actions(game)
+    if len(actions) == 1:
+        return actions[0]
+
+    deadline = time.monotonic() + seconds
+    iteration = 0
+    # At least one iteration, so that there is an action to choose
+    while not iteration or time.monotonic() < deadline and (iterations is None or iteration < iterations):
+        iteration += 1
+        state = game.clone()
+        determinize(state, user_id, rng)
+
+        # Selection, down the children that are legal in this determinization
+        node = root
+        while not state.is_ended:
+            legal = simulator.legal_actions(state)
+            untried = [action for action in legal if action not in node.children]
+            if untried:
+                # Expansion
+                action = rng.choice(untried)
+                child = node.children[action] = Node(action, state.player_moving.user_id, node)
+                child.available = 1
+                node = child
+                state.apply(*action)
+                state.clear_touched()
+                break
+            node = node.select(legal)
+            state.apply(*node.action)
+            state.clear_touched()
+
+        # Simulation and backpropagation
+        reward = rollout(state, user_id, rng)
+        while node is not None:
+            node.visits += 1
+            node.reward += reward if node.user_id == user_id else 1 - reward
+            node = node.parent
+
+    # The most visited action is the most trusted
+    return max(root.children.values(), key=lambda child: child.visits).action
+
+
+def think(state, user_id, seconds=None, seed=None):
+    """
+    Searches the next action of a bot, in a worker process.
+    :param state: snapshot of the game, from engine.dump_game
+    :param user_id: bot's User pk
+    :param seconds: time budget, THINKING_SECONDS by default
+    :param seed:
+    :return: (command, args)
+    """
+    return search(engine.load_game(state), user_id, seconds, random.Random(seed))
+
+
+def take_turns(game_state, search_pool=None):
+    """
+    Plays the actions of the bot whose turn it is, until its turn ends or the game does.
+    Everyone in the room is sent an update after each action.
+    :param game_state: GameState
+    :param search_pool: executor to search in, or None to search in this thread
+    :return: number of actions taken
+    """
+    taken = 0
+    while True:
+        bot_state = game_state.playerstate_set.filter(is_bot=True, is_moving=True).first()
+        if bot_state is None:
+            return taken
+        game = game_state.load_engine()
+        if not game.is_started or game.is_ended:
+            return taken
+
+        state = engine.dump_game(game)
+        if search_pool is None:
+            command, args = think(state, bot_state.user_id, THINKING_SECONDS)
+        else:
+            command, args = search_pool.submit(think, state, bot_state.user_id, THINKING_SECONDS).result()
+
+        try:
+            game_state.run_command(command, *args)
+        except (exceptions.GameStateConflict, exceptions.NotAuthorized):
+            # The game moved on while the bot was thinking
+            continue
+        taken += 1
+        _update_room(game_state)
+
+
+def _update_room(game_state):
+    async_to_sync(get_channel_layer().group_send)('game_game_%s' % game_state.room_name,
+                                                  protocol.update_event(game_state.load_snapshot()))
+
+
+def _give_up_turn(game_state_pk):
+    """
+    Ends the turn of a bot that failed, so that the game goes on without waiting for it.
+    :param game_state_pk:
+    :return:
+    """
+    from .models import GameState
+    try:
+        game_state = GameState.objects.get(pk=game_state_pk)
+        bot_state = game_state.playerstate_set.filter(is_bot=True, is_moving=True).first()
+        if bot_state is None or not game_state.is_started or game_state.is_ended:
+            return
+        game_state.run_command('end_turn', bot_state.user_id)
+        _update_room(game_state)
+    except Exception:
+        logger.exception('Bot of game %s could not end its turn', game_state_pk)
+
+
+def _drive(game_state_pk):
+    from .models import GameState
+    try:
+        while True:
+            take_turns(GameState.objects.get(pk=game_state_pk), _search_pool)
+            with _lock:
+                # A command that gave the bot its turn may have come in after take_turns last looked
+                if not _games_in_turn[game_state_pk]:
+                    del _games_in_turn[game_state_pk]
+                    return
+                _games_in_turn[game_state_pk] = False
+    except Exception:
+        # Nothing reads the result of this thread, so the failure is logged here
+        logger.exception('Bot of game %s failed', game_state_pk)
+        with _lock:
+            _games_in_turn.pop(game_state_pk, None)
+        _give_up_turn(game_state_pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(game_state):
+    """
+    Starts playing a bot's turn in the background, if a bot is to move in the game and is not already playing.
+    Returns at once.
+    :param game_state: GameState
+    :return:
+    """
+    global _search_pool, _turn_pool
+    with _lock:
+        if game_state.pk in _games_in_turn:
+            _games_in_turn[game_state.pk] = True
+            return
+        if _search_pool is None:
+            _search_pool = ProcessPoolExecutor(max_workers=WORKERS)
+            _turn_pool = ThreadPoolExecutor(max_workers=WORKERS)
+        _games_in_turn[game_state.pk] = False
+    _turn_pool.submit(_drive, game_state.pk)
@@ -0,0 +1,203 @@
+"""
+Room chat flow control.
+
+Each chat connection has a TokenBucket that limits how fast its user can send messages, and two Coalescers: one that
+gathers the user's messages for a short window before they go to the room's group as one group message, and one that
+gathers the group's messages before they go to the client as one frame. A paste flood then costs a handful of group
+messages and frames rather than one per line, and cannot starve game traffic on the same worker.
+
+Each worker keeps the last messages of its rooms in a History, which is replayed to users who join or rejoin a room.
+A room's history is only kept while the room has connections on the worker, which hear every message said in it.
+Messages are written to the database behind the chat, in batches (see consumers.chat_writer).
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# Messages a user can send per second, and in one burst
+RATE = 2.0
+BURST = 8
+
+# Seconds messages are gathered for before they are sent together
+COALESCE_SECONDS = 0.05
+
+# Messages sent together at most
+MAX_COALESCED = 50
+
+# Characters of a message that are kept
+MAX_MESSAGE_LENGTH = 500
+
+# Messages a room's history keeps, and rooms whose history a worker keeps
+HISTORY_SIZE = 100
+HISTORY_ROOMS = 1000
+
+# Seconds messages wait to be written to the database, and messages written together at most
+FLUSH_SECONDS = 2.0
+FLUSH_SIZE = 200
+
+
+class TokenBucket:
+    """
+    Allows rate actions per second on average, and up to burst at once.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        Takes a token for an action.
+        :return: whether there was one, and so whether the action is allowed
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        """
+        Seconds until a token is available.
+        :return: float
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Coalescer:
+    """
+    Gathers items for a short window after the first one, then hands them all to an async flush function at once.
+    The window is timed by a task of the coalescer's own, in self.task until the window ends or is cut short.
+    """
+
+    def __init__(self, flush, window=COALESCE_SECONDS, max_items=MAX_COALESCED):
+        self.flush = flush
+        self.window = window
+        self.max_items = max_items
+        self.items = []
+        self.task = None  # task waiting for the window to end
+
+    async def add(self, item):
+        """
+        Adds an item to the items being gathered. Items are handed over at once when there are max_items of them.
+        :param item:
+        :return:
+        """
+        self.items.append(item)
+        if len(self.items) >= self.max_items:
+            await self.drain()
+        elif self.task is None:
+            self.task = asyncio.ensure_future(self._drain_later())
+
+    async def _drain_later(self):
+        await asyncio.sleep(self.window)
+        # The window is over: this task is no longer to be cancelled, and the next item opens a new window
+        self.task = None
+        await self.drain()
+
+    async def drain(self):
+        """
+        Hands over the items gathered so far, without waiting for the window to end.
+        :return:
+        """
+        self._cancel()
+        items, self.items = self.items, []
+        if items:
+            await self.flush(items)
+
+    def close(self):
+        """
+        Drops the items gathered so far, such as when the connection they were for is closed.
+        :return:
+        """
+        self._cancel()
+        self.items = []
+
+    def _cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+
+
+class History:
+    """
+    The last messages of each room, in ring buffers of HISTORY_SIZE messages.
+    Only the HISTORY_ROOMS rooms used last are kept, so memory is bounded per room and in all. A room's history is
+    dropped with its last connection on this worker, as it would miss what is said on other workers from then on.
+    """
+
+    def __init__(self, size=HISTORY_SIZE, max_rooms=HISTORY_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()  # room name -> (deque of messages, ids of those messages), used last at the end
+        self.connections = {}  # room name -> connections to the room on this worker
+
+    def _room(self, room_name):
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.rooms[room_name] = (deque(maxlen=self.size), set())
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room_name)
+        return room
+
+    def add(self, room_name, message):
+        """
+        Adds a message to a room's history, unless it is there already. Every connection of a room hears each message,
+        and each adds it.
+        :param room_name:
+        :param message: dict, with an 'id' that is unique to the message
+        :return: whether the message was added
+        """
+        messages, ids = self._room(room_name)
+        if message.get('id') is not None:
+            if message['id'] in ids:
+                return False
+            ids.add(message['id'])
+        if len(messages) == messages.maxlen:
+            ids.discard(messages[0].get('id'))
+        messages.append(message)
+        return True
+
+    def load(self, room_name, messages):
+        """
+        Fills the history of a room that is not kept, such as from the database.
+        :param room_name:
+        :param messages: list of dict, oldest first
+        :return:
+        """
+        for message in messages:
+            self.add(room_name, message)
+
+    def recent(self, room_name):
+        """
+        The last messages of a room.
+        :param room_name:
+        :return: list of dict, oldest first, or None if the room's history is not kept
+        """
+        if room_name not in self.rooms:
+            return None
+        return list(self._room(room_name)[0])
+
+    def connect(self, room_name):
+        self.connections[room_name] = self.connections.get(room_name, 0) + 1
+
+    def disconnect(self, room_name):
+        self.connections[room_name] -= 1
+        if not self.connections[room_name]:
+            del self.connections[room_name]
+            self.rooms.pop(room_name, None)
+
+
+# The history of this worker's rooms
+history = History()
@@ -1,10 +1,96 @@
-from channels.generic.websocket import AsyncWebsocketConsumer, WebsocketConsumer
 from asgiref.sync import async_to_sync
+from channels.consumer import SyncConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from collections import OrderedDict
 import json
-from game.models import GameState
-from game import exceptions
+import logging
+import uuid
+from urllib.parse import parse_qs
+from game.models import ChatMessage, GameState
+from game import bot, chat, exceptions, protocol, shards
+
+logger = logging.getLogger(__name__)
+
+# Commands a client can send in one batch
+MAX_BATCH_COMMANDS = 20
+
+
+@database_sync_to_async
+def save_chat_messages(chat_messages):
+    """
+    Writes chat messages with one insert.
+    :param chat_messages: unsaved ChatMessages
+    :return:
+    """
+    ChatMessage.objects.bulk_create(chat_messages)
+
+
+# Chat messages said through this worker, waiting to be written
+chat_writer = chat.Coalescer(save_chat_messages, window=chat.FLUSH_SECONDS, max_items=chat.FLUSH_SIZE)
+
+# GameState pk -> protocol.Feed of the spectators of the game on this worker, kept while it has spectators
+spectator_feeds = {}
+
+# Client commands that are engine.Game commands
+ENGINE_COMMANDS = ('end_turn', 'summon', 'attack', 'attack_player')
+
+
+def engine_command(user_id, data):
+    """
+    The engine.Game command of a client command that can be sent in a batch.
+    :param user_id: User sending the command
+    :param data: client command
+    :return: (command, args)
+    """
+    command = data.get('command') if isinstance(data, dict) else None
+    try:
+        if command == 'end_turn':
+            return 'end_turn', (user_id,)
+        elif command == 'summon':
+            return 'summon', (user_id, data['handCardPosition'], data['fieldCardPosition'])
+        elif command == 'attack':
+            return 'attack', (user_id, data['attackingFieldCardPosition'], data['defendingFieldCardPosition'])
+        elif command == 'attack_player':
+            return 'attack_player', (user_id, data['attackingFieldCardPosition'], data['defendingPlayerName'])
+    except KeyError:
+        raise exceptions.InvalidBatch(command)
+    raise exceptions.InvalidBatch(command)
+
+
+def batch_commands(user_id, data):
+    """
+    The engine.Game commands of a client batch.
+    :param user_id: User sending the batch
+    :param data: client batch, with the commands in data['commands']
+    :return: list of (command, args)
+    """
+    items = data.get('commands')
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_COMMANDS:
+        raise exceptions.InvalidBatch
+    return [engine_command(user_id, item) for item in items]
+
+
+def gives_turn(command, data):
+    """
+    Whether a client command may give the turn to a bot.
+    :param command:
+    :param data: client command
+    :return: bool
+    """
+    return command in ('start_game', 'end_turn') or command == 'batch' and any(
+        isinstance(item, dict) and item.get('command') == 'end_turn' for item in data['commands'])
+
 
 class AsyncChatConsumer(AsyncWebsocketConsumer):
+    """
+    Relays chat messages between the users in a room.
+    Messages are rate limited per connection, and sent on in batches (see chat).
+
+    Clients are sent frames of messages, {'messages': [{'author': ..., 'message': ...}, ...]}, and notices such as
+    {'notice': 'dropped', 'message': ..., 'retry_after': seconds} when their messages are dropped for coming too fast.
+    On connect, they are sent the room's last messages in one frame, {'messages': [...], 'history': True}.
+    """
     async def connect(self):  # Declares that this routine may be suspended and resumed (coroutine)
         """
         Server response to client connection request.
@@ -15,7 +101,13 @@ class AsyncChatConsumer(AsyncWebsocketConsumer):
         self.group_name = 'game_chat_' + self.room_name
         self.username = self.scope['user'].username
 
-        self.game = GameState.objects.get(room_name=self.room_name)  # Game associated with room name
+        # Game associated with room name, fetched in a thread so that the event loop is not blocked
+        self.game = await database_sync_to_async(GameState.objects.get)(room_name=self.room_name)
+
+        self.bucket = chat.TokenBucket()  # Messages this user may send
+        self.dropping = False  # Whether this user was told their messages are being dropped
+        self.outgoing = chat.Coalescer(self.send_to_group)  # This user's messages, to the group
+        self.incoming = chat.Coalescer(self.send_to_client)  # The group's messages, to this client
 
         # This channel joins a group associated with room name
         await self.channel_layer.group_add(  # Await the resource that is blocking this operation by doing other things.
@@ -26,6 +118,25 @@ class AsyncChatConsumer(AsyncWebsocketConsumer):
         # Accept connection
         await self.accept()
 
+        # What was said before, from memory while the room has other connections on this worker
+        messages = chat.history.recent(self.room_name)
+        chat.history.connect(self.room_name)
+        self.connected = True
+        if messages is None:
+            messages = await self.load_history()
+            chat.history.load(self.room_name, messages)
+        if messages:
+            await self.send(text_data=json.dumps({'messages': messages, 'history': True}))
+
+    @database_sync_to_async
+    def load_history(self):
+        """
+        The room's last messages in the database, for a room whose history this worker does not keep.
+        :return: list of dict, oldest first
+        """
+        chat_messages = self.game.chat_messages.order_by('-id')[:chat.HISTORY_SIZE]
+        return [chat_message.to_message() for chat_message in reversed(chat_messages)]
+
     async def disconnect(self, close_code):
         """
         Server response to the close of a WebSocket connection.
@@ -33,6 +144,10 @@ class AsyncChatConsumer(AsyncWebsocketConsumer):
         """
         # print('Websocket disconnected')
 
+        # Messages this user sent last still go out, but nothing more goes to the closed client
+        await self.outgoing.drain()
+        self.incoming.close()
+
         # Channel leaves group associated with room name
         await self.channel_layer.group_discard(
             self.group_name,
@@ -40,202 +155,370 @@ class AsyncChatConsumer(AsyncWebsocketConsumer):
         )
 
         # Notify group that user has disconnected
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'chat_message',
-                'author': 'Server',
-                'message': self.username + ' has disconnected.'
-            }
-        )
+        await self.send_to_group([self.new_message('Server', self.username + ' has disconnected.')])
+
+        if getattr(self, 'connected', False):
+            chat.history.disconnect(self.room_name)
+
+        # Write what is waiting rather than keep it in memory for a room that may be empty
+        await chat_writer.drain()
 
     async def receive(self, text_data):
         """
         Server response to message sent by Client.
-        Channel sends message to group.
+        Channel sends message to group, along with the other messages the user sends within a short window.
         :return:
         """
         # Deserialize message
         data = json.loads(text_data)
         message = data['message']
 
-        # Send message to group associated with room name
+        if not self.bucket.take():
+            # Tell the user once, rather than once per dropped message
+            if not self.dropping:
+                self.dropping = True
+                await self.send(text_data=json.dumps({
+                    'notice': 'dropped',
+                    'message': 'You are sending messages too fast. Messages are dropped until you slow down.',
+                    'retry_after': self.bucket.wait(),
+                }))
+            return
+        self.dropping = False
+
+        await self.outgoing.add(self.new_message(self.username, message[:chat.MAX_MESSAGE_LENGTH]))
+
+    def new_message(self, author, message):
+        """
+        A message said in this room, as clients are sent it. Its id tells it apart in the room's history.
+        :param author:
+        :param message:
+        :return: dict, as clients are sent it
+        """
+        return {'id': uuid.uuid4().hex, 'author': author, 'message': message}
+
+    async def send_to_group(self, messages):
+        """
+        Sends messages to the group associated with room name, in one group message.
+        :param messages: list of dict
+        :return:
+        """
         await self.channel_layer.group_send(
             self.group_name,
             {
                 'type': 'chat_message',
-                'author': self.username,
-                'message': message,
+                'messages': messages,
             }
         )
+        for message in messages:
+            await chat_writer.add(ChatMessage(game_id=self.game.pk, author=message['author'],
+                                              message=message['message']))
 
     async def chat_message(self, event):
         """
         Server response to message received by group that channel is in.
-        Each channel in group affected by event echoes message to client.
+        Each channel in group affected by event echoes messages to client, along with those that arrive within a short
+        window.
         :return:
         """
-        # Send message contained in event
-        author = event['author']
-        message = event['message']
-        await self.send(text_data=json.dumps(
-            {
-                'author': author,
-                'message': message,
-            }
-        ))
+        for message in event['messages']:
+            chat.history.add(self.room_name, message)
+            await self.incoming.add(message)
 
+    async def send_to_client(self, messages):
+        """
+        Sends messages to the client, in one frame.
+        :param messages: list of dict
+        :return:
+        """
+        await self.send(text_data=json.dumps({'messages': messages}))
 
-class GameConsumer(WebsocketConsumer):
+
+class GameConsumer(AsyncWebsocketConsumer):
     """
     Responds to players connecting and making commands in the game.
+    Database work runs in threads through database_sync_to_async, so a connection only holds a thread while it queries.
+
+    Users who do not play in the game connect as spectators. They are sent the public state from the game's shared
+    protocol.Feed, and can send no command but resync.
+
+    A client reconnecting with ?seq= is sent what it missed since that message, out of protocol.replay.
+    Frames go out through a protocol.Outbox, so a slow client is sent the latest state rather than every one.
     """
-    def connect(self):
+    async def connect(self):
         """
         Handles players connecting to the part of the server that will handle user requests associated with the game.
         :return:
         """
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.group_name = 'game_game_%s' % self.room_name
-        self.game = GameState.objects.get(room_name=self.room_name)
+        try:
+            self.game = await database_sync_to_async(GameState.objects.get)(room_name=self.room_name)
+        except GameState.DoesNotExist:
+            # Accepted first, so that the client is told why it was closed
+            await self.accept()
+            await self.close(code=protocol.ROOM_GONE)
+            return
         self.user = self.scope['user']
+        self.stream = protocol.Stream()  # Messages sent to this client
+        self.outbox = protocol.Outbox(self.send, self.too_slow)  # Frame waiting to be sent to this client
+        self.subprotocol = protocol.choose_subprotocol(self.scope.get('subprotocols', []))
+
+        # Users without a seat in the game spectate it. Anonymous users always do: filtering on their pk of None would
+        # match a free seat.
+        self.spectator = self.user.pk is None or not await database_sync_to_async(
+            self.game.playerstate_set.filter(user_id=self.user.pk).exists)()
+        if self.spectator:
+            self.feed = spectator_feeds.setdefault(self.game.pk, protocol.Feed())
+            self.feed.spectators += 1
+            self.seq = None  # seq of the last feed message sent to this client
+
+        # A reconnecting client picks up where it left off, if this worker still has the state it was last sent
+        seq = self.resumed_seq()
+        if self.spectator:
+            self.seq = seq
+        elif seq is not None:
+            base = protocol.replay.event(self.game.pk, seq)
+            state = protocol.state_for(base, self.user.username) if base is not None else None
+            if state is not None:
+                self.stream.resume(state, seq)
+
+        # What the client missed is read from memory while other connections keep the replay current
+        latest = protocol.replay.latest(self.game.pk)
+        protocol.replay.connect(self.game.pk)
 
         # Add the channel associated with the connecting WebSocket to the group
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name,
             self.channel_name,
         )
 
-        # Accept every client
-        self.accept()
+        # Accept every client, in the subprotocol it asked for
+        await self.accept(self.subprotocol)
 
-        self.update_client()
+        # A spectator joining others is sent the state they share, without loading it again
+        if self.spectator and self.feed.state is not None:
+            await self.outbox.put(self.feed_frame)
+        else:
+            await self.update_client(latest)
 
-    def disconnect(self, close_code):
+    def resumed_seq(self):
+        """
+        Sequence number of the last message a reconnecting client was sent, from ?seq= on the websocket URL.
+        :return: int, or None for a new client
+        """
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['seq'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def disconnect(self, close_code):
         """
         Server responds to client disconnect
         :return:
         """
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name,
         )
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+
+        # Unless the connection failed before it was counted
+        if not hasattr(self, 'spectator'):
+            return
+        protocol.replay.disconnect(self.game.pk)
+        if self.spectator:
+            self.feed.spectators -= 1
+            if not self.feed.spectators and spectator_feeds.get(self.game.pk) is self.feed:
+                del spectator_feeds[self.game.pk]
 
-    # TODO: Instead of receiving a command and making each consumer execute the command and send update to client,
-    # TODO: Lets do: The consumer the receives the command executes the command and informs all consumers in the game to render the client
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Server respond to data sent from client
         :return:
         """
         print('receive')
-        data = json.loads(text_data)
+        data = protocol.decode(text_data, bytes_data)
 
         command = data['command']
 
-        if command == 'start_game':
-            self.start_game()
-            # print('start_game')
-            # self.game.start_game()
-        elif command == 'end_turn':
-            self.end_turn()
-            # self.game.end_turn(self.user)
-        elif command == 'delete_game':
-            self.delete_game()
-            # self.game.delete_game()
-        elif command == 'summon':
-            self.summon(data)
-        elif command == 'attack':
-            self.attack(data)
-        elif command == 'attack_player':
-            self.attack_player(data)
+        # A client that missed a message only needs the whole state again, and nobody else needs anything
+        if command == 'resync':
+            await self.resync()
+            return
 
+        # Spectators only watch
+        if self.spectator:
+            print('spectator command %s ignored' % command)
+            return
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            {
-                'type': 'update_client'
-                # 'type': data['type']
-            }
-        )
+        # The shard that owns the game runs the command, and updates the group
+        shard = shards.shard_for(self.room_name)
+        if shard is not None:
+            await self.channel_layer.send(shard, {
+                'type': 'game.command',
+                'room_name': self.room_name,
+                'user_id': self.user.pk,
+                'command': command,
+                'data': data,
+                'reply_channel': self.channel_name,
+            })
+            return
+
+        # The state is built once, for every consumer in the group
+        event, has_bot, error = await self.run_command(command, data)
+        if error is not None:
+            await self.send_error(error)
+        if event is None:
+            return
+        await self.channel_layer.group_send(self.group_name, event)
+
+        # A bot may have been given the turn. It plays in the background.
+        if has_bot and gives_turn(command, data):
+            bot.schedule(self.game)
+
+    @database_sync_to_async
+    def run_command(self, command, data):
+        """
+        Runs a client's command, in a thread.
+        :param command:
+        :param data: message from the client
+        :return: (group message updating every client of the game, or None when nothing changed, whether a bot plays
+            in the game, exception of the command that failed or None)
+        """
+        error = None
+        try:
+            if command == 'start_game':
+                self.start_game()
+            elif command == 'end_turn':
+                self.end_turn()
+            elif command == 'delete_game':
+                self.delete_game()
+                return protocol.deleted_event(), False, None
+            elif command == 'summon':
+                self.summon(data)
+            elif command == 'attack':
+                self.attack(data)
+            elif command == 'attack_player':
+                self.attack_player(data)
+            elif command == 'add_bot':
+                self.add_bot()
+            elif command == 'surrender':
+                self.surrender()
+            elif command == 'batch':
+                error = self.batch(data)
+            else:
+                raise exceptions.InvalidCommand(command)
+        except Exception as failure:
+            # A failed command leaves the game as it was, and the client is told rather than disconnected
+            logger.exception('Command %s of room %s failed', command, self.room_name)
+            return None, False, failure
+
+        game = self.game.load_engine()
+        return protocol.update_event(game.snapshot()), game.has_bot, error
 
     # Server response based on type of event
 
-    def update_client(self, event=None):
+    async def update_client(self, event=None):
         """
-        Server sends to client the current state of the game.
-        Eventually, we should update
+        Server sends to client the current state of the game, as a patch of the last state it sent.
+        :param event: group message from protocol.update_event, or None to load the state
         :return:
         """
         print('update_client')
 
+        if event is None or 'public' not in event:
+            # Everything below is read from one snapshot, loaded in a fixed number of queries
+            event = protocol.update_event(await database_sync_to_async(self.game.load_snapshot)())
+        protocol.replay.add(self.game.pk, event)
+
+        # Spectators see the public state, encoded once for all of them
+        if self.spectator:
+            if event['public'] is not None:
+                self.feed.update(event['public'], event['version'])
+                await self.outbox.put(self.feed_frame)
+            return
+
         # If game hasn't started, do not give any information
-        if not self.game.is_started:
+        state = protocol.state_for(event, self.user.username)
+        if state is None:
             return
 
-        self.game.refresh_from_db()
-        # TODO: Send different information based on who the User is (player 1 and player 2)
+        # Send only what changed since the last message to this client, once it can be sent
+        version = event['version']
+        await self.outbox.put(lambda: self.stream_frame(state, version))
 
-        player_1 = self.game.player_1_state.user
-        player_2 = self.game.player_2_state.user
+    def stream_frame(self, state, version):
+        """
+        Frame of the message that brings this client to a state.
+        :param state: dict
+        :param version:
+        :return: keyword arguments of send, or None when the client has the state
+        """
+        message = self.stream.message(state, version)
+        if message is None:
+            return None
+        return protocol.encode(message, self.subprotocol)
 
-        if self.game.winner:
-            winner = self.game.winner.username
-        else:
-            winner = None
-
-        # Public information
-        data = {
-            'is_started': self.game.is_started,
-            'turn': self.game.turn,
-            'winner': winner,
-
-            'player_1_hp': self.game.player_1_state.hp,
-            'player_2_hp': self.game.player_2_state.hp,
-            'player_1_mana': self.game.player_1_state.mana,
-            'player_2_mana': self.game.player_2_state.mana,
-            'player_1_max_mana': self.game.player_1_state.max_mana,
-            'player_2_max_mana': self.game.player_2_state.max_mana,
-
-            # We cannot reference the deck until we create the deck by initializing player states
-            'player_1_deck_counter': self.game.player_1_state.deckstate.deckcard_set.count(),
-            'player_2_deck_counter': self.game.player_2_state.deckstate.deckcard_set.count(),
-        }
-        for index, field_card in enumerate(self.game.player_1_state.fieldstate.fieldcard_set.order_by('position')):
-            data['player_1_field_card_' + str(index) + '_position'] = field_card.position
-            data['player_1_field_card_' + str(index) + '_name'] = field_card.card.name
-            data['player_1_field_card_' + str(index) + '_description'] = field_card.card.description
-            data['player_1_field_card_' + str(index) + '_cost'] = field_card.card.cost
-            data['player_1_field_card_' + str(index) + '_picture'] = field_card.card.picture_url
-
-            data['player_1_field_card_' + str(index) + '_attack'] = field_card.attack
-            data['player_1_field_card_' + str(index) + '_hp'] = field_card.hp
-        for index, field_card in enumerate(self.game.player_2_state.fieldstate.fieldcard_set.order_by('position')):
-            data['player_2_field_card_' + str(index) + '_position'] = field_card.position
-            data['player_2_field_card_' + str(index) + '_name'] = field_card.card.name
-            data['player_2_field_card_' + str(index) + '_description'] = field_card.card.description
-            data['player_2_field_card_' + str(index) + '_cost'] = field_card.card.cost
-            data['player_2_field_card_' + str(index) + '_picture'] = field_card.card.picture_url
-
-            data['player_2_field_card_' + str(index) + '_attack'] = field_card.attack
-            data['player_2_field_card_' + str(index) + '_hp'] = field_card.hp
-
-        # Private information
-        if self.user.username == player_1.username:
-            player_state = self.game.player_1_state
-        else:
-            player_state = self.game.player_2_state
+    async def resync(self):
+        """
+        Server sends the whole state of the game to a client that missed a message.
+        :return:
+        """
+        print('resync')
+        if self.spectator:
+            self.seq = None
+            await self.outbox.put(self.feed_frame)
+            return
+        self.stream.reset()
+        # This connection keeps the replay current, so the state is not loaded again
+        await self.update_client(protocol.replay.latest(self.game.pk))
+
+    def feed_frame(self):
+        """
+        Frame of the feed that brings a spectator up to date.
+        :return: keyword arguments of send, or None when the spectator is up to date
+        """
+        frame = self.feed.frame(self.seq, self.subprotocol)
+        if frame is not None:
+            self.seq = self.feed.seq
+        return frame
+
+    async def send_error(self, error):
+        """
+        Server tells the client that its command failed, and which command of its batch.
+        :param error: exception of the command, see protocol.error_message
+        :return:
+        """
+        print('command failed: %r' % error)
+        await self.send(**protocol.encode(protocol.error_message(error), self.subprotocol))
+
+    async def command_error(self, event):
+        """
+        Server tells the client that its command failed, when a shard ran it.
+        :param event: {'type': 'command_error', 'error': message from protocol.error_message}
+        :return:
+        """
+        await self.send(**protocol.encode(event['error'], self.subprotocol))
+
+    async def game_deleted(self, event):
+        """
+        Server closes the clients of a deleted game, telling them not to reconnect.
+        :param event: group message from protocol.deleted_event
+        :return:
+        """
+        await self.close(code=protocol.ROOM_GONE)
 
-        for index, hand_card in enumerate(player_state.handstate.handcard_set.order_by('position')):
-            data['hand_card_' + str(index) + '_position'] = hand_card.position
-            data['hand_card_' + str(index) + '_name'] = hand_card.card.name
-            data['hand_card_' + str(index) + '_description'] = hand_card.card.description
-            data['hand_card_' + str(index) + '_cost'] = hand_card.card.cost
-            data['hand_card_' + str(index) + '_picture'] = hand_card.card.picture_url
+    async def too_slow(self):
+        """
+        Server disconnects a client that cannot keep up with the game. It resumes when it reconnects.
+        :return:
+        """
+        print('too_slow')
+        await self.close(code=protocol.TOO_SLOW)
 
-        # Send serialized message to client
-        message = json.dumps(data)
-        self.send(text_data=message)
+    # Commands, run in a thread by run_command
 
     def start_game(self):
         """
@@ -245,6 +528,14 @@ class GameConsumer(WebsocketConsumer):
         print('start_game')
         self.game.start_game()
 
+    def add_bot(self):
+        """
+        Server handles a computer opponent taking the free seat
+        :return:
+        """
+        print('add_bot')
+        self.game.add_bot()
+
     def end_turn(self):
         """
         Server handles Player ending his turn
@@ -258,6 +549,20 @@ class GameConsumer(WebsocketConsumer):
         # except exceptions.NotAuthorized:  # If the user isn't authorized to end turn and tries to do it, ignore it
         #     pass
 
+    def batch(self, data):
+        """
+        Server handles the Player sending several commands at once, such as attacks and then ending the turn.
+        They are applied in order in one transaction, and clients are updated once, after all of them.
+        data['commands'] holds the commands as they would be sent one by one. If data['atomic'] is true, the default,
+        a command failing fails them all, raising exceptions.CommandFailed. Otherwise the commands before it are kept.
+        :param data:
+        :return: exceptions.CommandFailed of the command that stopped a batch that is not atomic, or None
+        """
+        print('batch')
+        commands = batch_commands(self.user.pk, data)
+        game, error = self.game.run_commands(commands, atomic=data.get('atomic', True) is not False)
+        return error
+
     def delete_game(self):
         """
         Server handles deleting the game.
@@ -317,3 +622,99 @@ class GameConsumer(WebsocketConsumer):
 
         self.game.attack_player(self.user, attacking_field_card_position, defending_player_name)
 
+
+
+class GameShardConsumer(SyncConsumer):
+    """
+    Runs the commands of the games whose rooms hash to its channel (see shards), one at a time, in the order they come.
+    Started games are kept in memory between commands, so a command loads nothing while its game is current. A game is
+    reloaded when something else changed it, such as a bot's turn, which the version of its GameState tells.
+    """
+
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.games = OrderedDict()  # room name -> (GameState, engine.Game), used last at the end
+
+    def game_command(self, event):
+        """
+        Server runs a command forwarded by a GameConsumer, and updates every client of the game.
+        :param event: {'type': 'game.command', 'room_name', 'user_id', 'command', 'data', 'reply_channel'}, the
+            reply channel being the channel of the GameConsumer, which is told if the command fails
+        :return:
+        """
+        room_name, command, data = event['room_name'], event['command'], event['data']
+        print('shard %s %s' % (room_name, command))
+        game_state, game = self.games.pop(room_name, (None, None))
+        error = None
+        try:
+            if game_state is None:
+                game_state = GameState.objects.get(room_name=room_name)
+            elif not GameState.objects.filter(pk=game_state.pk, version=game.version).exists():
+                game = None
+
+            if command in ENGINE_COMMANDS or command == 'batch':
+                if command == 'batch':
+                    commands = batch_commands(event['user_id'], data)
+                else:
+                    commands = [engine_command(event['user_id'], data)]
+                game, error = game_state.run_commands(commands, atomic=data.get('atomic', True) is not False,
+                                                      game=game)
+            else:
+                game = None
+                self.run_game_state_command(game_state, command, event['user_id'])
+        except Exception as failure:
+            # A failed command leaves its game as it was, and must not stop the commands of the other rooms
+            logger.exception('Shard command %s of room %s failed', command, room_name)
+            if isinstance(failure, exceptions.CommandFailed) and command != 'batch':
+                failure = failure.error  # a single command has no index
+            self.reply_error(event, failure)
+            return
+        if error is not None:
+            self.reply_error(event, error)
+
+        if command == 'delete_game':
+            # The game left the cache when its command came in, and is not put back
+            async_to_sync(self.channel_layer.group_send)('game_game_%s' % room_name, protocol.deleted_event())
+            return
+
+        if game is None:
+            game = game_state.load_engine()
+        if game.is_started:
+            self.games[room_name] = (game_state, game)
+            while len(self.games) > shards.SHARD_GAMES:
+                self.games.popitem(last=False)
+
+        async_to_sync(self.channel_layer.group_send)('game_game_%s' % room_name,
+                                                     protocol.update_event(game.snapshot()))
+        if game.has_bot and gives_turn(command, data):
+            bot.schedule(game_state)
+
+    def reply_error(self, event, error):
+        """
+        Tells the GameConsumer that forwarded a command that it failed.
+        :param event: game.command event of the command
+        :param error: exception of the command
+        :return:
+        """
+        async_to_sync(self.channel_layer.send)(event['reply_channel'], {
+            'type': 'command_error',
+            'error': protocol.error_message(error),
+        })
+
+    @staticmethod
+    def run_game_state_command(game_state, command, user_id):
+        """
+        Runs a client command that is not an engine.Game command.
+        :param game_state: GameState
+        :param command:
+        :param user_id:
+        :return:
+        """
+        if command == 'start_game':
+            game_state.start_game()
+        elif command == 'add_bot':
+            game_state.add_bot()
+        elif command == 'delete_game':
+            game_state.delete_game()
+        elif command != 'surrender':
+            raise exceptions.InvalidCommand(command)
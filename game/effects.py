@@ -0,0 +1,116 @@
+"""
+Card abilities.
+
+A card's effect text holds one ability per line, each an event and the action it triggers:
+
+    <event>: <action> <amount>
+
+such as "destroyed: draw 1" or "turn_ended: damage_enemy_player 2". Effect text is compiled into handlers once per
+card definition (see engine.CardDefinition), never on each trigger.
+
+A Game keeps an index from each event to the field cards listening for it, so dispatching an event only calls its
+listeners (see engine.Game.dispatch).
+
+Actions only go through engine.Game methods, so abilities are as deterministic as the rest of a command, and
+replaying the command log replays them too.
+"""
+from functools import lru_cache
+
+from . import exceptions
+
+# Events about the card with the ability, which only that card hears
+SUMMONED = 'summoned'
+DESTROYED = 'destroyed'
+CARD_EVENTS = frozenset([SUMMONED, DESTROYED])
+
+# Events that every listening field card hears
+MONSTER_SUMMONED = 'monster_summoned'  # another monster is summoned
+MONSTER_DESTROYED = 'monster_destroyed'  # another monster is destroyed
+TURN_STARTED = 'turn_started'
+TURN_ENDED = 'turn_ended'
+GAME_EVENTS = frozenset([MONSTER_SUMMONED, MONSTER_DESTROYED, TURN_STARTED, TURN_ENDED])
+
+EVENTS = CARD_EVENTS | GAME_EVENTS
+
+# Distinct effect texts whose compiled handlers are kept, the texts used last
+COMPILED_EFFECTS = 1024
+
+# Largest value an action raises a stat to, the largest the stat's IntegerField column holds
+MAX_STAT = 2 ** 31 - 1
+
+# Action name -> function(game, card, amount), card being the card with the ability
+ACTIONS = {}
+
+
+def action(name):
+    """
+    Registers a function as an action that effect text can name.
+    :param name:
+    :return: decorator
+    """
+    def register(function):
+        ACTIONS[name] = function
+        return function
+    return register
+
+
+@action('damage_enemy_player')
+def damage_enemy_player(game, card, amount):
+    game.damage_player(game.opponent_of(card.owner), amount)
+
+
+@action('damage_enemy_field')
+def damage_enemy_field(game, card, amount):
+    opponent = game.opponent_of(card.owner)
+    for position in sorted(opponent.field):
+        game.damage_card(opponent.field[position], amount)
+
+
+@action('heal_owner')
+def heal_owner(game, card, amount):
+    card.owner.hp = min(card.owner.hp + amount, MAX_STAT)
+    game.touch_player(card.owner)
+
+
+@action('draw')
+def draw(game, card, amount):
+    for _ in range(amount):
+        game.draw_if_possible(card.owner)
+
+
+@action('buff_attack')
+def buff_attack(game, card, amount):
+    if card.attack is not None:
+        card.attack = min(card.attack + amount, MAX_STAT)
+        game.touch_card(card)
+
+
+def _handler(function, amount):
+    def handler(game, card):
+        function(game, card, amount)
+    return handler
+
+
+@lru_cache(maxsize=COMPILED_EFFECTS)
+def compile_effect(text):
+    """
+    Compiles effect text into handlers. Cards with the same effect text share the compiled handlers.
+    :param text: effect text
+    :return: dict of event -> tuple of handler(game, card). Shared, so it must not be changed.
+    """
+    abilities = {}
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        event, separator, rest = line.partition(':')
+        words = rest.split()
+        event = event.strip()
+        if not separator or event not in EVENTS or len(words) != 2 or words[0] not in ACTIONS:
+            raise exceptions.InvalidEffect(line)
+        try:
+            amount = int(words[1])
+        except ValueError:
+            raise exceptions.InvalidEffect(line)
+        abilities.setdefault(event, []).append(_handler(ACTIONS[words[0]], amount))
+    return {event: tuple(handlers) for event, handlers in abilities.items()}
@@ -0,0 +1,803 @@
+"""
+In-memory rules engine for GameState.
+
+A game's tree (players, decks, hands, fields and the cards in them) is loaded once into the compact objects below.
+Commands are applied to these objects in memory, and every object a command touches is remembered so that
+GameState can write the changes back to the database in one batch (see GameState.load_engine and
+GameState.save_engine).
+
+Nothing in this module touches the database.
+"""
+from collections import namedtuple
+
+from . import effects, exceptions
+
+
+# Number of positions in a player's hand and field
+HAND_SIZE = 10
+FIELD_SIZE = 7
+
+# Game methods that are commands. Only these are applied when a logged command is replayed.
+COMMANDS = frozenset(['draw_card', 'draw_cards', 'summon', 'attack', 'attack_player', 'end_turn'])
+
+# Zones a card instance can be in
+DECK = 'deck'
+HAND = 'hand'
+FIELD = 'field'
+GRAVEYARD = 'graveyard'
+
+
+# Upkeep: what happens to every field card at the end of each turn.
+# Each step is (column, operation, operand), applied in order:
+#   ADD adds operand to the column, COPY copies the column named operand, SET sets the column to operand.
+# Being declared as column operations, the upkeep of a whole field can be written to the database as one set-based
+# UPDATE (see FieldState.upkeep_updates). Per-turn effects join the upkeep phase with register_upkeep.
+ADD = 'add'
+COPY = 'copy'
+SET = 'set'
+
+UPKEEP = [
+    ('turns_alive', ADD, 1),
+    ('attacks_left', COPY, 'attacks_per_turn'),
+]
+
+
+def register_upkeep(column, operation, operand):
+    """
+    Adds a step to the end of the upkeep phase.
+    :param column: CardInstance attribute, which is also a GameCard column
+    :param operation: ADD, COPY or SET
+    :param operand:
+    :return:
+    """
+    if operation not in (ADD, COPY, SET):
+        raise ValueError(operation)
+    UPKEEP.append((column, operation, operand))
+
+
+def apply_upkeep(card):
+    """
+    Applies every upkeep step to a card in memory.
+    :param card: CardInstance
+    :return:
+    """
+    for column, operation, operand in UPKEEP:
+        if operation == ADD:
+            setattr(card, column, getattr(card, column) + operand)
+        elif operation == COPY:
+            setattr(card, column, getattr(card, operand))
+        else:
+            setattr(card, column, operand)
+
+
+def lowest_free_position(occupied, size):
+    """
+    Returns the lowest position whose bit is not set in an occupancy bitmask, or None if all size positions are set.
+    :param occupied: bitmask, bit i set when position i is occupied
+    :param size: number of positions
+    :return:
+    """
+    free = ~occupied & ((1 << size) - 1)
+    if not free:
+        return None
+    # Isolate the lowest set bit of free
+    return (free & -free).bit_length() - 1
+
+
+def free_positions(occupied, size):
+    """
+    Returns the positions whose bit is not set in an occupancy bitmask, lowest first.
+    :return: list
+    """
+    return [position for position in range(size) if not occupied >> position & 1]
+
+
+class CardSnapshot(namedtuple('CardSnapshot', ['position', 'card', 'attack', 'hp', 'turns_alive', 'attacks_left',
+                                                 'charge'])):
+    """
+    Read-only view of a card in a hand or field. card is its CardDefinition.
+    """
+    __slots__ = ()
+
+
+class PlayerSnapshot(namedtuple('PlayerSnapshot', ['pk', 'user_id', 'username', 'is_moving', 'is_first', 'hp', 'mana',
+                                                   'max_mana', 'deck_count', 'hand', 'field'])):
+    """
+    Read-only view of a player. hand and field are tuples of CardSnapshot ordered by position.
+    """
+    __slots__ = ()
+
+
+class GameSnapshot(namedtuple('GameSnapshot', ['pk', 'room_name', 'turn', 'is_started', 'is_ended', 'winner_id',
+                                               'players', 'version'])):
+    """
+    Read-only view of a game. players holds the PlayerSnapshot of the player who goes first, then second.
+    version is the version of the game the snapshot was taken at.
+    """
+    __slots__ = ()
+
+    @property
+    def player_1(self):
+        return self.players[0]
+
+    @property
+    def player_2(self):
+        return self.players[1]
+
+    @property
+    def winner(self):
+        """
+        PlayerSnapshot of the winner, if there is one.
+        :return:
+        """
+        for player in self.players:
+            if self.winner_id is not None and player.user_id == self.winner_id:
+                return player
+        return None
+
+    def player_of(self, user_id):
+        """
+        PlayerSnapshot of the player a User plays as, or None if the User is not playing.
+        :param user_id:
+        :return:
+        """
+        for player in self.players:
+            if user_id is not None and player.user_id == user_id:
+                return player
+        return None
+
+
+class CardDefinition:
+    """
+    The values a card instance is created from. Mirrors a MonsterCardState.
+    """
+    __slots__ = ('pk', 'name', 'description', 'cost', 'picture_url', 'attack', 'hp', 'effect', 'abilities')
+
+    def __init__(self, pk, name, description, cost, picture_url, attack, hp, effect=''):
+        self.pk = pk
+        self.name = name
+        self.description = description
+        self.cost = cost
+        self.picture_url = picture_url
+        self.attack = attack
+        self.hp = hp
+        self.effect = effect
+        # Event -> handlers, compiled from the effect text once for the definition
+        self.abilities = effects.compile_effect(effect)
+
+
+class CardInstance:
+    """
+    A card in one of a player's zones. Mirrors a GameCard.
+    """
+    __slots__ = ('definition', 'owner', 'zone', 'position', 'attack', 'hp', 'turns_alive', 'attacks_per_turn',
+                 'attacks_left', 'charge', 'row_pk', 'row_zone', 'row_position')
+
+    def __init__(self, definition, owner, zone, position=None, attack=None, hp=None, turns_alive=0,
+                 attacks_per_turn=1, attacks_left=None, charge=False, row_pk=None):
+        self.definition = definition
+        self.owner = owner  # Player
+        self.zone = zone
+        self.position = position
+        self.attack = attack
+        self.hp = hp
+        self.turns_alive = turns_alive
+        self.attacks_per_turn = attacks_per_turn
+        self.attacks_left = attacks_left
+        self.charge = charge
+
+        # GameCard row this instance was loaded from, and the zone and position of that row.
+        # A card whose zone differs from row_zone has moved, which changes the occupancy of both zones.
+        self.row_pk = row_pk
+        self.row_zone = zone if row_pk is not None else None
+        self.row_position = position if row_pk is not None else None
+
+    def copy(self, owner):
+        """
+        Copy of this card, owned by a copy of its owner. The definition is shared.
+        :param owner: Player
+        :return: CardInstance
+        """
+        card = CardInstance.__new__(CardInstance)
+        for slot in CardInstance.__slots__:
+            setattr(card, slot, getattr(self, slot))
+        card.owner = owner
+        return card
+
+
+class Player:
+    """
+    A player's stats and zones. Mirrors a PlayerState.
+    """
+    __slots__ = ('pk', 'user_id', 'username', 'is_moving', 'is_first', 'hp', 'mana', 'max_mana',
+                 'deck', 'hand', 'field', 'graveyard', 'hand_occupied', 'field_occupied', 'zone_pks', 'is_bot')
+
+    def __init__(self, pk, user_id, username, is_moving, is_first, hp, mana, max_mana, zone_pks=None, is_bot=False):
+        self.pk = pk
+        self.user_id = user_id
+        self.username = username
+        self.is_moving = is_moving
+        self.is_first = is_first
+        self.hp = hp
+        self.mana = mana
+        self.max_mana = max_mana
+        self.is_bot = is_bot  # whether a bot plays this seat
+
+        self.deck = []  # CardInstance, shuffled, the top of the deck last
+        self.hand = {}  # position -> CardInstance
+        self.field = {}  # position -> CardInstance
+        self.graveyard = []  # CardInstance, in no particular order
+
+        # Bitmasks of occupied hand and field positions, bit i set when position i is occupied
+        self.hand_occupied = 0
+        self.field_occupied = 0
+
+        # pks of the DeckState, HandState and FieldState rows, keyed by zone
+        self.zone_pks = zone_pks or {}
+
+    def next_hand_position(self):
+        """
+        Returns the lowest hand position not occupied by a hand card, or None if the hand is full.
+        :return:
+        """
+        return lowest_free_position(self.hand_occupied, HAND_SIZE)
+
+    def next_field_position(self):
+        """
+        Returns the lowest field position not occupied by a field card, or None if the field is full.
+        :return:
+        """
+        return lowest_free_position(self.field_occupied, FIELD_SIZE)
+
+    def add(self, card):
+        """
+        Puts a loaded card in the zone it says it is in. Deck cards must be added bottom of the deck first.
+        :param card: CardInstance
+        :return:
+        """
+        if card.zone == DECK:
+            self.deck.append(card)
+        elif card.zone == GRAVEYARD:
+            self.graveyard.append(card)
+        else:
+            self.place(card, card.zone, card.position)
+
+    def place(self, card, zone, position):
+        """
+        Puts a card in a free position of the hand or field.
+        :param card: CardInstance
+        :param zone: HAND or FIELD
+        :param position:
+        :return:
+        """
+        card.zone = zone
+        card.position = position
+        if zone == HAND:
+            self.hand[position] = card
+            self.hand_occupied |= 1 << position
+        else:
+            self.field[position] = card
+            self.field_occupied |= 1 << position
+
+    def take(self, zone, position):
+        """
+        Takes the card out of a position of the hand or field.
+        :param zone: HAND or FIELD
+        :param position:
+        :return: CardInstance
+        """
+        if zone == HAND:
+            self.hand_occupied &= ~(1 << position)
+            return self.hand.pop(position)
+        else:
+            self.field_occupied &= ~(1 << position)
+            return self.field.pop(position)
+
+
+class Game:
+    """
+    The state of a GameState and both of its players.
+    Commands check the same rules as the GameState commands and record what they change.
+    """
+    __slots__ = ('pk', 'room_name', 'version', 'turn', 'is_started', 'is_ended', 'winner_id', 'players',
+                 'listeners', 'touched_cards', 'touched_players', 'upkeeps')
+
+    def __init__(self, pk, room_name, turn, is_started, is_ended, winner_id, players, version=0):
+        self.pk = pk
+        self.room_name = room_name
+        self.version = version  # GameState.version this state was loaded at
+        self.turn = turn
+        self.is_started = is_started
+        self.is_ended = is_ended
+        self.winner_id = winner_id
+        self.players = tuple(players)  # Player who goes first, then player who goes second
+
+        # Event -> field cards with an ability for it, in listener_order
+        self.listeners = {}
+        for player in self.players:
+            for card in player.field.values():
+                self.subscribe(card)
+
+        # Write-behind bookkeeping
+        self.touched_cards = []
+        self.touched_players = []
+        self.upkeeps = {}  # Player -> number of upkeep phases their field went through
+
+    # Accessors
+
+    @property
+    def player_moving(self):
+        return self.players[0] if self.players[0].is_moving else self.players[1]
+
+    @property
+    def player_waiting(self):
+        return self.players[1] if self.players[0].is_moving else self.players[0]
+
+    @property
+    def has_bot(self):
+        """
+        Whether a bot plays in this game, and so may have to be given its turn.
+        :return:
+        """
+        return any(player.is_bot for player in self.players)
+
+    def opponent_of(self, player):
+        return self.players[1] if player is self.players[0] else self.players[0]
+
+    def clone(self):
+        """
+        Copy of this game that commands can be applied to without changing this one, such as to search moves.
+        Card definitions are shared, and the write-behind bookkeeping is not copied.
+        :return: Game
+        """
+        players = []
+        for player in self.players:
+            copy = Player(player.pk, player.user_id, player.username, player.is_moving, player.is_first, player.hp,
+                          player.mana, player.max_mana, zone_pks=player.zone_pks, is_bot=player.is_bot)
+            copy.deck = [card.copy(copy) for card in player.deck]
+            copy.hand = {position: card.copy(copy) for position, card in player.hand.items()}
+            copy.field = {position: card.copy(copy) for position, card in player.field.items()}
+            copy.graveyard = [card.copy(copy) for card in player.graveyard]
+            copy.hand_occupied = player.hand_occupied
+            copy.field_occupied = player.field_occupied
+            players.append(copy)
+        return Game(self.pk, self.room_name, self.turn, self.is_started, self.is_ended, self.winner_id, players,
+                    version=self.version)
+
+    def snapshot(self):
+        """
+        Read-only copy of the current state.
+        :return: GameSnapshot
+        """
+        def card_snapshots(zone):
+            return tuple(CardSnapshot(position, card.definition, card.attack, card.hp, card.turns_alive,
+                                      card.attacks_left, card.charge)
+                         for position, card in sorted(zone.items()))
+
+        players = tuple(PlayerSnapshot(player.pk, player.user_id, player.username, player.is_moving, player.is_first,
+                                       player.hp, player.mana, player.max_mana, len(player.deck),
+                                       card_snapshots(player.hand), card_snapshots(player.field))
+                        for player in self.players)
+        return GameSnapshot(self.pk, self.room_name, self.turn, self.is_started, self.is_ended, self.winner_id,
+                            players, self.version)
+
+    # Write-behind bookkeeping
+
+    def touch_card(self, card):
+        if card not in self.touched_cards:
+            self.touched_cards.append(card)
+
+    def remove_card(self, card):
+        """
+        Takes a card out of play, to its owner's graveyard.
+        :param card: CardInstance
+        :return:
+        """
+        card.zone = GRAVEYARD
+        card.position = None
+        card.owner.graveyard.append(card)
+        self.touch_card(card)
+
+    def touch_player(self, player):
+        if player not in self.touched_players:
+            self.touched_players.append(player)
+
+    def clear_touched(self):
+        """
+        Forgets the recorded changes once they have been written to the database.
+        :return:
+        """
+        self.touched_cards = []
+        self.touched_players = []
+        self.upkeeps = {}
+
+    # Abilities
+
+    def listener_order(self, card):
+        """
+        Order listeners hear game events in: the first player's field cards, then the second's, by position.
+        It only depends on what is saved, so a game loaded from the database runs abilities in the same order as the
+        game it was saved from.
+        :param card: CardInstance on the field
+        :return: sort key
+        """
+        return card.owner is not self.players[0], card.position
+
+    def subscribe(self, card):
+        """
+        Indexes a card that entered the field under each game event it has an ability for.
+        :param card: CardInstance
+        :return:
+        """
+        for event in card.definition.abilities:
+            if event in effects.GAME_EVENTS:
+                listeners = self.listeners.setdefault(event, [])
+                listeners.append(card)
+                listeners.sort(key=self.listener_order)
+
+    def unsubscribe(self, card):
+        for event in card.definition.abilities:
+            if event in effects.GAME_EVENTS:
+                self.listeners[event].remove(card)
+
+    def dispatch(self, event, source=None):
+        """
+        Runs the abilities of the cards listening for an event.
+        Events about a card are only heard by that card. Game events are heard by every listening field card but
+        source.
+        :param event: one of effects.EVENTS
+        :param source: CardInstance the event is about
+        :return:
+        """
+        if event in effects.CARD_EVENTS:
+            listeners = [source]
+        else:
+            # Copied, since abilities can summon or destroy listeners
+            listeners = [card for card in self.listeners.get(event, ()) if card is not source]
+        for card in listeners:
+            # An earlier ability may have destroyed this listener
+            if card.zone != FIELD and event != effects.DESTROYED:
+                continue
+            for handler in card.definition.abilities.get(event, ()):
+                handler(self, card)
+
+    def damage_card(self, card, amount):
+        """
+        A field card loses hp, and is destroyed if it has none left.
+        :param card: CardInstance
+        :param amount:
+        :return:
+        """
+        card.hp -= amount
+        self.touch_card(card)
+        if card.hp <= 0:
+            self.destroy(card)
+
+    def destroy(self, card):
+        """
+        Removes a card from its owner's field to their graveyard.
+        :param card: CardInstance
+        :return:
+        """
+        if card.zone != FIELD:
+            return
+        card.owner.take(FIELD, card.position)
+        self.unsubscribe(card)
+        self.remove_card(card)
+        self.dispatch(effects.DESTROYED, card)
+        self.dispatch(effects.MONSTER_DESTROYED, card)
+
+    def damage_player(self, player, amount):
+        """
+        A player loses hp. A player with no hp left loses the game.
+        :param player: Player
+        :param amount:
+        :return:
+        """
+        player.hp -= amount
+        self.touch_player(player)
+        if player.hp <= 0 and not self.is_ended:
+            self.is_ended = True
+            self.winner_id = self.opponent_of(player).user_id
+
+    def draw_if_possible(self, player):
+        """
+        A player draws a card, unless their deck or hand does not allow it.
+        :param player:
+        :return: CardInstance drawn, or None
+        """
+        if player.deck and player.next_hand_position() is not None:
+            return self._draw(player)
+        return None
+
+    def apply(self, command, args):
+        """
+        Applies a command by name, as it was recorded in the command log.
+        :param command: one of COMMANDS
+        :param args: arguments of the command
+        :return: what the command returns
+        """
+        if command not in COMMANDS:
+            raise ValueError(command)
+        return getattr(self, command)(*args)
+
+    def upkeep(self, player):
+        """
+        Runs the upkeep phase on every card in a player's field.
+        The cards are not touched one by one: the whole field is written back with one set-based update.
+        :param player:
+        :return:
+        """
+        for card in player.field.values():
+            apply_upkeep(card)
+        self.upkeeps[player] = self.upkeeps.get(player, 0) + 1
+
+    # Rules
+
+    def check_can_move(self, user_id):
+        """
+        Raises unless the user is the moving player of a game in progress.
+        :param user_id: pk of the User giving the command
+        :return: Player that is moving
+        """
+        player_moving = self.player_moving
+
+        # Check authorization
+        if user_id is None or user_id != player_moving.user_id:
+            raise exceptions.NotAuthorized
+
+        # Check game started
+        if not self.is_started:
+            raise exceptions.GameNotStarted
+
+        # Check game ended
+        if self.is_ended:
+            raise exceptions.GameEnded
+
+        return player_moving
+
+    def draw_card(self, user_id):
+        """
+        The moving player removes the top card of their deck and puts it in their hand.
+        :param user_id:
+        :return: CardInstance drawn
+        """
+        player = self.check_can_move(user_id)
+        return self._draw(player)
+
+    def draw_cards(self, user_id, num):
+        """
+        The moving player draws num cards.
+        :param user_id:
+        :param num:
+        :return: list of CardInstance drawn
+        """
+        player = self.check_can_move(user_id)
+        return [self._draw(player) for _ in range(num)]
+
+    def _draw(self, player):
+        # Check if empty
+        if not player.deck:
+            raise exceptions.DeckEmpty
+
+        # Check if position is available
+        position = player.next_hand_position()
+        if position is None:
+            raise exceptions.HandFull
+
+        # The deck was shuffled when it was created, so the top card is a random one
+        card = player.deck.pop()
+        player.place(card, HAND, position)
+        self.touch_card(card)
+        return card
+
+    def summon(self, user_id, hand_card_position, field_card_position):
+        """
+        The moving player summons a monster from their hand to their field.
+        :param user_id:
+        :param hand_card_position:
+        :param field_card_position:
+        :return: CardInstance summoned
+        """
+        player = self.check_can_move(user_id)
+
+        # Reference candidate hand position
+        card = player.hand.get(hand_card_position)
+        if card is None:
+            raise exceptions.InvalidCard
+
+        # Check the field position exists and is free
+        if not 0 <= field_card_position < FIELD_SIZE:
+            raise exceptions.InvalidCard
+        if player.field_occupied >> field_card_position & 1:
+            raise exceptions.FieldPositionOccupied
+
+        # Check if enough mana
+        if card.definition.cost > player.mana:
+            raise exceptions.ManaInsuffcient
+
+        # Move the card from the hand to the field, and remove the cost in mana
+        player.take(HAND, hand_card_position)
+        player.place(card, FIELD, field_card_position)
+        card.attack = card.definition.attack
+        card.hp = card.definition.hp
+        card.turns_alive = 0
+        card.attacks_per_turn = 1
+        card.attacks_left = 1
+        self.touch_card(card)
+
+        player.mana -= card.definition.cost
+        self.touch_player(player)
+
+        self.subscribe(card)
+        self.dispatch(effects.SUMMONED, card)
+        self.dispatch(effects.MONSTER_SUMMONED, card)
+        return card
+
+    def _check_can_attack(self, attacker):
+        # Check immediate attack
+        if attacker.turns_alive == 0 and not attacker.charge:
+            raise exceptions.AttackOnTurnSummonedWithoutCharge
+
+        # Check attacks left
+        if attacker.attacks_left <= 0:
+            raise exceptions.AttacksNoneLeft
+
+    def attack(self, user_id, attacking_field_card_position, defending_field_card_position):
+        """
+        A monster controlled by the moving player fights a monster controlled by the waiting player.
+        :param user_id:
+        :param attacking_field_card_position:
+        :param defending_field_card_position:
+        :return:
+        """
+        player_moving = self.check_can_move(user_id)
+        player_waiting = self.player_waiting
+
+        # Reference attacking and defending field cards
+        attacker = player_moving.field.get(attacking_field_card_position)
+        defender = player_waiting.field.get(defending_field_card_position)
+        if attacker is None or defender is None:
+            raise exceptions.InvalidCard
+
+        self._check_can_attack(attacker)
+
+        # Perform combat
+        attacker.hp -= defender.attack
+        defender.hp -= attacker.attack
+        attacker.attacks_left -= 1
+        self.touch_card(attacker)
+        self.touch_card(defender)
+
+        # If a field card has 0 or less hp, it is removed from the field
+        if attacker.hp <= 0:
+            self.destroy(attacker)
+        if defender.hp <= 0:
+            self.destroy(defender)
+
+    def attack_player(self, user_id, attacking_field_card_position, defending_player_name):
+        """
+        A monster controlled by the moving player attacks the waiting player.
+        :param user_id:
+        :param attacking_field_card_position:
+        :param defending_player_name: username of the player being attacked
+        :return:
+        """
+        player_moving = self.check_can_move(user_id)
+        defender = self.player_waiting
+
+        # Reference attacking field card
+        attacker = player_moving.field.get(attacking_field_card_position)
+        if attacker is None:
+            raise exceptions.InvalidCard
+
+        # Check defending player is valid
+        if defender.username != defending_player_name:
+            raise exceptions.AttackInvalidPlayer
+
+        self._check_can_attack(attacker)
+
+        # Calculate combat. If player has 0 or less hp, then game is over, and is won by attacking player
+        attacker.attacks_left -= 1
+        self.touch_card(attacker)
+        self.damage_player(defender, attacker.attack)
+
+    def end_turn(self, user_id):
+        """
+        The moving player ends their turn.
+        :param user_id:
+        :return:
+        """
+        player_moving = self.check_can_move(user_id)
+        player_waiting = self.player_waiting
+        self.dispatch(effects.TURN_ENDED)
+
+        # Players switch moving / waiting
+        player_moving.is_moving = False
+        player_waiting.is_moving = True
+
+        # Increment turn counter
+        self.turn += 1
+
+        # Field card effects trigger
+        for player in self.players:
+            self.upkeep(player)
+
+        # Next player draws a card, unless their deck or hand does not allow it
+        self.draw_if_possible(player_waiting)
+
+        # Player that ended their turn increments max mana and restores mana
+        player_moving.max_mana += 1
+        player_moving.mana = player_moving.max_mana
+
+        self.touch_player(player_moving)
+        self.touch_player(player_waiting)
+        self.dispatch(effects.TURN_STARTED)
+
+
+# Snapshots
+# A snapshot is the whole state of a Game as plain lists and dicts, which can be stored as JSON.
+# Cards are lists of CARD_FIELDS values, and refer to their definition by pk.
+
+DEFINITION_FIELDS = ('pk', 'name', 'description', 'cost', 'picture_url', 'attack', 'hp', 'effect')
+CARD_FIELDS = ('definition', 'zone', 'position', 'attack', 'hp', 'turns_alive', 'attacks_per_turn', 'attacks_left',
+               'charge', 'row_pk')
+PLAYER_FIELDS = ('pk', 'user_id', 'username', 'is_moving', 'is_first', 'hp', 'mana', 'max_mana', 'zone_pks',
+                 'is_bot')
+
+
+def dump_game(game):
+    """
+    Takes a snapshot of a game.
+    :param game: Game
+    :return: dict
+    """
+    definitions = {}
+    players = []
+    for player in game.players:
+        cards = []
+        zones = (player.deck, [player.hand[position] for position in sorted(player.hand)],
+                 [player.field[position] for position in sorted(player.field)], player.graveyard)
+        for zone in zones:
+            for card in zone:
+                definitions[card.definition.pk] = card.definition
+                cards.append([card.definition.pk] + [getattr(card, field) for field in CARD_FIELDS[1:]])
+        players.append(dict({field: getattr(player, field) for field in PLAYER_FIELDS}, cards=cards))
+
+    return {
+        'pk': game.pk,
+        'room_name': game.room_name,
+        'version': game.version,
+        'turn': game.turn,
+        'is_started': game.is_started,
+        'is_ended': game.is_ended,
+        'winner_id': game.winner_id,
+        'definitions': [[getattr(definition, field) for field in DEFINITION_FIELDS]
+                        for definition in definitions.values()],
+        'players': players,
+    }
+
+
+def load_game(data):
+    """
+    Rebuilds a game from a snapshot taken by dump_game.
+    :param data: dict
+    :return: Game
+    """
+    definitions = {}
+    for values in data['definitions']:
+        definition = CardDefinition(*values)
+        definitions[definition.pk] = definition
+
+    players = []
+    for player_data in data['players']:
+        # Snapshots taken before a field was added do not have it, and it keeps its default
+        player = Player(**{field: player_data[field] for field in PLAYER_FIELDS if field in player_data})
+        for values in player_data['cards']:
+            card = dict(zip(CARD_FIELDS, values))
+            definition = definitions[card.pop('definition')]
+            player.add(CardInstance(definition, player, **card))
+        players.append(player)
+
+    return Game(pk=data['pk'], room_name=data['room_name'], turn=data['turn'], is_started=data['is_started'],
+                is_ended=data['is_ended'], winner_id=data['winner_id'], players=players, version=data['version'])
@@ -57,4 +57,36 @@ class AttacksNoneLeft(Exception):
     pass
 
 
+class GameStateConflict(Exception):
+    pass
+
+
+class InvalidEffect(Exception):
+    pass
+
+
+class InvalidBatch(Exception):
+    pass
+
+
+class InvalidCommand(Exception):
+    pass
+
+
+class OccupancyMismatch(Exception):
+    """
+    The occupancy of a player's hand or field disagrees with the cards in it: pk is the player's PlayerState.
+    """
+    def __init__(self, pk):
+        super().__init__(pk)
+        self.pk = pk
+
 
+class CommandFailed(Exception):
+    """
+    A command of a batch failed: error is the exception it raised, index its position in the batch.
+    """
+    def __init__(self, index, error):
+        super().__init__(index, error)
+        self.index = index
+        self.error = error
@@ -6,6 +6,7 @@
 # Thus ModelForms contain a subset of a model's fields information
 
 from django import forms
+from . import effects, exceptions
 from .models import Card, MonsterCard, SpellCard, Deck, GameState, UserSettings
 
 
@@ -29,9 +30,18 @@ class MonsterCardForm(CardForm):
         fields = CardForm.Meta.fields + [
             'attack',
             'hp',
+            'effect',
         ]
         # exclude = ['type',]
 
+    def clean_effect(self):
+        effect = self.cleaned_data['effect']
+        try:
+            effects.compile_effect(effect)
+        except exceptions.InvalidEffect as e:
+            raise forms.ValidationError('Invalid ability: %(ability)s', params={'ability': e})
+        return effect
+
 
 class SpellCardForm(CardForm):
     class Meta(CardForm.Meta):
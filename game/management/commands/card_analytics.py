@@ -0,0 +1,20 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Computes trade, hero kill, mana curve and deck versus deck analytics of every MonsterCard and Deck.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='card_analytics.json', help='file the analytics are written to')
+
+    def handle(self, *args, **options):
+        # Needs NumPy, which the rest of the app does not
+        from game import analytics
+
+        report = analytics.report()
+        with open(options['output'], 'w') as file:
+            json.dump(report, file)
+        self.stdout.write('Analyzed %d cards and %d decks. Written to %s.' % (
+            len(report['cards']), len(report['decks']['pks']), options['output']))
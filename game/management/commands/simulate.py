@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from game import engine, simulator
+from game.models import Deck, MonsterCard
+
+
+def card_definition(monster_card):
+    """
+    engine.CardDefinition of a MonsterCard.
+    :param monster_card: MonsterCard
+    :return: engine.CardDefinition
+    """
+    return engine.CardDefinition(pk=monster_card.pk, name=monster_card.name, description=monster_card.description,
+                                 cost=monster_card.cost, picture_url=None, attack=monster_card.attack,
+                                 hp=monster_card.hp, effect=monster_card.effect)
+
+
+class Command(BaseCommand):
+    help = 'Plays headless matches between two decks and writes the win rates to a file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('deck', type=int, help='pk of the first player\'s Deck')
+        parser.add_argument('opponent_deck', type=int, nargs='?',
+                            help='pk of the second player\'s Deck. Defaults to the first player\'s Deck.')
+        parser.add_argument('--card', type=int,
+                            help='pk of a MonsterCard to evaluate. It replaces cards of the first player\'s deck.')
+        parser.add_argument('--copies', type=int, default=1, help='cards of the first deck replaced by --card')
+        parser.add_argument('--games', type=int, default=10000)
+        parser.add_argument('--policies', nargs=2, default=['aggressive', 'aggressive'],
+                            choices=sorted(simulator.POLICIES), metavar='POLICY',
+                            help='policies of the first and second player: %s' % ', '.join(sorted(simulator.POLICIES)))
+        parser.add_argument('--workers', type=int, default=None, help='worker processes, one per CPU by default')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='simulation.json', help='file the results are written to')
+
+    def deck_definitions(self, pk):
+        try:
+            deck = Deck.objects.get(pk=pk)
+        except Deck.DoesNotExist:
+            raise CommandError('Deck %s does not exist' % pk)
+        definitions = [card_definition(monster_card) for monster_card in deck.monster_cards.order_by('pk')]
+        if not definitions:
+            raise CommandError('Deck %s has no monster cards' % pk)
+        return definitions
+
+    def handle(self, *args, **options):
+        deck_1 = self.deck_definitions(options['deck'])
+        deck_2 = self.deck_definitions(options['opponent_deck'] or options['deck'])
+
+        if options['card'] is not None:
+            try:
+                monster_card = MonsterCard.objects.get(pk=options['card'])
+            except MonsterCard.DoesNotExist:
+                raise CommandError('MonsterCard %s does not exist' % options['card'])
+            copies = min(options['copies'], len(deck_1))
+            # The last cards of the deck make room for the card being evaluated
+            deck_1 = deck_1[:len(deck_1) - copies] + [card_definition(monster_card)] * copies
+
+        results = simulator.simulate(deck_1, deck_2, options['games'], policies=options['policies'],
+                                     workers=options['workers'], seed=options['seed'])
+        results['decks'] = [options['deck'], options['opponent_deck'] or options['deck']]
+        results['card'] = options['card']
+        simulator.write_results(results, options['output'])
+
+        self.stdout.write('%d games: first player won %.1f%%, second player won %.1f%%, %d draws. Written to %s.' % (
+            results['games'], results['win_rates'][0] * 100, results['win_rates'][1] * 100, results['draws'],
+            options['output']))
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:46
+
+import random
+
+from django.db import migrations, models
+
+
+def shuffle_existing_decks(apps, schema_editor):
+    """
+    Gives the cards already in decks a place in a shuffled draw pile.
+    """
+    DeckCard = apps.get_model('game', 'DeckCard')
+    shuffler = random.SystemRandom()
+
+    deck_cards = {}  # deck_state_id -> DeckCards
+    for deck_card in DeckCard.objects.filter(position__isnull=True):
+        deck_cards.setdefault(deck_card.deck_state_id, []).append(deck_card)
+    for cards in deck_cards.values():
+        shuffler.shuffle(cards)
+        for position, deck_card in enumerate(cards):
+            deck_card.position = position
+        DeckCard.objects.bulk_update(cards, ['position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0002_gamestate_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deckcard',
+            name='position',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='deckcard',
+            index=models.Index(fields=['deck_state', 'position'], name='game_deckca_deck_st_88f2e3_idx'),
+        ),
+        migrations.RunPython(shuffle_existing_decks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:47
+
+from django.db import migrations, models
+
+
+def fill_occupancy(apps, schema_editor):
+    """
+    Moves cards that share a hand or field position to free positions, and records which positions are occupied.
+    Cards left without a free position are removed.
+    """
+    for zone_model_name, card_model_name, zone_field, size in (('HandState', 'HandCard', 'hand_state_id', 10),
+                                                                ('FieldState', 'FieldCard', 'field_state_id', 7)):
+        zone_model = apps.get_model('game', zone_model_name)
+        card_model = apps.get_model('game', card_model_name)
+
+        cards = {}  # zone pk -> cards in the zone
+        for card in card_model.objects.order_by('pk'):
+            cards.setdefault(getattr(card, zone_field), []).append(card)
+
+        for zone in zone_model.objects.all():
+            occupied = 0
+            duplicates = []
+            for card in cards.get(zone.pk, []):
+                if card.position is not None and 0 <= card.position < size and not occupied >> card.position & 1:
+                    occupied |= 1 << card.position
+                else:
+                    duplicates.append(card)
+            for card in duplicates:
+                free = [position for position in range(size) if not occupied >> position & 1]
+                if free:
+                    card.position = free[0]
+                    card.save(update_fields=['position'])
+                    occupied |= 1 << card.position
+                else:
+                    card.delete()
+            zone.occupied = occupied
+            zone.save(update_fields=['occupied'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0003_deckcard_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fieldstate',
+            name='occupied',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='handstate',
+            name='occupied',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_occupancy, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='fieldcard',
+            constraint=models.UniqueConstraint(fields=('field_state', 'position'), name='unique_field_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='handcard',
+            constraint=models.UniqueConstraint(fields=('hand_state', 'position'), name='unique_hand_position'),
+        ),
+    ]
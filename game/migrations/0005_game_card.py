@@ -0,0 +1,108 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_zone_cards(apps, schema_editor):
+    """
+    Copies the cards of every deck, hand and field into GameCard rows.
+    Cards in no zone, or not referring to a MonsterCardState, are left behind.
+    """
+    GameCard = apps.get_model('game', 'GameCard')
+    MonsterCardState = apps.get_model('game', 'MonsterCardState')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    monster_card_state_type = ContentType.objects.filter(app_label='game', model='monstercardstate').first()
+    if monster_card_state_type is None:
+        return
+    monster_card_states = set(MonsterCardState.objects.values_list('pk', flat=True))
+
+    game_cards = []
+    for zone, card_model_name, zone_state_field in (('deck', 'DeckCard', 'deck_state'),
+                                                    ('hand', 'HandCard', 'hand_state'),
+                                                    ('field', 'FieldCard', 'field_state')):
+        card_model = apps.get_model('game', card_model_name)
+        rows = card_model.objects.filter(**{zone_state_field + '__isnull': False,
+                                            'content_type': monster_card_state_type}).select_related(
+            zone_state_field + '__player_state')
+        for row in rows:
+            if row.object_id not in monster_card_states:
+                continue
+            player_state = getattr(row, zone_state_field).player_state
+            game_card = GameCard(game_id=player_state.game_state_id, owner_id=player_state.pk, zone=zone,
+                                 position=row.position, card_id=row.object_id)
+            if zone == 'field':
+                game_card.attack = row.attack
+                game_card.hp = row.hp
+                game_card.turns_alive = row.turns_alive
+                game_card.attacks_per_turn = row.attacks_per_turn
+                game_card.attacks_left = row.attacks_left
+                game_card.charge = row.charge
+            game_cards.append(game_card)
+    GameCard.objects.bulk_create(game_cards)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('game', '0004_zone_occupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone', models.CharField(choices=[('deck', 'Deck'), ('hand', 'Hand'), ('field', 'Field'), ('graveyard', 'Graveyard')], max_length=9)),
+                ('position', models.IntegerField(null=True)),
+                ('attack', models.IntegerField(null=True)),
+                ('hp', models.IntegerField(null=True)),
+                ('turns_alive', models.IntegerField(default=0)),
+                ('attacks_per_turn', models.IntegerField(default=1)),
+                ('attacks_left', models.IntegerField(null=True)),
+                ('charge', models.BooleanField(default=False)),
+                ('card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instances', to='game.MonsterCardState')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cards', to='game.GameState')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cards', to='game.PlayerState')),
+            ],
+        ),
+        migrations.RunPython(copy_zone_cards, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name='handcard',
+            name='unique_hand_position',
+        ),
+        migrations.RemoveConstraint(
+            model_name='fieldcard',
+            name='unique_field_position',
+        ),
+        migrations.RemoveField(
+            model_name='fieldcard',
+            name='content_type',
+        ),
+        migrations.RemoveField(
+            model_name='fieldcard',
+            name='field_state',
+        ),
+        migrations.RemoveField(
+            model_name='handcard',
+            name='content_type',
+        ),
+        migrations.RemoveField(
+            model_name='handcard',
+            name='hand_state',
+        ),
+        migrations.DeleteModel(
+            name='DeckCard',
+        ),
+        migrations.DeleteModel(
+            name='FieldCard',
+        ),
+        migrations.DeleteModel(
+            name='HandCard',
+        ),
+        migrations.AddConstraint(
+            model_name='gamecard',
+            constraint=models.UniqueConstraint(fields=('owner', 'zone', 'position'), name='unique_zone_position'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_game_card'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameStateSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('state', models.TextField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='game.GameState')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('command', models.CharField(max_length=20)),
+                ('arguments', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='game.GameState')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='gamestatesnapshot',
+            constraint=models.UniqueConstraint(fields=('game', 'version'), name='unique_snapshot_version'),
+        ),
+        migrations.AddConstraint(
+            model_name='gameevent',
+            constraint=models.UniqueConstraint(fields=('game', 'version'), name='unique_event_version'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_command_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monstercard',
+            name='effect',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='monstercardstate',
+            name='effect',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0007_card_effect'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playerstate',
+            name='is_bot',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0008_playerstate_is_bot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('author', models.CharField(max_length=150)),
+                ('message', models.TextField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='game.GameState')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['game', 'id'], name='chat_message_game_id'),
+        ),
+    ]
@@ -1,16 +1,51 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.utils import timezone
+import json
 import random
-from . import exceptions
-from observable import Observable
+from . import exceptions, engine
 from functools import wraps
 from itertools import chain
-from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
-from django.contrib.contenttypes.models import ContentType
 
 
 # Create your models here.
 
+# Times a command is tried before a GameStateConflict is given up on
+COMMAND_ATTEMPTS = 3
+
+# Username of the User a bot plays a room as. Usernames people register with cannot hold a colon (see
+# django.contrib.auth.validators), so no one can sign up as a bot.
+BOT_USERNAME = 'bot:%s'
+
+# A snapshot of a game is written every SNAPSHOT_INTERVAL logged commands
+SNAPSHOT_INTERVAL = 20
+
+# Shuffles decks when a game starts
+deck_shuffler = random.SystemRandom()
+
+
+def bulk_create_with_pks(model, objs, queryset):
+    """
+    Saves objs with one bulk_create and makes sure each of them has its pk afterwards.
+    Backends that cannot return ids from a bulk insert get them read back: the first rows of queryset numbered after
+    the last pk the table had before the insert.
+    :param model: model of objs
+    :param objs: unsaved model instances
+    :param queryset: selects the rows of objs, among older rows such as those of the same game
+    :return: objs
+    """
+    last_pk = None
+    if not connection.features.can_return_ids_from_bulk_insert:
+        last_pk = model.objects.aggregate(last_pk=models.Max('pk'))['last_pk'] or 0
+    model.objects.bulk_create(objs)
+    if last_pk is not None:
+        # Rows inserted by one statement are numbered in insertion order
+        new_pks = queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:len(objs)]
+        for obj, pk in zip(objs, new_pks):
+            obj.pk = pk
+    return objs
+
 
 class Card(models.Model):
     """
@@ -40,6 +75,7 @@ class Card(models.Model):
 class MonsterCard(Card):
     hp = models.IntegerField(default=1)
     attack = models.IntegerField(default=1)
+    effect = models.CharField(max_length=500, blank=True, default='')  # Abilities, see effects
 
 class SpellCard(Card):
     effect = models.CharField(max_length=500)
@@ -122,6 +158,9 @@ class GameState(models.Model):
     winner = models.ForeignKey(to=User, on_delete=models.SET_NULL, default=None, null=True,
                                related_name='winner')
 
+    # Incremented by every command. A command only saves if the version it loaded is still current.
+    version = models.PositiveIntegerField(default=0)
+
     # Helper methods that initialize the game
 
     def create_player_states(self):
@@ -179,6 +218,39 @@ class GameState(models.Model):
         player_1_state.save()
         player_2_state.save()
 
+    def add_bot(self, deck=None):
+        """
+        Registers a computer opponent in a free seat of this GameState.
+        The bot plays as a User of its own, named after the room, that nobody can log in as.
+        :param deck: Deck the bot plays with. By default, the preferred deck of the other player.
+        :return: PlayerState of the bot, or None if no seat is free
+        :raise exceptions.NotAuthorized: if an account someone can log in as has the bot's username
+        """
+        player_states = list(self.playerstate_set.all())
+        free = [player_state for player_state in player_states if player_state.user_id is None]
+        if not free:
+            return None
+        if deck is None:
+            settings = UserSettings.objects.filter(
+                user_id__in=[player_state.user_id for player_state in player_states if player_state.user_id],
+                preferred_deck__isnull=False).first()
+            if settings is None:
+                raise UserSettings.DoesNotExist('No preferred deck for the bot to play with')
+            deck = settings.preferred_deck
+
+        with transaction.atomic():
+            user, created = User.objects.get_or_create(username=BOT_USERNAME % self.room_name,
+                                                       defaults={'password': make_password(None)})
+            if user.has_usable_password():
+                raise exceptions.NotAuthorized('%s is not a bot' % user.username)
+            UserSettings.objects.update_or_create(user=user, defaults={'preferred_deck': deck})
+
+            bot_state = free[0]
+            bot_state.user = user
+            bot_state.is_bot = True
+            bot_state.save()
+        return bot_state
+
     # User commands
 
     def start_game(self):
@@ -186,15 +258,22 @@ class GameState(models.Model):
         A game starts.
         :return:
         """
-        # Check game already started
-        if self.is_started:
-            raise exceptions.GameAlreadyStarted
+        with transaction.atomic():
+            # Lock the game so that two players starting it at once cannot both initialize it
+            locked = GameState.objects.select_for_update().get(pk=self.pk)
 
-        self.turn = 0
-        self.player_moving_state.initialize()
-        self.player_waiting_state.initialize()
-        self.is_started = True
-        self.save()
+            # Check game already started
+            if locked.is_started:
+                raise exceptions.GameAlreadyStarted
+
+            self.turn = 0
+            PlayerState.initialize_all(self.playerstate_set.select_related('user'))
+            self.is_started = True
+            self.version = locked.version + 1
+            self.save()
+
+            # The command log of the game starts from here
+            GameStateSnapshot.take(self.load_engine())
 
     def surrender(self):
         pass
@@ -205,49 +284,7 @@ class GameState(models.Model):
         :param user: User that wants to end turn
         :return:
         """
-        # Reference players
-        player_moving_state = self.player_moving_state
-        player_waiting_state = self.player_waiting_state
-
-        print(player_moving_state.user, player_waiting_state.user, user)
-        # Check authorization
-        if user != player_moving_state.user:
-            raise exceptions.NotAuthorized
-
-        # Check game started
-        if not self.is_started:
-            raise exceptions.GameNotStarted
-
-        # Check game ended
-        if self.is_ended:
-            raise exceptions.GameEnded
-
-        # Players switch moving / waiting
-        player_moving_state.is_moving = False
-        player_waiting_state.is_moving = True
-
-        # Save to db
-        player_moving_state.save()
-        player_waiting_state.save()
-
-        # Increment turn counter
-        self.turn += 1
-
-        # Field card effects trigger
-        player_moving_state.fieldstate.trigger_end_of_turn_effects()
-        player_waiting_state.fieldstate.trigger_end_of_turn_effects()
-
-        # Next player draws a card
-        self.draw_card(player_waiting_state.user)
-
-        # Next player increments max mana and restores mana
-        player_moving_state.max_mana += 1
-        player_moving_state.mana = player_moving_state.max_mana
-
-        # Save to db
-        player_moving_state.save()
-        player_waiting_state.save()
-        self.save()
+        self.run_command('end_turn', user.pk)
 
     # Accessors
     @property
@@ -289,20 +326,14 @@ class GameState(models.Model):
         User wants to draw a card.
         :return:
         """
-        # Check authorization
-        if user != self.player_moving_state.user:
-            raise exceptions.NotAuthorized
-
-        # Check game started
-        if not self.is_started:
-            raise exceptions.GameNotStarted
-
-        # Check game ended
-        if self.is_ended:
-            raise exceptions.GameEnded
+        self.run_command('draw_card', user.pk)
 
-        # Remove a random card from moving player's deck and put it in their hand
-        self.player_moving_state.draw_card()
+    def draw_cards(self, user, num):
+        """
+        User wants to draw num cards, such as for an opening hand or a card-draw effect.
+        :return:
+        """
+        self.run_command('draw_cards', user.pk, num)
 
     def summon(self, user, hand_card_position, field_card_position):
         """
@@ -310,45 +341,7 @@ class GameState(models.Model):
         Hand position and field position is the information necessary to service this command.
         :return:
         """
-        # Reference player
-        player_moving_state = self.player_moving_state
-
-        # Check authorization
-        if user != player_moving_state.user:
-            print(user, player_moving_state.user)
-            raise exceptions.NotAuthorized
-
-        # Check game started
-        if not self.is_started:
-            raise exceptions.GameNotStarted
-
-        # Check game ended
-        if self.is_ended:
-            raise exceptions.GameEnded
-
-        # Reference candidate hand positions
-        hand_card = player_moving_state.handstate.handcard_set.get(position=hand_card_position)
-        # The hand card must be a monster card
-        monster_card = MonsterCardState.objects.get(pk=hand_card.card.pk)
-
-        # If a field card already occupies position, then it is already occupied
-        field_cards = player_moving_state.fieldstate.fieldcard_set.filter(position=field_card_position)
-        if field_cards.count() is not 0:
-            raise exceptions.FieldPositionOccupied
-
-        # Check if enough mana
-        cost = hand_card.card.cost
-        if cost > player_moving_state.mana:
-            raise exceptions.ManaInsuffcient
-
-        # Add field card, remove hand card, and remove the cost in mana
-        player_moving_state.fieldstate.add_card(monster_card=monster_card, position=field_card_position)
-        player_moving_state.handstate.remove_card(hand_card)
-
-        player_moving_state.mana -= cost
-        player_moving_state.save()
-
-        self.save()
+        self.run_command('summon', user.pk, hand_card_position, field_card_position)
 
     def cast(self, user):
         pass
@@ -361,97 +354,22 @@ class GameState(models.Model):
         :param defending_field_card_position:
         :return:
         """
-        player_moving_state = self.player_moving_state
-        player_waiting_state = self.player_waiting_state
-
-        # Check authorization
-        if user != player_moving_state.user:
-            raise exceptions.NotAuthorized
-
-        # Check game started
-        if not self.is_started:
-            raise exceptions.GameNotStarted
-
-        # Check game ended
-        if self.is_ended:
-            raise exceptions.GameEnded
-
-        # Reference attacking and defending field cards
-        attacker = player_moving_state.fieldstate.fieldcard_set.get(position=attacking_field_card_position)
-        defender = player_waiting_state.fieldstate.fieldcard_set.get(position=defending_field_card_position)
-
-        # Check immediate attack
-        if attacker.turns_alive is 0 and not attacker.charge:
-            raise exceptions.AttackOnTurnSummonedWithoutCharge
-
-        # Check attacks left
-        if attacker.attacks_left <= 0:
-            raise exceptions.AttacksNoneLeft
-
-        # Perform combat
-        attacker.hp -= defender.attack
-        defender.hp -= attacker.attack
-        attacker.attacks_left -= 1
-
-        attacker.save()
-        defender.save()
-
-        # If a field card has 0 or less hp, it is removed from the field
-        if attacker.hp <= 0:
-            player_moving_state.fieldstate.remove_card(attacker)
-        if defender.hp <= 0:
-            player_waiting_state.fieldstate.remove_card(defender)
+        self.run_command('attack', user.pk, attacking_field_card_position, defending_field_card_position)
 
     def attack_player(self, user, attacking_field_card_position, defending_player_name):
-        player_moving_state = self.player_moving_state
-        player_waiting_state = self.player_waiting_state
-
-        # Check authorization
-        if user != player_moving_state.user:
-            raise exceptions.NotAuthorized
-
-        # Check game started
-        if not self.is_started:
-            raise exceptions.GameNotStarted
-
-        # Check game ended
-        if self.is_ended:
-            raise exceptions.GameEnded
-
-        # Reference attacking field card and defending player
-        attacker = player_moving_state.fieldstate.fieldcard_set.get(position=attacking_field_card_position)
-        defender = player_waiting_state
-
-        # Check defending player is valid
-        if defender.user.username != defending_player_name:
-            raise exceptions.AttackInvalidPlayer
-
-        # Check immediate attack
-        if attacker.turns_alive is 0 and not attacker.charge:
-            raise exceptions.AttackOnTurnSummonedWithoutCharge
-
-        # Check attacks left
-        if attacker.attacks_left <= 0:
-            raise exceptions.AttacksNoneLeft
-
-        # Calculate combat
-        attacker.attacks_left -= 1
-        defender.hp -= attacker.attack
-
-        # If player has 0 or less hp, then game is over, and is won by attacking player
-        if defender.hp <= 0:
-            self.is_ended = True
-            self.winner = player_moving_state.user
-
-        attacker.save()
-        defender.save()
-        self.save()
+        """
+        User wants a monster under his control to attack his opponent.
+        :param user:
+        :param attacking_field_card_position:
+        :param defending_player_name:
+        :return:
+        """
+        self.run_command('attack_player', user.pk, attacking_field_card_position, defending_player_name)
 
     def delete_game(self):
         """
         Removes the entire game from the database.
-        Deletes the GameState and its children PlayerState, DeckState, HandState, FieldState, DeckCard, HandCard,
-        FieldCard objects
+        Deletes the GameState and its children PlayerState, DeckState, HandState, FieldState, GameCard objects
         :return:
         """
 
@@ -467,6 +385,270 @@ class GameState(models.Model):
         # Delete game
         self.delete()
 
+    # In-memory engine
+
+    def load_engine(self):
+        """
+        Loads this game's tree into an engine.Game in a fixed number of queries.
+        The occupancy of each hand and field is checked against the cards in it; recover rewrites both.
+        :return: engine.Game
+        """
+        self.refresh_from_db()
+        player_states = self.playerstate_set.select_related('user').order_by('-is_first')
+        if self.is_started:
+            player_states = player_states.select_related('deckstate', 'handstate', 'fieldstate')
+
+        players = []
+        players_by_pk = {}
+        occupancy = {}  # PlayerState pk -> occupancy of the hand and field, as saved
+        for player_state in player_states:
+            user = player_state.user
+            player = engine.Player(pk=player_state.pk, user_id=player_state.user_id,
+                                   username=user.username if user else None, is_moving=player_state.is_moving,
+                                   is_first=player_state.is_first, hp=player_state.hp, mana=player_state.mana,
+                                   max_mana=player_state.max_mana, is_bot=player_state.is_bot)
+            if self.is_started:
+                player.zone_pks = {
+                    engine.DECK: player_state.deckstate.pk,
+                    engine.HAND: player_state.handstate.pk,
+                    engine.FIELD: player_state.fieldstate.pk,
+                }
+                occupancy[player.pk] = (player_state.handstate.occupied, player_state.fieldstate.occupied)
+            players.append(player)
+            players_by_pk[player.pk] = player
+
+        if self.is_started:
+            definitions = {}  # MonsterCardState pk -> engine.CardDefinition
+
+            # Every card of the game, whatever its zone, in one query
+            for game_card in self.cards.select_related('card').order_by('zone', 'position'):
+                monster_card_state = game_card.card
+                definition = definitions.get(monster_card_state.pk)
+                if definition is None:
+                    definition = engine.CardDefinition(
+                        pk=monster_card_state.pk, name=monster_card_state.name,
+                        description=monster_card_state.description, cost=monster_card_state.cost,
+                        picture_url=monster_card_state.picture_url, attack=monster_card_state.attack,
+                        hp=monster_card_state.hp, effect=monster_card_state.effect)
+                    definitions[monster_card_state.pk] = definition
+
+                player = players_by_pk[game_card.owner_id]
+                card = engine.CardInstance(
+                    definition, player, game_card.zone, position=game_card.position, attack=game_card.attack,
+                    hp=game_card.hp, turns_alive=game_card.turns_alive, attacks_per_turn=game_card.attacks_per_turn,
+                    attacks_left=game_card.attacks_left, charge=game_card.charge, row_pk=game_card.pk)
+                player.add(card)
+
+            for player in players:
+                if (player.hand_occupied, player.field_occupied) != occupancy[player.pk]:
+                    raise exceptions.OccupancyMismatch(player.pk)
+
+        return engine.Game(pk=self.pk, room_name=self.room_name, turn=self.turn, is_started=self.is_started,
+                           is_ended=self.is_ended, winner_id=self.winner_id, players=players, version=self.version)
+
+    def load_snapshot(self):
+        """
+        Loads a read-only snapshot of this game, both players and the cards in their decks, hands and fields.
+        Takes the same fixed number of queries as load_engine, however many cards are in play.
+        :return: engine.GameSnapshot
+        """
+        return self.load_engine().snapshot()
+
+    def run_command(self, command, *args):
+        """
+        Applies an engine.Game command to this game and saves the result.
+        If another command saved first, the game is reloaded and the command is tried again, up to
+        COMMAND_ATTEMPTS times.
+        :param command: name of the engine.Game method, such as 'summon'
+        :param args: arguments of the engine.Game method
+        :return: engine.Game after the command
+        """
+        try:
+            game, error = self.run_commands([(command, args)])
+        except exceptions.CommandFailed as failure:
+            raise failure.error from None
+        return game
+
+    def run_commands(self, commands, atomic=True, game=None):
+        """
+        Applies engine.Game commands to this game in order, and saves the result in one transaction.
+        If another command saved first, the game is reloaded and the commands are tried again, up to
+        COMMAND_ATTEMPTS times.
+        :param commands: list of (command, args)
+        :param atomic: if True, a command failing fails them all and nothing is saved. If False, the commands before
+            the one that failed are saved.
+        :param game: engine.Game of this game kept in memory, applied to rather than a fresh load. It is only saved if
+            it is current, and cannot be used again if an exception is raised.
+        :return: (engine.Game after the commands, exceptions.CommandFailed of the command that failed or None)
+        :raise exceptions.CommandFailed: if atomic and a command failed
+        """
+        commands = list(commands)
+        error = None
+        attempt = 0
+        while True:
+            if game is None:
+                game = self.load_engine()
+            applied = 0
+            try:
+                for command, args in commands:
+                    game.apply(command, args)
+                    applied += 1
+            except Exception as failure:
+                if atomic:
+                    raise exceptions.CommandFailed(applied, failure) from failure
+                # The failed command may have changed the game before failing, so the commands before it are applied
+                # again to a fresh load
+                commands, error = commands[:applied], exceptions.CommandFailed(applied, failure)
+                game = None
+                continue
+
+            if not commands:
+                return game, error
+            try:
+                self.save_engine(game, commands)
+            except exceptions.GameStateConflict:
+                attempt += 1
+                if attempt == COMMAND_ATTEMPTS:
+                    raise
+                game = None
+            else:
+                return game, error
+
+    def save_engine(self, game, commands=()):
+        """
+        Writes everything commands changed in an engine.Game back to the database in one transaction.
+        The commands are appended to the game's command log, each with a version of its own, and every
+        SNAPSHOT_INTERVAL versions a snapshot is taken.
+        :param game: engine.Game loaded from this GameState
+        :param commands: list of (command, args) that were applied, if they are to be logged
+        :return:
+        """
+        # Players whose hand or field occupancy changed
+        changed_zones = {engine.HAND: set(), engine.FIELD: set()}
+        for card in game.touched_cards:
+            if card.zone != card.row_zone:
+                changed_zones.get(card.row_zone, set()).add(card.owner)
+                changed_zones.get(card.zone, set()).add(card.owner)
+
+        # Cards leaving a hand or field position that another card takes in the same save, as when a batch summons
+        # a card and then draws into the hand position it left. Rows are written one by one and positions must stay
+        # unique all along, so these positions are cleared first.
+        taken = {(card.owner.pk, card.zone, card.position) for card in game.touched_cards
+                 if card.zone in (engine.HAND, engine.FIELD)}
+        vacating = [card.row_pk for card in game.touched_cards
+                    if card.row_pk is not None and (card.row_zone, card.row_position) != (card.zone, card.position)
+                    and (card.owner.pk, card.row_zone, card.row_position) in taken]
+
+        game_cards = [GameCard.from_instance(card) for card in game.touched_cards]
+
+        with transaction.atomic():
+            # Compare-and-swap on the version, so a command loaded from a stale state writes nothing
+            versions = len(commands) or 1
+            updated = GameState.objects.filter(pk=self.pk, version=game.version).update(
+                version=models.F('version') + versions, turn=game.turn, is_ended=game.is_ended,
+                winner=game.winner_id)
+            if not updated:
+                raise exceptions.GameStateConflict
+
+            # Upkeep of whole fields, one set-based update per field. This comes before the rows below are written,
+            # since their values already include the upkeep.
+            for player, times in game.upkeeps.items():
+                GameCard.objects.filter(owner_id=player.pk, zone=engine.FIELD).update(
+                    **FieldState.upkeep_updates(times))
+
+            if vacating:
+                GameCard.objects.filter(pk__in=vacating).update(position=None)
+            self._write_rows(game_cards, changed_zones[engine.HAND], changed_zones[engine.FIELD],
+                             game.touched_players)
+
+            version = game.version + versions
+            if commands:
+                GameEvent.objects.bulk_create([
+                    GameEvent(game_id=self.pk, version=game.version + number, command=command,
+                              arguments=json.dumps(list(args)))
+                    for number, (command, args) in enumerate(commands, 1)])
+                # Only the state after the last command is known, so it stands for any multiple of the interval
+                # the commands went past
+                if version // SNAPSHOT_INTERVAL > game.version // SNAPSHOT_INTERVAL:
+                    GameStateSnapshot.take(game, version=version)
+
+        self.turn = game.turn
+        self.is_ended = game.is_ended
+        self.winner_id = game.winner_id
+        self.version = game.version = version
+        for card in game.touched_cards:
+            card.row_zone = card.zone
+            card.row_position = card.position
+        game.clear_touched()
+
+    @staticmethod
+    def _write_rows(game_cards, hand_players, field_players, players):
+        """
+        Writes GameCards, the occupancy of hands and fields, and players, with one bulk update each.
+        :param game_cards: GameCards
+        :param hand_players: engine.Player whose hand occupancy is written
+        :param field_players: engine.Player whose field occupancy is written
+        :param players: engine.Player whose stats are written
+        :return:
+        """
+        # Moving a card between zones is an update of its row like any other change.
+        # Cards leaving play are written first, so the positions they free can be taken by the other cards.
+        leaving = [game_card for game_card in game_cards if game_card.zone == engine.GRAVEYARD]
+        staying = [game_card for game_card in game_cards if game_card.zone != engine.GRAVEYARD]
+        for rows in (leaving, staying):
+            if rows:
+                GameCard.objects.bulk_update(rows, ['zone', 'position', 'attack', 'hp', 'turns_alive',
+                                                    'attacks_per_turn', 'attacks_left', 'charge'])
+
+        if hand_players:
+            HandState.objects.bulk_update(
+                [HandState(pk=player.zone_pks[engine.HAND], occupied=player.hand_occupied)
+                 for player in hand_players], ['occupied'])
+        if field_players:
+            FieldState.objects.bulk_update(
+                [FieldState(pk=player.zone_pks[engine.FIELD], occupied=player.field_occupied)
+                 for player in field_players], ['occupied'])
+
+        if players:
+            PlayerState.objects.bulk_update(
+                [PlayerState(pk=player.pk, is_moving=player.is_moving, hp=player.hp, mana=player.mana,
+                             max_mana=player.max_mana) for player in players],
+                ['is_moving', 'hp', 'mana', 'max_mana'])
+
+    # Command log
+
+    def rebuild_engine(self):
+        """
+        Rebuilds this game from its latest snapshot and the logged commands after it, without reading the game's
+        cards or players.
+        :return: engine.Game
+        """
+        snapshot = self.snapshots.latest('version')
+        game = snapshot.load()
+        for event in self.events.filter(version__gt=snapshot.version).order_by('version'):
+            game.apply(event.command, json.loads(event.arguments))
+            game.version = event.version
+        game.clear_touched()
+        return game
+
+    def recover(self):
+        """
+        Overwrites this game's rows with the game rebuilt from the command log.
+        The rows left behind may hold any positions, so all positions are cleared before the rows are written.
+        :return: engine.Game
+        """
+        game = self.rebuild_engine()
+        cards = [card for player in game.players
+                 for card in chain(player.deck, player.hand.values(), player.field.values(), player.graveyard)]
+        with transaction.atomic():
+            GameState.objects.filter(pk=self.pk).update(version=game.version, turn=game.turn, is_ended=game.is_ended,
+                                                        winner=game.winner_id)
+            GameCard.objects.filter(game=self).exclude(zone=engine.GRAVEYARD).update(position=None)
+            self._write_rows([GameCard.from_instance(card) for card in cards], game.players, game.players,
+                             game.players)
+        self.refresh_from_db()
+        return game
+
 
 class PlayerState(models.Model):
     """
@@ -481,6 +663,8 @@ class PlayerState(models.Model):
     is_moving = models.BooleanField()
     # player goes first or second
     is_first = models.BooleanField()
+    # Played by the computer, see bot
+    is_bot = models.BooleanField(default=False)
 
     hp = models.IntegerField(null=True)
     mana = models.IntegerField(null=True)
@@ -495,28 +679,55 @@ class PlayerState(models.Model):
         Define the starting values of a PlayerState.
         User must be registered first.
         """
-        self.hp = 30
-        self.mana = 1
-        self.max_mana = 1
+        PlayerState.initialize_all([self])
 
-        # Save DeckInstance into database, and have PlayerState reference it
-        preferred_deck = UserSettings.objects.get(user=self.user).preferred_deck  # this user's preferred deck
+    @classmethod
+    def initialize_all(cls, player_states):
+        """
+        Define the starting values of PlayerStates, and create their decks, hands and fields.
+        Users must be registered first.
+        Takes the same handful of queries however many cards are in the decks.
+        :param player_states: PlayerStates of one game
+        :return:
+        """
+        player_states = list(player_states)
 
-        DeckState.create(player_state=self, deck=preferred_deck)
-        HandState.objects.create(player_state=self)
-        FieldState.objects.create(player_state=self)
+        # Every user's preferred deck and its monster cards, in one pass
+        user_settings = UserSettings.objects.filter(user__in=[player_state.user_id for player_state in player_states])
+        preferred_decks = {settings.user_id: settings.preferred_deck for settings in
+                           user_settings.select_related('preferred_deck').prefetch_related(
+                               'preferred_deck__monster_cards')}
 
-        self.save()
+        for player_state in player_states:
+            if player_state.user_id not in preferred_decks:
+                raise UserSettings.DoesNotExist
+            player_state.hp = 30
+            player_state.mana = 1
+            player_state.max_mana = 1
+
+        # Save DeckInstances into database, and have PlayerStates reference them
+        DeckState.create_all([(player_state, preferred_decks[player_state.user_id])
+                              for player_state in player_states])
+        HandState.objects.bulk_create([HandState(player_state=player_state) for player_state in player_states])
+        FieldState.objects.bulk_create([FieldState(player_state=player_state) for player_state in player_states])
+
+        cls.objects.bulk_update(player_states, ['hp', 'mana', 'max_mana'])
 
     def draw_card(self):
         """
-        A random card is removed from the player's deck and added to the players's hand.
+        The top card is removed from the player's deck and added to the players's hand.
         :return:
         """
-        card = self.deckstate.remove_random_card()
-        self.handstate.add_card(card)
-        print('Finished drawing card')
-        self.save()
+        self.draw_cards(1)
+
+    def draw_cards(self, num):
+        """
+        The top num cards are moved from the player's deck to the player's hand.
+        This is a command of the game like any other, so it is versioned and logged.
+        :param num:
+        :return:
+        """
+        self.game_state.run_command('draw_cards', self.user_id, num)
 
     # def lose_hp(self, amount):
     #     """
@@ -528,9 +739,6 @@ class PlayerState(models.Model):
     #     self.save()
 
 
-# TODO: Make field, deck and hand cards depend on MonsterCardState instead of MonsterCard
-
-
 class DeckState(models.Model):
     """
     The current state of a User's deck in a game.
@@ -543,147 +751,86 @@ class DeckState(models.Model):
         """
         Create a DeckState.
         Create MonsterCardState for each MonsterCard needed.
-        Create DeckCard for each MonsterCardState.
-        Associate DeckCard with corresponding MonsterCardState.
-        """
-        # Create DeckState
-        deck_state = cls(player_state=player_state)  # User defined parameters for the creation of a deck instance
-        deck_state.save()
-        # TODO: For now, each card has count=1
-
-        # Using MonsterCard, create MonsterCardState. Using MonsterCardState create DeckCard
-        for monster_card in deck.monster_cards.all():
-            # Create MonsterCardState, a game specific card based on user created card
-            monster_card_state = MonsterCardState.create_from_card(card=monster_card, game=player_state.game_state)
-            # Create DeckCard, associate it with MonsterCardState, and add it to DeckState
-            deck_card = DeckCard.objects.create(content_object=monster_card_state, count=1, deck_state=deck_state)
-            # deck_state.deckcard_set.add(deck_card)  # No need to call save after adding
-            deck_card.save()
+        Create a GameCard in the deck for each MonsterCardState.
+        """
+        return cls.create_all([(player_state, deck)])[0]
+
+    @classmethod
+    def create_all(cls, player_decks, rng=None):
+        """
+        Create the DeckStates of the players of one game, with one bulk insert per table.
+        Each deck is shuffled once, here, into the order it will be drawn in.
+        :param player_decks: list of (PlayerState, Deck)
+        :param rng: random.Random used to shuffle the decks
+        :return: list of DeckState, in the order of player_decks
+        """
+        rng = rng or deck_shuffler
+
+        # Create DeckStates
+        deck_states = [cls(player_state=player_state) for player_state, deck in player_decks]
+        cls.objects.bulk_create(deck_states)
+
+        # Using MonsterCard, create MonsterCardState, a game specific card based on user created card
+        monster_card_states = []
+        owners = []
+        for player_state, deck in player_decks:
+            monster_cards = list(deck.monster_cards.all())
+            rng.shuffle(monster_cards)
+            for monster_card in monster_cards:
+                monster_card_states.append(MonsterCardState.build_from_card(card=monster_card,
+                                                                            game_id=player_state.game_state_id))
+                owners.append(player_state)
+        game_states = {player_state.game_state_id for player_state, deck in player_decks}
+        bulk_create_with_pks(MonsterCardState, monster_card_states,
+                             MonsterCardState.objects.filter(game__in=game_states))
+
+        # Using MonsterCardState create a GameCard in the deck, in shuffled order
+        game_cards = []
+        positions = {}  # PlayerState pk -> position of the next card in their deck
+        for monster_card_state, owner in zip(monster_card_states, owners):
+            position = positions.get(owner.pk, 0)
+            positions[owner.pk] = position + 1
+            game_cards.append(GameCard(game_id=owner.game_state_id, owner=owner, zone=engine.DECK,
+                                       position=position, card=monster_card_state))
+        GameCard.objects.bulk_create(game_cards)
 
         # for spell_card in deck.spell_cards.all():
         #     spell_card_state = SpellCardState.objects.create(game=player_state.game_state, deck_card=spell_card)
-        #     deck_card = DeckCard.objects.create(card=spell_card_state, count=1)
-        #     deck_state.deckcard_set.add(deck_card)
 
-        # deck_state.save()
-        return deck_state
+        return deck_states
 
-    def remove_random_card(self):
+    @property
+    def cards(self):
         """
-        Remove a random card from the deck
-        :return: Card that was removed
+        GameCards in this deck.
+        :return: QuerySet
         """
-        print('DeckState.remove_random_card()')
-        # Check if empty
-        num_cards = self.deckcard_set.count()
-        if num_cards is 0:
-            raise exceptions.DeckEmpty
-
-        # Select a random card from deck
-        # TODO: Not random since we're considering
-        deck_card_index = random.randint(0, num_cards - 1)
-        deck_card = self.deckcard_set.all()[deck_card_index]
-        # Remove one card from deck and return card
-        # TODO: Always removing the deck card works when each DeckCard has count=1
-        card = deck_card.card
-        deck_card.delete()
-        return card
+        return GameCard.objects.filter(owner_id=self.player_state_id, zone=engine.DECK)
 
-        # TODO: Make deck_card.card refer to MonsterCardState or SpellCardState
 
 
-class DeckCard(models.Model):
-    """
-    Represents the state of a card in a player's deck.
-    """
-    deck_state = models.ForeignKey(to=DeckState, on_delete=models.CASCADE, null=True)
-    count = models.IntegerField()  # Number of copies
-
-    # Generic relation to cards
-    content_type = models.ForeignKey(ContentType, models.SET_NULL, blank=True, null=True)
-    object_id = models.PositiveIntegerField(blank=True, null=True)
-    content_object = GenericForeignKey('content_type', 'object_id')
-    # Older
-    # card = models.ForeignKey(Card, models.SET_NULL, null=True)
-
-    @property
-    def card(self):
-        return self.content_object
-
 class HandState(models.Model):
     """
     The current state of a player's hand in a game.
     """
     player_state = models.OneToOneField(to=PlayerState, on_delete=models.CASCADE)
+    # Bitmask of occupied positions, bit i set when a hand card is in position i
+    occupied = models.PositiveSmallIntegerField(default=0)
 
-    def add_card(self, card):
-        """
-        Adds a card to this hand.
-        :param card: MonsterCardState or SpellCardState
-        :return:
-        """
-        print('HandState.add_card()')
-
-        # TODO: Make compatible with spell
-        # Check card type
-        if not isinstance(card, MonsterCardState):
-            raise exceptions.InvalidCard
-        # Check if too many cards to add another card
-        if self.handcard_set.count() >= 10:
-            raise exceptions.HandFull
-        # Check if position is available
-        position = self.get_next_position()
-        if position is None:
-            raise exceptions.HandPositionOccupied
-
-        # Create hand card
-        hand_card = HandCard.objects.create(content_object=card, position=position, hand_state=self)
-        # self.handcard_set.add(hand_card)  # Associate hand card with
-
-        self.save()
-
-    def remove_card(self, hand_card):
+    @property
+    def cards(self):
         """
-        Removes a card from this hand.
-        :param hand_card:
-        :return:
+        GameCards in this hand.
+        :return: QuerySet
         """
-        hand_card.delete()
-        # self.handcard_set.remove(hand_card)
+        return GameCard.objects.filter(owner_id=self.player_state_id, zone=engine.HAND)
 
     def get_next_position(self):
         """
         Returns the next position available in the hand not occupied by another hand card.
         :return:
         """
-        position = 0
-        while position in map(lambda x: x.position, self.handcard_set.all()):
-            position += 1
-        if position >= 10:
-            position = None
-        return position
-
-        # max_position_hand_card = self.handcard_set.all().aggregate(models.Max('position'))
-        # return max_position_hand_card.position + 1
-
-
-class HandCard(models.Model):
-    """
-    Represents the state of a card in a player's hand.
-    """
-    hand_state = models.ForeignKey(to=HandState, on_delete=models.CASCADE, null=True)
-    position = models.IntegerField()
-
-    # Generic relation to cards
-    content_type = models.ForeignKey(ContentType, models.SET_NULL, blank=True, null=True)
-    object_id = models.PositiveIntegerField(blank=True, null=True)
-    content_object = GenericForeignKey('content_type', 'object_id')
-    # Older
-    # card = models.ForeignKey(Card, models.SET_NULL, null=True)
-
-    @property
-    def card(self):
-        return self.content_object
+        return engine.lowest_free_position(self.occupied, engine.HAND_SIZE)
 
 
 class FieldState(models.Model):
@@ -691,75 +838,35 @@ class FieldState(models.Model):
     The current state of a player's field in a game.
     """
     player_state = models.OneToOneField(to=PlayerState, on_delete=models.CASCADE)
+    # Bitmask of occupied positions, bit i set when a field card is in position i
+    occupied = models.PositiveSmallIntegerField(default=0)
 
-    def add_card(self, monster_card, position):
-        """
-        Adds a card to this field.
-        :return:
-        """
-        if not isinstance(monster_card, MonsterCardState):
-            raise exceptions.InvalidCard
-        # Check if too many cards to add another card
-        if self.fieldcard_set.count() >= 7:
-            raise exceptions.FieldFull
-        # Check if candidate position is occupied by another field card
-        if position in map(lambda x: x.position, self.fieldcard_set.all()):
-            raise exceptions.FieldPositionOccupied
-
-        # Reference the card this monster card is based on
-        # card = MonsterCardState.objects.get(pk=monster_card.pk)
-
-        field_card = FieldCard.objects.create(field_state=self, content_object=monster_card, position=position,
-                                              attack=monster_card.attack, hp=monster_card.hp, turns_alive=0,
-                                              attacks_per_turn=1, attacks_left=1)
-        # Add field card to the field
-        # self.fieldcard_set.add(field_card)
-        self.save()
-
-    def remove_card(self, field_card):
+    @property
+    def cards(self):
         """
-        Removes a card from this field.
-        :param position:
-        :return:
+        GameCards in this field.
+        :return: QuerySet
         """
-        # Reference card to be removed
-        # field_card = self.field_cards.filter(position=position)
-        field_card.delete()
+        return GameCard.objects.filter(owner_id=self.player_state_id, zone=engine.FIELD)
 
-    def trigger_end_of_turn_effects(self):
+    @staticmethod
+    def upkeep_updates(times=1):
         """
-        Field card values change from the end of a player's turn.
-        :return:
+        Turns the upkeep steps in engine.UPKEEP into F-expression updates for GameCard rows.
+        Steps run in order, so a step reading a column that an earlier step changed sees the changed value.
+        :param times: number of upkeep phases to apply
+        :return: dict of column -> expression, for QuerySet.update
         """
-        for field_card in self.fieldcard_set.all():
-            field_card.turns_alive += 1
-            field_card.attacks_left = field_card.attacks_per_turn
-            field_card.save()
-
-
-class FieldCard(models.Model):
-    """
-    Represents the state of a card in a player's field.
-    """
-    field_state = models.ForeignKey(to=FieldState, on_delete=models.CASCADE, null=True)
-    position = models.IntegerField(null=True)
-    attack = models.IntegerField()
-    hp = models.IntegerField()
-    turns_alive = models.IntegerField(default=0)
-    attacks_per_turn = models.IntegerField(default=1)
-    attacks_left = models.IntegerField(null=True)
-    charge = models.BooleanField(default=False)
-
-    # Generic relation to cards
-    content_type = models.ForeignKey(ContentType, models.SET_NULL, blank=True, null=True)
-    object_id = models.PositiveIntegerField(blank=True, null=True)
-    content_object = GenericForeignKey('content_type', 'object_id')
-    # Older
-    # card = models.ForeignKey(Card, models.SET_NULL, null=True)
-
-    @property
-    def card(self):
-        return self.content_object
+        expressions = {}
+        for _ in range(times):
+            for column, operation, operand in engine.UPKEEP:
+                if operation == engine.ADD:
+                    expressions[column] = expressions.get(column, models.F(column)) + operand
+                elif operation == engine.COPY:
+                    expressions[column] = expressions.get(operand, models.F(operand))
+                else:
+                    expressions[column] = models.Value(operand)
+        return expressions
 
 
 class MonsterCardState(models.Model):
@@ -773,14 +880,10 @@ class MonsterCardState(models.Model):
     picture = models.ImageField(upload_to='card_pictures/', null=True)  # User may omit picture
     hp = models.IntegerField(default=1)
     attack = models.IntegerField(default=1)
+    effect = models.CharField(max_length=500, blank=True, default='')
 
     game = models.ForeignKey(GameState, models.CASCADE)
 
-    # Can be generically related to by
-    deck_cards = GenericRelation(DeckCard)
-    hand_cards = GenericRelation(HandCard)
-    field_cards = GenericRelation(FieldCard)
-
     @classmethod
     def create_from_card(cls, card, game):
         """
@@ -790,11 +893,21 @@ class MonsterCardState(models.Model):
         :param game: GameState
         :return:
         """
-        monster_card_state = cls(creator=card.creator, name=card.name, description=card.description, cost=card.cost,
-                                 picture=card.picture, hp=card.hp, attack=card.attack, game=game)
+        monster_card_state = cls.build_from_card(card, game.pk)
         monster_card_state.save()
         return monster_card_state
 
+    @classmethod
+    def build_from_card(cls, card, game_id):
+        """
+        Like create_from_card, but does not save, so that many can be saved with one bulk_create.
+        :param card: MonsterCard
+        :param game_id: pk of GameState
+        :return:
+        """
+        return cls(creator_id=card.creator_id, name=card.name, description=card.description, cost=card.cost,
+                   picture=card.picture, hp=card.hp, attack=card.attack, effect=card.effect, game_id=game_id)
+
     @property
     def picture_url(self):
         if self.picture and hasattr(self.picture, 'url'):
@@ -805,10 +918,127 @@ class MonsterCardState(models.Model):
 #     A copy of a SpellCard specific to a Game
 #     """
 #     game = models.ForeignKey(GameState, models.CASCADE)
-#     # Can be generically related to by
-#     deck_card = GenericRelation(DeckCard)
-#     hand_card = GenericRelation(HandCard)
-#     field_card = GenericRelation(FieldCard)
+
+
+class GameCard(models.Model):
+    """
+    A card in a game: in its owner's deck, hand, field or graveyard.
+    A card moving between zones is an update of its zone and position.
+    """
+    ZONE_CHOICES = [
+        (engine.DECK, 'Deck'),
+        (engine.HAND, 'Hand'),
+        (engine.FIELD, 'Field'),
+        (engine.GRAVEYARD, 'Graveyard'),
+    ]
+
+    game = models.ForeignKey(to=GameState, on_delete=models.CASCADE, related_name='cards')
+    owner = models.ForeignKey(to=PlayerState, on_delete=models.CASCADE, related_name='cards')
+    zone = models.CharField(max_length=9, choices=ZONE_CHOICES)
+    # Place in the zone. In the deck, the highest position is drawn first. Graveyard cards have no position.
+    position = models.IntegerField(null=True)
+
+    # Game copy of the card this is an instance of
+    card = models.ForeignKey(to=MonsterCardState, on_delete=models.CASCADE, related_name='instances')
+
+    # Values that change during play, set when the card enters the field
+    attack = models.IntegerField(null=True)
+    hp = models.IntegerField(null=True)
+    turns_alive = models.IntegerField(default=0)
+    attacks_per_turn = models.IntegerField(default=1)
+    attacks_left = models.IntegerField(null=True)
+    charge = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'zone', 'position'], name='unique_zone_position'),
+        ]
+
+    @classmethod
+    def from_instance(cls, card):
+        """
+        Unsaved GameCard with the pk and values of an engine.CardInstance, for bulk updates.
+        :param card: engine.CardInstance
+        :return: GameCard
+        """
+        return cls(pk=card.row_pk, zone=card.zone, position=card.position, attack=card.attack, hp=card.hp,
+                   turns_alive=card.turns_alive, attacks_per_turn=card.attacks_per_turn,
+                   attacks_left=card.attacks_left, charge=card.charge)
+
+
+class GameEvent(models.Model):
+    """
+    A command accepted by a game, in the game's append-only command log.
+    """
+    game = models.ForeignKey(to=GameState, on_delete=models.CASCADE, related_name='events')
+    # GameState.version the command brought the game to
+    version = models.PositiveIntegerField()
+    command = models.CharField(max_length=20)  # engine.COMMANDS
+    arguments = models.TextField()  # JSON list
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'version'], name='unique_event_version'),
+        ]
+
+
+class GameStateSnapshot(models.Model):
+    """
+    The whole state of a game at one version, written when the game starts and every SNAPSHOT_INTERVAL commands.
+    A game is rebuilt from its latest snapshot and the GameEvents after it.
+    """
+    game = models.ForeignKey(to=GameState, on_delete=models.CASCADE, related_name='snapshots')
+    version = models.PositiveIntegerField()
+    state = models.TextField()  # JSON, see engine.dump_game
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'version'], name='unique_snapshot_version'),
+        ]
+
+    @classmethod
+    def take(cls, game, version=None):
+        """
+        Writes a snapshot of an engine.Game.
+        :param game: engine.Game
+        :param version: version the snapshot is of, if not the version game was loaded at
+        :return: GameStateSnapshot
+        """
+        state = engine.dump_game(game)
+        if version is not None:
+            state['version'] = version
+        return cls.objects.create(game_id=game.pk, version=state['version'],
+                                  state=json.dumps(state, separators=(',', ':')))
+
+    def load(self):
+        """
+        The engine.Game this is a snapshot of.
+        :return: engine.Game
+        """
+        return engine.load_game(json.loads(self.state))
+
+
+class ChatMessage(models.Model):
+    """
+    A message said in a room's chat. Written behind the chat, in batches.
+    """
+    game = models.ForeignKey(to=GameState, on_delete=models.CASCADE, related_name='chat_messages')
+    author = models.CharField(max_length=150)
+    message = models.TextField()
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['game', 'id'], name='chat_message_game_id'),
+        ]
+
+    def to_message(self):
+        """
+        The message as chat clients are sent it.
+        :return: dict
+        """
+        return {'author': self.author, 'message': self.message}
 
 
 class UserSettings(models.Model):
@@ -820,7 +1050,7 @@ class UserSettings(models.Model):
     profile_picture = models.ImageField(upload_to='profile_pictures/', null=True)
 
 
-# TODO: Implement the Observer design pattern that will handle game events
+# Game events and card abilities are implemented in effects.py and engine.Game.dispatch, following the notes below.
 
 """
 Event Listener: A change in state that the game reports
@@ -0,0 +1,527 @@
+"""
+Game state messages sent to clients.
+
+A client is sent the state of its game as a nested dict:
+
+    {
+        'started': True,
+        'turn': 3,
+        'winner': 'username',  # once there is one
+        'players': {'1': player, '2': player},  # the player who goes first, then second
+        'hand': {'0': card, ...},  # only to the player whose hand it is
+    }
+    player = {'name': 'username', 'hp': 30, 'mana': 1, 'max_mana': 1, 'deck': 20, 'field': {'0': card, ...}}
+    card = {'n': name, 'd': description, 'c': cost, 'i': picture url, 'a': attack, 'h': hp}
+
+Cards are keyed by their position, and field cards alone have attack and hp.
+
+Rather than the whole state after every command, each connection keeps the last state it sent and sends the
+difference, as a JSON merge patch (RFC 7386): the keys whose values changed, and None for the keys that are gone.
+States never hold None, so a None in a patch always removes a key. Players and cards are keyed rather than listed
+so that patches can reach into them: a merge patch replaces a list whole.
+
+Every message has the version of this layout, and a sequence number: the version of the game its state is of.
+Sequence numbers are the same for every connection to a game, but not consecutive, as a message is only sent when
+what a client sees changes. A patch also has the sequence number of the state it applies to:
+
+    {'v': 2, 'seq': 12, 'state': {...}}  the whole state, sent on connect and on a resync
+    {'v': 2, 'seq': 15, 'base': 12, 'patch': {...}}  what changed since the last message
+
+A client whose sequence number is not the base of a patch has missed a message, and asks for a resync.
+
+A client whose command failed is told so, with the position of the command that failed when it sent a batch:
+
+    {'v': 2, 'error': 'NotAuthorized', 'index': 1}
+
+Frames go to each client through an Outbox, which keeps one frame waiting at most, however slow the client. A client
+that falls too far behind is disconnected, and resumes when it reconnects.
+
+Each worker keeps the last update events of its games in a Replay. A client that reconnects gives the sequence number
+of its last message (?seq= on the websocket URL) and is sent one patch of what it missed since, or the whole state if
+that is too far behind.
+
+Spectators, the users in the room who do not play, are sent the public state alone. All the spectators of a game on
+a worker share a Feed, so that each version of the public state is diffed and encoded once however many there are.
+
+Messages are JSON text frames, or MessagePack binary frames for clients that ask for the msgpack websocket
+subprotocol and when msgpack is installed.
+"""
+import asyncio
+import json
+from collections import OrderedDict
+
+from . import exceptions
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional, JSON is always available
+    msgpack = None
+
+# Version of the state layout, changed whenever the layout changes
+SCHEMA_VERSION = 2
+
+# Update events a game's replay keeps, and games whose replay a worker keeps
+REPLAY_SIZE = 64
+REPLAY_GAMES = 1000
+
+# Updates a client can fall behind by while a frame is being sent to it, before it is disconnected
+HIGH_WATER = 50
+
+# Websocket close code of clients disconnected for being too slow: Try Again Later
+TOO_SLOW = 1013
+
+# Websocket close code of clients of a room that does not exist, such as a deleted game's, which stop reconnecting
+ROOM_GONE = 4404
+
+# Websocket subprotocols
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+def card_state(card, field=False):
+    """
+    :param card: engine.CardSnapshot
+    :param field: whether the card is on the field, where it has attack and hp
+    :return: dict
+    """
+    data = {
+        'n': card.card.name,
+        'd': card.card.description,
+        'c': card.card.cost,
+        'i': card.card.picture_url,
+    }
+    if field:
+        data['a'] = card.attack
+        data['h'] = card.hp
+    return _without_none(data)
+
+
+def public_state(snapshot):
+    """
+    The part of the state of a game everyone in the room can see.
+    :param snapshot: engine.GameSnapshot of a started game
+    :return: dict
+    """
+    winner = snapshot.winner
+    players = {}
+    for number, player in enumerate(snapshot.players, 1):
+        players[str(number)] = _without_none({
+            'name': player.username,
+            'hp': player.hp,
+            'mana': player.mana,
+            'max_mana': player.max_mana,
+            'deck': player.deck_count,
+            'field': {str(card.position): card_state(card, field=True) for card in player.field},
+        })
+    return _without_none({
+        'started': snapshot.is_started,
+        'turn': snapshot.turn,
+        'winner': winner.username if winner else None,
+        'players': players,
+    })
+
+
+def hand_state(player):
+    """
+    The part of the state of a game only one player can see: their hand.
+    :param player: engine.PlayerSnapshot
+    :return: dict
+    """
+    return {str(card.position): card_state(card) for card in player.hand}
+
+
+def _without_none(data):
+    # A missing key and a None value are the same to the client, and only the first can be patched
+    return {key: value for key, value in data.items() if value is not None}
+
+
+def build_state(snapshot, username):
+    """
+    The state of a game a User is sent: what everyone can see, and their own hand if they play.
+    :param snapshot: engine.GameSnapshot of a started game
+    :param username:
+    :return: dict
+    """
+    return state_for(update_event(snapshot), username)
+
+
+def update_event(snapshot):
+    """
+    Group message telling every consumer of a game to update its client. It carries the public state and the hand of
+    each player, built once by whoever changed the game, so that consumers receiving it do not query anything.
+    :param snapshot: engine.GameSnapshot
+    :return: dict
+    """
+    if not snapshot.is_started:
+        return {'type': 'update_client', 'version': snapshot.version, 'public': None, 'hands': {}}
+    return {
+        'type': 'update_client',
+        'version': snapshot.version,
+        'public': public_state(snapshot),
+        'hands': {player.username: hand_state(player) for player in snapshot.players},
+    }
+
+
+def deleted_event():
+    """
+    Group message telling every consumer of a game that the game was deleted, so that it closes its client.
+    :return: dict
+    """
+    return {'type': 'game_deleted'}
+
+
+def state_for(event, username):
+    """
+    The state of a game a User is sent, out of an update_event message.
+    :param event: dict from update_event
+    :param username:
+    :return: dict, or None if the game has not started
+    """
+    if event['public'] is None:
+        return None
+    state = dict(event['public'])
+    hand = event['hands'].get(username)
+    if hand is not None:
+        state['hand'] = hand
+    return state
+
+
+def error_message(error):
+    """
+    Message telling a client its command failed.
+    :param error: exception the command raised, or exceptions.CommandFailed for a command of a batch
+    :return: dict
+    """
+    index = None
+    if isinstance(error, exceptions.CommandFailed):
+        index, error = error.index, error.error
+    return _without_none({'v': SCHEMA_VERSION, 'error': type(error).__name__, 'index': index})
+
+
+def diff(old, new):
+    """
+    Merge patch that turns one state into another.
+    :param old: dict
+    :param new: dict
+    :return: dict, empty when the states are equal
+    """
+    patch = {}
+    for key, value in new.items():
+        old_value = old.get(key)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            nested = diff(old_value, value)
+            if nested:
+                patch[key] = nested
+        elif key not in old or old_value != value:
+            patch[key] = value
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    return patch
+
+
+def merge(state, patch):
+    """
+    Applies a merge patch to a state, as clients do.
+    :param state: dict, not changed
+    :param patch: dict
+    :return: dict
+    """
+    merged = dict(state)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict):
+            merged[key] = merge(merged.get(key) if isinstance(merged.get(key), dict) else {}, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Stream:
+    """
+    The messages of one connection: the last state sent, and its sequence number.
+    """
+
+    def __init__(self):
+        self.seq = None
+        self.version = None  # latest version of the game seen, which later messages cannot be older than
+        self.state = None
+
+    def reset(self):
+        """
+        Makes the next message carry the whole state.
+        :return:
+        """
+        self.state = None
+
+    def resume(self, state, seq):
+        """
+        Picks up where the client of an earlier connection left off, so that the next message is a patch of its state.
+        :param state: dict, the state the client was last sent
+        :param seq: sequence number of that state
+        :return:
+        """
+        self.state = state
+        self.seq = self.version = seq
+
+    def message(self, state, version):
+        """
+        Message that brings the client to a state.
+        :param state: dict
+        :param version: version of the game the state is of
+        :return: dict, or None when the client already has the state or a later one
+        """
+        if self.state is None:
+            message = {'state': state}
+        else:
+            if version <= self.version:
+                return None
+            self.version = version
+            patch = diff(self.state, state)
+            if not patch:
+                return None
+            message = {'base': self.seq, 'patch': patch}
+        self.seq = self.version = version
+        self.state = state
+        message['v'] = SCHEMA_VERSION
+        message['seq'] = version
+        return message
+
+
+class Feed:
+    """
+    The messages of the spectators of a game: the last public state, and the sequence number of the last message.
+    Every spectator is sent the same frames, each encoded once per subprotocol and kept until the state changes.
+    """
+
+    def __init__(self):
+        self.seq = None
+        self.base = None  # sequence number of the state the last patch applies to
+        self.version = None  # latest version of the game seen
+        self.state = None
+        self.patch = None  # what the last message changed, None when it carried the first state
+        self.frames = {}  # (seq the spectator has, subprotocol) -> frame of the last message
+        self.spectators = 0
+
+    def update(self, state, version):
+        """
+        Brings the feed to a public state, unless it has a later one already.
+        :param state: dict from public_state
+        :param version: version of the game the state is of
+        :return:
+        """
+        if self.version is not None and version <= self.version:
+            return
+        self.version = version
+        if self.state is not None:
+            patch = diff(self.state, state)
+            if not patch:
+                return
+            self.patch = patch
+            self.base = self.seq
+        self.seq = version
+        self.state = state
+        self.frames = {}
+
+    def frame(self, seq, subprotocol=None):
+        """
+        Frame that brings a spectator to the feed's state.
+        :param seq: seq of the last message the spectator was sent, or None to send the whole state
+        :param subprotocol: from choose_subprotocol
+        :return: dict of the keyword arguments of AsyncWebsocketConsumer.send, or None when the spectator is up to date
+        """
+        if self.state is None or seq == self.seq:
+            return None
+        # The patch only applies to the state of the message before
+        if seq != self.base or self.patch is None:
+            seq = None
+        key = (seq, subprotocol)
+        if key not in self.frames:
+            message = {'state': self.state} if seq is None else {'base': seq, 'patch': self.patch}
+            message['v'] = SCHEMA_VERSION
+            message['seq'] = self.seq
+            self.frames[key] = encode(message, subprotocol)
+        return self.frames[key]
+
+
+class Outbox:
+    """
+    The frame waiting to go to one client, sent by a task of its own so that updates never wait on the client.
+    A frame is built only when the client can be sent it, out of the latest update: an update coming while another
+    waits supersedes it. However fast updates come, one waits at most.
+
+    The outbox owns the task sending its frames: it is the task in self.task, which lets go of it when done, or which
+    close lets go of. A client more than high_water updates behind is given up on rather than sent frames it cannot
+    keep up with. That is the backpressure on slow clients: they are disconnected, and sent the whole state when they
+    reconnect, as any client resuming the game.
+    """
+
+    def __init__(self, send, give_up, high_water=HIGH_WATER):
+        """
+        :param send: AsyncWebsocketConsumer.send of the client
+        :param give_up: coroutine function called when the client falls more than high_water updates behind
+        :param high_water:
+        """
+        self.send = send
+        self.give_up = give_up
+        self.high_water = high_water
+        self.pending = None  # function building the frame waiting
+        self.behind = 0  # updates since the frame being sent was built
+        self.task = None  # task sending the frames, while there are frames to send
+
+    async def put(self, build):
+        """
+        Makes a frame the one waiting, in place of any other.
+        :param build: function returning the keyword arguments of AsyncWebsocketConsumer.send, or None if there is
+        nothing to send by then
+        :return:
+        """
+        self.pending = build
+        self.behind += 1
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._write())
+        elif self.behind > self.high_water:
+            self.close()
+            await self.give_up()
+
+    async def _write(self):
+        try:
+            while self.pending is not None:
+                build, self.pending = self.pending, None
+                self.behind = 0
+                frame = build()
+                if frame is not None:
+                    await self.send(**frame)
+        except asyncio.CancelledError:
+            # Cancelled by close, which let go of this task: another may be sending by now
+            raise
+        except Exception:
+            self.task = None
+            raise
+        # Nothing is waiting: the next update starts a task of its own
+        self.task = None
+
+    async def join(self):
+        """
+        Waits until no frame is waiting or being sent.
+        :return:
+        """
+        if self.task is not None:
+            await self.task
+
+    def close(self):
+        """
+        Drops the frame waiting and stops sending, such as when the client is gone.
+        :return:
+        """
+        self.pending = None
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.task = None
+
+
+class Replay:
+    """
+    The last update events of each game, by version, for clients that reconnect.
+    Games are keyed by pk, as a room name can be used again by a new game. Only the REPLAY_GAMES games used last are
+    kept, so memory is bounded per game and in all.
+    """
+
+    def __init__(self, size=REPLAY_SIZE, max_games=REPLAY_GAMES):
+        self.size = size
+        self.max_games = max_games
+        self.games = OrderedDict()  # GameState pk -> OrderedDict of version -> event, oldest first; used last at the end
+        self.connections = {}  # GameState pk -> connections to the game on this worker
+
+    def add(self, game_pk, event):
+        """
+        Adds an update event to a game's replay, unless it has it or a later one already. Every connection to a game
+        hears each event, and each adds it.
+        :param game_pk:
+        :param event: dict from update_event
+        :return:
+        """
+        events = self.games.get(game_pk)
+        if events is None:
+            events = self.games[game_pk] = OrderedDict()
+            while len(self.games) > self.max_games:
+                self.games.popitem(last=False)
+        else:
+            self.games.move_to_end(game_pk)
+        if events and event['version'] <= next(reversed(events)):
+            return
+        events[event['version']] = event
+        while len(events) > self.size:
+            events.popitem(last=False)
+
+    def event(self, game_pk, version):
+        """
+        :param game_pk:
+        :param version:
+        :return: the update event of a game at a version, or None if it is not kept
+        """
+        return self.games.get(game_pk, {}).get(version)
+
+    def latest(self, game_pk):
+        """
+        The last update event of a game, if it is current. It is only known to be while the game has connections on
+        this worker, which hear every event.
+        :param game_pk:
+        :return: dict, or None
+        """
+        events = self.games.get(game_pk)
+        if not events or not self.connections.get(game_pk):
+            return None
+        return next(reversed(events.values()))
+
+    def connect(self, game_pk):
+        self.connections[game_pk] = self.connections.get(game_pk, 0) + 1
+
+    def disconnect(self, game_pk):
+        self.connections[game_pk] -= 1
+        if not self.connections[game_pk]:
+            del self.connections[game_pk]
+
+
+# The replay of this worker's games
+replay = Replay()
+
+
+def choose_subprotocol(offered):
+    """
+    The websocket subprotocol to accept out of those a client offers, MessagePack first when it is installed.
+    :param offered: subprotocols the client offers
+    :return: subprotocol, or None for plain JSON
+    """
+    for subprotocol in (MSGPACK, JSON):
+        if subprotocol in offered and (subprotocol != MSGPACK or msgpack is not None):
+            return subprotocol
+    return None
+
+
+def encode(message, subprotocol=None):
+    """
+    Frame of a message in a subprotocol.
+    :param message: dict
+    :param subprotocol: from choose_subprotocol
+    :return: dict of the keyword arguments of AsyncWebsocketConsumer.send
+    """
+    if subprotocol == MSGPACK:
+        return {'bytes_data': msgpack.packb(message, use_bin_type=True)}
+    return {'text_data': json.dumps(message, separators=(',', ':'))}
+
+
+def decode(text_data=None, bytes_data=None):
+    """
+    Message of a frame sent by a client, in either subprotocol.
+    :param text_data:
+    :param bytes_data:
+    :return: dict
+    """
+    if bytes_data is not None:
+        if msgpack is None:
+            raise ValueError('Binary frames need msgpack')
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
@@ -1,7 +1,10 @@
 from django.urls import path
-from . import consumers
+from . import consumers, shards
 
 websocket_urlpatterns = [
     path('ws/game/chat/<str:room_name>/', consumers.AsyncChatConsumer),
     path('ws/game/game/<str:room_name>/', consumers.GameConsumer),
-]
\ No newline at end of file
+]
+
+# Channels of the game shards, for a ChannelNameRouter, when settings.GAME_SHARDS is set
+channel_routes = {channel: consumers.GameShardConsumer for channel in shards.channel_names()}
@@ -0,0 +1,93 @@
+"""
+Room affinity of games across worker processes.
+
+Games can be spread across shards: `runworker` processes that each consume a channel of their own, 'game-shard-0',
+'game-shard-1' and so on. Every room name hashes to one shard on a consistent hash ring, so all the commands of a game
+go to the same shard, which keeps the game in memory and runs its commands one at a time (see
+consumers.GameShardConsumer). GameConsumers forward the commands of their clients to the shard of their room over the
+channel layer, rather than loading and saving the game themselves.
+
+Sharding is on when settings.GAME_SHARDS, the number of shards, is set. Each shard's channel then needs a worker
+process of its own, as a worker runs the commands of all its channels one at a time:
+
+    python manage.py runworker game-shard-0
+    python manage.py runworker game-shard-1
+    ...
+
+The ring has VIRTUAL_NODES points per shard, so rooms spread evenly, and changing the number of shards only moves the
+rooms of about one shard in every GAME_SHARDS.
+"""
+import bisect
+import hashlib
+
+from django.conf import settings
+
+# Channel of each shard
+SHARD_CHANNEL = 'game-shard-%d'
+
+# Points of each shard on the hash ring
+VIRTUAL_NODES = 64
+
+# Games a shard keeps in memory, the games used last
+SHARD_GAMES = 1000
+
+_rings = {}  # number of shards -> Ring
+
+
+def _hash(key):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class Ring:
+    """
+    Consistent hash ring of channel names.
+    """
+
+    def __init__(self, channels, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((_hash('%s#%d' % (channel, node)), channel)
+                        for channel in channels for node in range(virtual_nodes))
+        self.hashes = [point for point, channel in points]
+        self.channels = [channel for point, channel in points]
+
+    def channel_for(self, key):
+        """
+        The channel a key belongs to: the first point of the ring at or after the key's hash.
+        :param key: str
+        :return: channel name
+        """
+        index = bisect.bisect_left(self.hashes, _hash(key)) % len(self.hashes)
+        return self.channels[index]
+
+
+def shard_count():
+    """
+    :return: number of shards in settings.GAME_SHARDS, 0 when games are not sharded
+    """
+    return getattr(settings, 'GAME_SHARDS', 0) or 0
+
+
+def channel_names(count=None):
+    """
+    Channels of the shards.
+    :param count: number of shards, settings.GAME_SHARDS by default
+    :return: list
+    """
+    if count is None:
+        count = shard_count()
+    return [SHARD_CHANNEL % index for index in range(count)]
+
+
+def shard_for(room_name):
+    """
+    Channel of the shard that owns a room's game.
+    :param room_name:
+    :return: channel name, or None when games are not sharded
+    """
+    count = shard_count()
+    if not count:
+        return None
+    ring = _rings.get(count)
+    if ring is None:
+        ring = _rings[count] = Ring(channel_names(count))
+    return ring.channel_for(room_name)
@@ -0,0 +1,245 @@
+"""
+Headless match simulator, for balancing cards.
+
+Matches are played with the engine rules (summon, attack, attack_player, end_turn) on in-memory engine.Game objects,
+without the database or a websocket. Each player is driven by a policy, and many matches are spread across a
+process pool.
+
+A policy is a function(game, actions, rng) returning one of the legal actions, registered under a name with the
+policy decorator. An action is a (command, args) pair that engine.Game.apply takes.
+"""
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from . import engine
+
+# Stats players start a game with, as in PlayerState.initialize_all
+STARTING_HP = 30
+STARTING_MANA = 1
+
+# A match still going after this many turns is a draw
+MAX_TURNS = 200
+
+# Matches a worker process plays per task
+CHUNK_SIZE = 250
+
+# Policy name -> function(game, actions, rng)
+POLICIES = {}
+
+
+def policy(name):
+    """
+    Registers a function as a policy that can be chosen by name.
+    :param name:
+    :return: decorator
+    """
+    def register(function):
+        POLICIES[name] = function
+        return function
+    return register
+
+
+def legal_actions(game):
+    """
+    The actions the moving player can take.
+    Monsters are only summoned to the lowest free field position, since field positions do not change the rules.
+    :param game: engine.Game
+    :return: list of (command, args), end_turn last
+    """
+    player = game.player_moving
+    opponent = game.player_waiting
+    user_id = player.user_id
+    actions = []
+
+    field_position = player.next_field_position()
+    if field_position is not None:
+        for position, card in sorted(player.hand.items()):
+            if card.definition.cost <= player.mana:
+                actions.append(('summon', (user_id, position, field_position)))
+
+    for position, card in sorted(player.field.items()):
+        if (card.turns_alive > 0 or card.charge) and card.attacks_left > 0:
+            for target in sorted(opponent.field):
+                actions.append(('attack', (user_id, position, target)))
+            actions.append(('attack_player', (user_id, position, opponent.username)))
+
+    actions.append(('end_turn', (user_id,)))
+    return actions
+
+
+@policy('random')
+def random_policy(game, actions, rng):
+    """
+    Any legal action.
+    """
+    return rng.choice(actions)
+
+
+@policy('aggressive')
+def aggressive_policy(game, actions, rng):
+    """
+    Summons the most expensive monster it can afford, then attacks the opposing player with everything.
+    """
+    player = game.player_moving
+    summons = [action for action in actions if action[0] == 'summon']
+    if summons:
+        return max(summons, key=lambda action: player.hand[action[1][1]].definition.cost)
+    for action in actions:
+        if action[0] == 'attack_player':
+            return action
+    return actions[-1]
+
+
+@policy('trade')
+def trade_policy(game, actions, rng):
+    """
+    Summons like aggressive, but first attacks monsters its attacker destroys and survives.
+    """
+    player = game.player_moving
+    opponent = game.player_waiting
+    for action in actions:
+        if action[0] == 'attack':
+            attacker = player.field[action[1][1]]
+            defender = opponent.field[action[1][2]]
+            if attacker.attack >= defender.hp and defender.attack < attacker.hp:
+                return action
+    return aggressive_policy(game, actions, rng)
+
+
+def new_game(deck_1, deck_2, rng, first=0):
+    """
+    Starts a match in memory, each deck shuffled once as when a GameState starts.
+    :param deck_1: CardDefinitions of the first player's deck
+    :param deck_2: CardDefinitions of the second player's deck
+    :param rng: random.Random
+    :param first: index of the deck whose player moves first
+    :return: engine.Game
+    """
+    players = []
+    for index, deck in enumerate((deck_1, deck_2)):
+        player = engine.Player(pk=index + 1, user_id=index + 1, username='player_%d' % (index + 1),
+                               is_moving=index == first, is_first=index == first, hp=STARTING_HP,
+                               mana=STARTING_MANA, max_mana=STARTING_MANA)
+        definitions = list(deck)
+        rng.shuffle(definitions)
+        player.deck = [engine.CardInstance(definition, player, engine.DECK, position=position)
+                       for position, definition in enumerate(definitions)]
+        players.append(player)
+    if first:
+        players.reverse()
+    return engine.Game(pk=None, room_name=None, turn=0, is_started=True, is_ended=False, winner_id=None,
+                       players=players)
+
+
+def play_match(game, policies, rng, max_turns=MAX_TURNS):
+    """
+    Plays a match to its end.
+    :param game: engine.Game from new_game
+    :param policies: dict of user_id -> policy function
+    :param rng: random.Random
+    :param max_turns:
+    :return: user_id of the winner, or None for a draw
+    """
+    while not game.is_ended and game.turn < max_turns:
+        actions = legal_actions(game)
+        command, args = policies[game.player_moving.user_id](game, actions, rng)
+        game.apply(command, args)
+        # Nothing is written back, so there is nothing to remember
+        game.clear_touched()
+    return game.winner_id
+
+
+def _play_chunk(task):
+    """
+    Plays a chunk of matches in a worker process.
+    :param task: (deck_1, deck_2, policy names, seed, first game number, number of games), decks as
+        engine.DEFINITION_FIELDS values, so that they can be pickled
+    :return: dict of results
+    """
+    deck_1, deck_2, policy_names, seed, start, count = task
+    definitions = {}
+
+    def definitions_of(deck):
+        cards = []
+        for values in deck:
+            definition = definitions.get(values[0])
+            if definition is None:
+                definition = definitions[values[0]] = engine.CardDefinition(*values)
+            cards.append(definition)
+        return cards
+
+    deck_1 = definitions_of(deck_1)
+    deck_2 = definitions_of(deck_2)
+    policies = {1: POLICIES[policy_names[0]], 2: POLICIES[policy_names[1]]}
+
+    results = {'games': 0, 'wins': [0, 0], 'draws': 0, 'turns': 0}
+    for number in range(start, start + count):
+        rng = random.Random('%s-%d' % (seed, number))
+        # Players take turns going first
+        game = new_game(deck_1, deck_2, rng, first=number % 2)
+        winner_id = play_match(game, policies, rng)
+        results['games'] += 1
+        results['turns'] += game.turn
+        if winner_id is None:
+            results['draws'] += 1
+        else:
+            results['wins'][winner_id - 1] += 1
+    return results
+
+
+def simulate(deck_1, deck_2, games, policies=('aggressive', 'aggressive'), workers=None, seed=0):
+    """
+    Plays many matches between two decks, spread across a process pool.
+    Matches are seeded by seed and their number, so the results do not depend on the number of workers.
+    :param deck_1: CardDefinitions of the first player's deck
+    :param deck_2: CardDefinitions of the second player's deck
+    :param games: number of matches
+    :param policies: names of the policies of the first and second player
+    :param workers: number of worker processes. None uses one per CPU, 1 plays in this process.
+    :param seed:
+    :return: dict of results
+    """
+    for name in policies:
+        if name not in POLICIES:
+            raise ValueError(name)
+    deck_1 = [tuple(getattr(definition, field) for field in engine.DEFINITION_FIELDS) for definition in deck_1]
+    deck_2 = [tuple(getattr(definition, field) for field in engine.DEFINITION_FIELDS) for definition in deck_2]
+    tasks = [(deck_1, deck_2, tuple(policies), seed, start, min(CHUNK_SIZE, games - start))
+             for start in range(0, games, CHUNK_SIZE)]
+
+    if workers == 1:
+        chunks = list(map(_play_chunk, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(_play_chunk, tasks))
+
+    results = {'games': 0, 'wins': [0, 0], 'draws': 0, 'turns': 0}
+    for chunk in chunks:
+        results['games'] += chunk['games']
+        results['wins'][0] += chunk['wins'][0]
+        results['wins'][1] += chunk['wins'][1]
+        results['draws'] += chunk['draws']
+        results['turns'] += chunk['turns']
+
+    played = results['games'] or 1
+    return {
+        'games': results['games'],
+        'policies': list(policies),
+        'seed': seed,
+        'wins': results['wins'],
+        'draws': results['draws'],
+        'win_rates': [wins / played for wins in results['wins']],
+        'average_turns': results['turns'] / played,
+    }
+
+
+def write_results(results, path):
+    """
+    Writes simulation results to a JSON file.
+    :param results: dict from simulate
+    :param path:
+    :return:
+    """
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
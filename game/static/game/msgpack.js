@@ -0,0 +1,100 @@
+/* MessagePack decoding of the binary game frames the server sends to clients of the msgpack subprotocol.
+ * Served with the app rather than loaded from a CDN. Only decode is needed: clients send their commands as JSON.
+ * Extension types are not sent by the server, and are rejected.
+ */
+(function () {
+    let textDecoder = new TextDecoder();
+
+    function decode(bytes) {
+        let view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function take(length) {
+            if (offset + length > bytes.byteLength) {
+                throw new Error('MessagePack data ends early');
+            }
+            let start = offset;
+            offset += length;
+            return start;
+        }
+
+        function str(length) {
+            let start = take(length);
+            return textDecoder.decode(bytes.subarray(start, start + length));
+        }
+
+        function bin(length) {
+            let start = take(length);
+            return bytes.slice(start, start + length);
+        }
+
+        function array(length) {
+            let items = new Array(length);
+            for (let i = 0; i < length; i++) {
+                items[i] = value();
+            }
+            return items;
+        }
+
+        function map(length) {
+            let object = {};
+            for (let i = 0; i < length; i++) {
+                let key = value();
+                object[key] = value();
+            }
+            return object;
+        }
+
+        function uint64(start) {
+            return view.getUint32(start) * 4294967296 + view.getUint32(start + 4);
+        }
+
+        function value() {
+            let type = view.getUint8(take(1));
+
+            if (type <= 0x7f) return type;  // positive fixint
+            if (type >= 0xe0) return type - 0x100;  // negative fixint
+            if (type >= 0x80 && type <= 0x8f) return map(type & 0x0f);
+            if (type >= 0x90 && type <= 0x9f) return array(type & 0x0f);
+            if (type >= 0xa0 && type <= 0xbf) return str(type & 0x1f);
+
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(view.getUint8(take(1)));
+                case 0xc5: return bin(view.getUint16(take(2)));
+                case 0xc6: return bin(view.getUint32(take(4)));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return view.getUint8(take(1));
+                case 0xcd: return view.getUint16(take(2));
+                case 0xce: return view.getUint32(take(4));
+                case 0xcf: return uint64(take(8));
+                case 0xd0: return view.getInt8(take(1));
+                case 0xd1: return view.getInt16(take(2));
+                case 0xd2: return view.getInt32(take(4));
+                case 0xd3: {
+                    let start = take(8);
+                    return view.getInt32(start) * 4294967296 + view.getUint32(start + 4);
+                }
+                case 0xd9: return str(view.getUint8(take(1)));
+                case 0xda: return str(view.getUint16(take(2)));
+                case 0xdb: return str(view.getUint32(take(4)));
+                case 0xdc: return array(view.getUint16(take(2)));
+                case 0xdd: return array(view.getUint32(take(4)));
+                case 0xde: return map(view.getUint16(take(2)));
+                case 0xdf: return map(view.getUint32(take(4)));
+            }
+            throw new Error('Unsupported MessagePack type 0x' + type.toString(16));
+        }
+
+        let decoded = value();
+        if (offset !== bytes.byteLength) {
+            throw new Error('MessagePack data has extra bytes');
+        }
+        return decoded;
+    }
+
+    window.MessagePack = {decode: decode};
+})();
@@ -38,9 +38,18 @@ $(document).ready( function () {
     // client receives message
     chatSocket.onmessage = function (e) {
         let data = JSON.parse(e.data);  // deserialize string into JS object
-        let message = data['message'];
-        let author = data['author'];
-        chatLog.val(chatLog.val() + author + ': ' + message + '\n');  // display the message
+
+        // Notice about our own messages, such as them being dropped for coming too fast
+        if (data['notice']) {
+            chatLog.val(chatLog.val() + 'Server: ' + data['message'] + '\n');
+            return;
+        }
+
+        // Messages come in batches
+        let lines = data['messages'].map(function (message) {
+            return message['author'] + ': ' + message['message'] + '\n';
+        });
+        chatLog.val(chatLog.val() + lines.join(''));  // display the messages
     };
 
     // client connection closed
@@ -55,6 +64,7 @@ $(document).ready( function () {
     // Reference DOM elements
 
     let startGameButton = $('#start-game-button');
+    let addBotButton = $('#add-bot-button');
     let endTurnButton = $('#end-turn-button');
     let surrenderButton = $('#surrender-button');
     let deleteGameButton = $('#delete-game');
@@ -68,6 +78,8 @@ $(document).ready( function () {
     // Player
     let player1 = $('#player-1');
     let player2 = $('#player-2');
+    let player1NameText = $('#player-1-name');
+    let player2NameText = $('#player-2-name');
 
 
     let player1HpText = $('#player-1-hp');
@@ -95,19 +107,106 @@ $(document).ready( function () {
 
     /* Game WebSocket */
 
-    // connect to game websocket
-    let gameSocket = new WebSocket(
-        'ws://'
-        + window.location.host
-        + '/ws/game/game/' + roomName + '/'
-    );
+    // Version of the game state layout this client renders
+    const schemaVersion = 2;
+
+    // Last state received, and the sequence number of the message that brought it
+    let gameState = {};
+    let gameSeq = null;
+
+    // Close codes after which the game socket is not reconnected: a normal close, and a room that is gone
+    const normalClose = 1000;
+    const roomGone = 4404;
+
+    // Reconnect delays double after each failed attempt, up to the maximum. Each delay is picked at random below
+    // that, so that the clients of a restarted server do not all come back at once.
+    const reconnectBaseDelay = 500;
+    const reconnectMaxDelay = 30000;
+    let reconnectAttempts = 0;
+
+    // connect to game websocket, asking for binary MessagePack frames when the MessagePack library is loaded.
+    // On reconnect, give the sequence number of the last message, so that only what was missed is sent.
+    let gameSocket;
+    function connectGameSocket() {
+        gameSocket = new WebSocket(
+            'ws://'
+            + window.location.host
+            + '/ws/game/game/' + roomName + '/'
+            + (gameSeq === null ? '' : '?seq=' + gameSeq),
+            window.MessagePack ? ['msgpack', 'json'] : ['json']
+        );
+        gameSocket.binaryType = 'arraybuffer';
+        gameSocket.onopen = function () {
+            reconnectAttempts = 0;
+        };
+        gameSocket.onmessage = onGameMessage;
+        gameSocket.onclose = function (e) {
+            if (e.code === normalClose || e.code === roomGone) {
+                console.log('game socket closed');
+                return;
+            }
+            let delay = Math.min(reconnectMaxDelay, reconnectBaseDelay * Math.pow(2, reconnectAttempts));
+            reconnectAttempts += 1;
+            console.log('game socket closed, reconnecting');
+            setTimeout(connectGameSocket, Math.random() * delay);
+        };
+    }
 
     // client response to server message
-    gameSocket.onmessage = function (e) {
+    function onGameMessage(e) {
         console.log('onmessage');
-        let data = JSON.parse(e.data);
-        render(data);
-    };
+        let message;
+        if (e.data instanceof ArrayBuffer) {
+            message = MessagePack.decode(new Uint8Array(e.data));
+        } else {
+            message = JSON.parse(e.data);
+        }
+
+        if (message.v !== schemaVersion) {
+            console.error('Unsupported game state version ' + message.v);
+            return;
+        }
+
+        // One of our commands failed, and which one for a batch. The game is unchanged or updated separately.
+        if (message.error !== undefined) {
+            console.error('Command failed: ' + message.error
+                + (message.index === undefined ? '' : ' (command ' + message.index + ' of the batch)'));
+            return;
+        }
+
+        if (message.state !== undefined) {
+            // Whole state
+            gameState = message.state;
+        } else if (message.base === gameSeq) {
+            // What changed since the last message
+            gameState = mergePatch(gameState, message.patch);
+        } else {
+            // A message was missed, so the patch does not apply to our state
+            gameSocket.send(JSON.stringify({command: 'resync'}));
+            return;
+        }
+        gameSeq = message.seq;
+        render(gameState);
+    }
+
+    connectGameSocket();
+
+    // Applies a JSON merge patch: null removes a key, objects are merged, anything else replaces
+    function mergePatch(target, patch) {
+        let merged = Object.assign({}, target);
+        for (let key in patch) {
+            let value = patch[key];
+            if (value === null) {
+                delete merged[key];
+            } else if (typeof value === 'object' && !Array.isArray(value)) {
+                let nested = (typeof merged[key] === 'object' && merged[key] !== null) ? merged[key] : {};
+                merged[key] = mergePatch(nested, value);
+            } else {
+                merged[key] = value;
+            }
+        }
+        return merged;
+    }
 
 
 
@@ -117,76 +216,19 @@ $(document).ready( function () {
         // Retrieve message data
 
         // Game
-        let isStarted = data['is_started'];
-        let turn = data['turn'];
-        let winner = data['winner'];
+        let isStarted = data.started;
+        let turn = data.turn;
+        let winner = data.winner;
 
         // Player
-        let player1Hp = data['player_1_hp'];
-        let player2Hp = data['player_2_hp'];
-        let player1Mana = data['player_1_mana'];
-        let player2Mana = data['player_2_mana'];
-        let player1MaxMana = data['player_1_max_mana'];
-        let player2MaxMana = data['player_2_max_mana'];
-
-        // Deck
-        let player1DeckCount = data['player_1_deck_counter'];
-        let player2DeckCount = data['player_2_deck_counter'];
-
-        // TODO: Handle the fact that these cards may not exist
-
-        // Hand
-        let handCards = [];
-        for (let i = 0; i < 10; ++i) {
-            let position = data['hand_card_' + i + '_position'];
-            if (position !== undefined) {
-                handCards[position] =
-                    {
-                        position: data['hand_card_' + i + '_position'],
-                        name: data['hand_card_' + i + '_name'],
-                        description: data['hand_card_' + i + '_description'],
-                        cost: data['hand_card_' + i + '_cost'],
-                        picture: data['hand_card_' + i + '_picture'],
-                    };
-            }
-
-        }
+        let players = data.players || {};
+        let player1Data = players['1'] || {};
+        let player2Data = players['2'] || {};
 
-        // Field
-        let player1FieldCards = [];
-        let player2FieldCards = [];
-
-        // Index field cards by position
-        for (let i = 0; i < 7; ++i) {
-            let position = data['player_1_field_card_' + i + '_position'];
-            if (position !== undefined) {
-                player1FieldCards[position] = {
-                    position: data['player_1_field_card_' + i + '_position'],
-                    name: data['player_1_field_card_' + i + '_name'],
-                    description: data['player_1_field_card_' + i + '_description'],
-                    cost: data['player_1_field_card_' + i + '_cost'],
-                    picture: data['player_1_field_card_' + i + '_picture'],
-
-                    attack: data['player_1_field_card_' + i + '_attack'],
-                    hp: data['player_1_field_card_' + i + '_hp'],
-                };
-            }
-        }
-        for (let i = 0; i < 7; ++i) {
-            let position = data['player_2_field_card_' + i + '_position'];
-            if (position !== undefined) {
-                player2FieldCards[position] = {
-                    position: data['player_2_field_card_' + i + '_position'],
-                    name: data['player_2_field_card_' + i + '_name'],
-                    description: data['player_2_field_card_' + i + '_description'],
-                    cost: data['player_2_field_card_' + i + '_cost'],
-                    picture: data['player_2_field_card_' + i + '_picture'],
-
-                    attack: data['player_2_field_card_' + i + '_attack'],
-                    hp: data['player_2_field_card_' + i + '_hp'],
-                };
-            }
-        }
+        // Cards, keyed by position
+        let handCards = data.hand || {};
+        let player1FieldCards = player1Data.field || {};
+        let player2FieldCards = player2Data.field || {};
 
 
         // Update DOM
@@ -194,26 +236,39 @@ $(document).ready( function () {
         // GameState
         if (isStarted) {
             startGameButton.css({'display': 'none'})
+            addBotButton.css({'display': 'none'})
         } else {
             startGameButton.css({'display': 'inline-block'})
+            addBotButton.css({'display': 'inline-block'})
         }
 
         turnText.html(turn);
 
         if (winner) {
             winnerElement.html(winner + ' has won the game!');
+        } else {
+            winnerElement.empty();
         }
 
 
-        // Players
-        player1HpText.html(player1Hp);
-        player2HpText.html(player2Hp);
-        player1ManaText.html(player1Mana);
-        player2ManaText.html(player2Mana);
-        player1MaxManaText.html(player1MaxMana);
-        player2MaxManaText.html(player2MaxMana);
-        player1DeckCounter.html(player1DeckCount);
-        player2DeckCounter.html(player2DeckCount);
+        // Players. Seats can change hands after the page was rendered, such as when a bot takes the free one, so
+        // player1Name and player2Name follow the state.
+        if (player1Data.name !== undefined) {
+            player1Name = player1Data.name;
+            player1NameText.text(player1Name);
+        }
+        if (player2Data.name !== undefined) {
+            player2Name = player2Data.name;
+            player2NameText.text(player2Name);
+        }
+        player1HpText.html(player1Data.hp);
+        player2HpText.html(player2Data.hp);
+        player1ManaText.html(player1Data.mana);
+        player2ManaText.html(player2Data.mana);
+        player1MaxManaText.html(player1Data.max_mana);
+        player2MaxManaText.html(player2Data.max_mana);
+        player1DeckCounter.html(player1Data.deck);
+        player2DeckCounter.html(player2Data.deck);
 
         console.log(handCards);
         console.log(player1FieldCards);
@@ -223,10 +278,10 @@ $(document).ready( function () {
         handCardElements.each(function (i) {
             if (handCards[i]) {
                 // Element render hand card
-                handCardElements.eq(i).find('.name').html(handCards[i].name);
-                handCardElements.eq(i).find('.description').html(handCards[i].description);
-                handCardElements.eq(i).find('.cost').html(handCards[i].cost);
-                handCardElements.eq(i).find('.picture').attr('src', handCards[i].picture);
+                handCardElements.eq(i).find('.name').html(handCards[i].n);
+                handCardElements.eq(i).find('.description').html(handCards[i].d);
+                handCardElements.eq(i).find('.cost').html(handCards[i].c);
+                handCardElements.eq(i).find('.picture').attr('src', handCards[i].i || '');
             } else {
                 // Element should render empty card
                 handCardElements.eq(i).find('.name').empty();
@@ -239,12 +294,12 @@ $(document).ready( function () {
         // Field
         player1FieldCardElements.each(function (i) {
            if (player1FieldCards[i]) {
-                player1FieldCardElements.eq(i).find('.name').html(player1FieldCards[i].name);
-                player1FieldCardElements.eq(i).find('.description').html(player1FieldCards[i].description);
-                player1FieldCardElements.eq(i).find('.cost').html(player1FieldCards[i].cost);
-                player1FieldCardElements.eq(i).find('.picture').attr('src', player1FieldCards[i].picture);
-                player1FieldCardElements.eq(i).find('.attack').html(player1FieldCards[i].attack);
-                player1FieldCardElements.eq(i).find('.hp').html(player1FieldCards[i].hp);
+                player1FieldCardElements.eq(i).find('.name').html(player1FieldCards[i].n);
+                player1FieldCardElements.eq(i).find('.description').html(player1FieldCards[i].d);
+                player1FieldCardElements.eq(i).find('.cost').html(player1FieldCards[i].c);
+                player1FieldCardElements.eq(i).find('.picture').attr('src', player1FieldCards[i].i || '');
+                player1FieldCardElements.eq(i).find('.attack').html(player1FieldCards[i].a);
+                player1FieldCardElements.eq(i).find('.hp').html(player1FieldCards[i].h);
            } else {
                 player1FieldCardElements.eq(i).find('.name').empty();
                 player1FieldCardElements.eq(i).find('.description').empty();
@@ -256,12 +311,12 @@ $(document).ready( function () {
         });
         player2FieldCardElements.each(function (i) {
            if (player2FieldCards[i]) {
-                player2FieldCardElements.eq(i).find('.name').html(player2FieldCards[i].name);
-                player2FieldCardElements.eq(i).find('.description').html(player2FieldCards[i].description);
-                player2FieldCardElements.eq(i).find('.cost').html(player2FieldCards[i].cost);
-                player2FieldCardElements.eq(i).find('.picture').attr('src', player2FieldCards[i].picture);
-                player2FieldCardElements.eq(i).find('.attack').html(player2FieldCards[i].attack);
-                player2FieldCardElements.eq(i).find('.hp').html(player2FieldCards[i].hp);
+                player2FieldCardElements.eq(i).find('.name').html(player2FieldCards[i].n);
+                player2FieldCardElements.eq(i).find('.description').html(player2FieldCards[i].d);
+                player2FieldCardElements.eq(i).find('.cost').html(player2FieldCards[i].c);
+                player2FieldCardElements.eq(i).find('.picture').attr('src', player2FieldCards[i].i || '');
+                player2FieldCardElements.eq(i).find('.attack').html(player2FieldCards[i].a);
+                player2FieldCardElements.eq(i).find('.hp').html(player2FieldCards[i].h);
            }
            else {
                 player2FieldCardElements.eq(i).find('.name').empty();
@@ -282,6 +337,14 @@ $(document).ready( function () {
         gameSocket.send(JSON.stringify(data));
     });
 
+    addBotButton.click(function() {
+        console.log('add bot');
+        let data = {
+            command: 'add_bot',
+        };
+        gameSocket.send(JSON.stringify(data));
+    });
+
     endTurnButton.click(function() {
         console.log('end turn');
         let data = {
@@ -1,6 +1,29 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.db import IntegrityError, transaction
+from PIL import Image
+
+from game.consumers import AsyncChatConsumer, GameConsumer, GameShardConsumer
+from game import analytics, consumers, bot, chat, effects, engine, exceptions, models, protocol, shards, simulator
+from game.models import MonsterCard, Deck, UserSettings, GameState, MonsterCardState, GameCard, PlayerState, \
+    ChatMessage
 
 # Create your tests here.
 
@@ -15,9 +38,1649 @@ class CardTests(TestCase):
         user = create_user(username='username', password='password')
         # Create Card
 
+    def test_update_card_effect(self):
+        """
+        Editing a monster card saves its ability.
+        :return:
+        """
+        user = create_user()
+        card = MonsterCard.objects.create(creator=user, name='card', description='', cost=1, attack=2, hp=3)
+        self.client.force_login(user)
+        picture = io.BytesIO()
+        Image.new('RGB', (1, 1)).save(picture, 'PNG')
+        picture.name = 'picture.png'
+        picture.seek(0)
+
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root), \
+                mock.patch('game.views.render', return_value=HttpResponse()):
+            self.client.post(reverse('game:monster_card_update', args=[card.pk]), {
+                'name': 'card', 'description': 'description', 'cost': 1, 'attack': 2, 'hp': 3,
+                'effect': 'summoned: draw 1', 'picture': picture,
+            })
+        card.refresh_from_db()
+        self.assertEqual(card.effect, 'summoned: draw 1')
+
+
+class GameStateCommandTests(TestCase):
+
+    def setUp(self):
+        self.game = create_started_game()
+        self.moving_user = self.game.player_moving_state.user
+        self.waiting_user = self.game.player_waiting_state.user
+
+    def test_draw_card(self):
+        """
+        Drawing a card moves it from the moving player's deck to the first free hand position.
+        :return:
+        """
+        self.game.draw_card(self.moving_user)
+
+        player_state = self.game.player_moving_state
+        self.assertEqual(player_state.deckstate.cards.count(), 4)
+        self.assertEqual([hand_card.position for hand_card in player_state.handstate.cards.all()], [0])
+
+    def test_draw_cards(self):
+        """
+        Drawing several cards takes them from the top of the shuffled deck, in order, into free hand positions.
+        :return:
+        """
+        player_state = self.game.player_moving_state
+        top_cards = [deck_card.card_id for deck_card in player_state.deckstate.cards.order_by('-position')]
+
+        self.game.draw_cards(self.moving_user, 3)
+
+        hand_cards = player_state.handstate.cards.order_by('position')
+        self.assertEqual([(hand_card.position, hand_card.card_id) for hand_card in hand_cards],
+                         list(zip(range(3), top_cards[:3])))
+        self.assertEqual(player_state.deckstate.cards.count(), 2)
+
+        with self.assertRaises(exceptions.DeckEmpty):
+            self.game.draw_cards(self.moving_user, 3)
+        self.assertEqual(player_state.deckstate.cards.count(), 2)
+
+    def test_players_initialized_one_at_a_time(self):
+        """
+        Initializing one player after the other gives each their own cards.
+        :return:
+        """
+        game = create_started_game(room_name='separate', usernames=('player_3', 'player_4'), start=False)
+        for player_state in game.playerstate_set.all():
+            player_state.initialize()
+
+        cards = GameCard.objects.filter(game=game).select_related('owner', 'card')
+        self.assertEqual(cards.count(), 10)
+        self.assertEqual([card for card in cards if card.card.creator_id != card.owner.user_id], [])
+
+    def test_player_state_draw_cards(self):
+        """
+        PlayerState.draw_cards moves the top deck cards to the hand as a logged command of the game.
+        :return:
+        """
+        player_state = self.game.player_moving_state
+        top_card = player_state.deckstate.cards.order_by('-position').first()
+        version = self.game.version
+
+        player_state.draw_cards(2)
+
+        self.assertEqual(player_state.handstate.cards.get(position=0).card_id, top_card.card_id)
+        self.assertEqual(player_state.handstate.cards.count(), 2)
+        self.assertEqual(player_state.deckstate.cards.count(), 3)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.version, version + 1)
+        self.assertEqual(self.game.events.get(version=self.game.version).command, 'draw_cards')
+        self.assertEqual(snapshot_values(self.game.rebuild_engine().snapshot()),
+                         snapshot_values(self.game.load_engine().snapshot()))
+
+    def test_summon(self):
+        """
+        Summoning moves a hand card to the field and spends its cost in mana.
+        :return:
+        """
+        self.game.draw_card(self.moving_user)
+        self.game.summon(self.moving_user, 0, 3)
+
+        player_state = self.game.player_moving_state
+        field_card = player_state.fieldstate.cards.get()
+        self.assertEqual(field_card.position, 3)
+        self.assertEqual((field_card.attack, field_card.hp, field_card.attacks_left), (2, 3, 1))
+        self.assertEqual(player_state.handstate.cards.count(), 0)
+        self.assertEqual(player_state.mana, 0)
+
+    def test_occupied_positions(self):
+        """
+        Hands and fields record their occupied positions as bitmasks, and reject a second card in a position.
+        :return:
+        """
+        self.game.draw_cards(self.moving_user, 2)
+        self.game.summon(self.moving_user, 0, 5)
+
+        player_state = self.game.player_moving_state
+        self.assertEqual(player_state.handstate.occupied, 0b10)
+        self.assertEqual(player_state.fieldstate.occupied, 0b100000)
+        self.assertEqual(player_state.handstate.get_next_position(), 0)
+
+        with self.assertRaises(exceptions.FieldPositionOccupied):
+            self.game.summon(self.moving_user, 1, 5)
+        field_card = player_state.fieldstate.cards.get()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            GameCard.objects.create(game=self.game, owner=player_state, zone=engine.FIELD, position=5,
+                                    card=field_card.card, attack=1, hp=1)
+        self.assertEqual(list(player_state.fieldstate.cards.all()), [field_card])
+
+    def test_summon_not_authorized(self):
+        """
+        The waiting player cannot give commands.
+        :return:
+        """
+        with self.assertRaises(exceptions.NotAuthorized):
+            self.game.summon(self.waiting_user, 0, 0)
+
+    def test_end_turn(self):
+        """
+        Ending a turn switches the moving player, increments the turn and makes the next player draw.
+        :return:
+        """
+        self.game.end_turn(self.moving_user)
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.turn, 1)
+        self.assertEqual(self.game.player_moving_state.user, self.waiting_user)
+        self.assertEqual(self.game.player_moving_state.handstate.cards.count(), 1)
+        self.assertEqual(self.game.player_waiting_state.max_mana, 2)
+
+    def test_end_turn_upkeep(self):
+        """
+        End of turn upkeep bumps turns_alive and restores attacks on every field card, with queries that do not grow
+        with the number of field cards.
+        :return:
+        """
+        self.game.draw_cards(self.moving_user, 3)
+        player_state = self.game.player_moving_state
+        player_state.mana = 3
+        player_state.save()
+        self.game.summon(self.moving_user, 0, 0)
+        with self.assertNumQueries(12):
+            self.game.end_turn(self.moving_user)
+
+        self.game.end_turn(self.waiting_user)
+        self.game.summon(self.moving_user, 1, 1)
+        self.game.summon(self.moving_user, 2, 2)
+        GameCard.objects.filter(zone=engine.FIELD, position=0).update(attacks_left=0)
+        with self.assertNumQueries(12):
+            self.game.end_turn(self.moving_user)
+
+        field_cards = player_state.fieldstate.cards.order_by('position')
+        self.assertEqual([(field_card.turns_alive, field_card.attacks_left) for field_card in field_cards],
+                         [(3, 1), (1, 1), (1, 1)])
+
+    def test_attack_moves_destroyed_card_to_graveyard(self):
+        """
+        A field card whose hp reaches 0 moves to its owner's graveyard, freeing its field position.
+        :return:
+        """
+        self.game.draw_card(self.moving_user)
+        self.game.summon(self.moving_user, 0, 0)
+        self.game.end_turn(self.moving_user)
+        self.game.summon(self.waiting_user, 0, 4)
+        self.game.end_turn(self.waiting_user)
+
+        defending_state = self.game.player_waiting_state
+        defending_state.fieldstate.cards.update(hp=2)
+        self.game.attack(self.moving_user, 0, 4)
+
+        defending_state.fieldstate.refresh_from_db()
+        self.assertEqual(defending_state.fieldstate.occupied, 0)
+        self.assertEqual(defending_state.fieldstate.cards.count(), 0)
+        graveyard_card = defending_state.cards.get(zone=engine.GRAVEYARD)
+        self.assertIsNone(graveyard_card.position)
+        self.assertEqual(self.game.load_engine().players[1].graveyard[0].row_pk, graveyard_card.pk)
+
+    def test_summoned_ability(self):
+        """
+        A monster's ability runs when it is summoned, and is saved with the command.
+        :return:
+        """
+        MonsterCardState.objects.filter(game=self.game).update(effect='summoned: damage_enemy_player 2')
+        self.game.draw_card(self.moving_user)
+        self.game.summon(self.moving_user, 0, 0)
+
+        self.assertEqual(self.game.player_waiting_state.hp, 28)
+
+    def test_loaded_game_runs_abilities_in_the_same_order(self):
+        """
+        Abilities run in an order that only depends on the saved state, so a game runs the same once it is reloaded.
+        :return:
+        """
+        MonsterCardState.objects.filter(game=self.game).update(effect='turn_ended: damage_enemy_field 5')
+        moving, waiting = self.moving_user.pk, self.waiting_user.pk
+        # The second player summons first, the first player later
+        game, error = self.game.run_commands([
+            ('draw_cards', (moving, 1)), ('end_turn', (moving,)), ('draw_cards', (waiting, 1)),
+            ('summon', (waiting, 0, 0)), ('end_turn', (waiting,)), ('summon', (moving, 0, 3)),
+        ], game=self.game.load_engine())
+        loaded = self.game.load_engine()
+        self.assertEqual(loaded.listeners,
+                         {effects.TURN_ENDED: [loaded.players[0].field[3], loaded.players[1].field[0]]})
+        self.assertEqual([card.definition.pk for card in game.listeners[effects.TURN_ENDED]],
+                         [card.definition.pk for card in loaded.listeners[effects.TURN_ENDED]])
+
+        # Each ability destroys the other card, so only the first to run fires
+        game.apply('end_turn', (moving,))
+        loaded.apply('end_turn', (moving,))
+        self.assertEqual(snapshot_values(game.snapshot()), snapshot_values(loaded.snapshot()))
+        self.assertEqual(len(loaded.players[1].field), 0)
+
+    def test_attack_player_wins_game(self):
+        """
+        A player whose hp reaches 0 loses the game.
+        :return:
+        """
+        self.game.draw_card(self.moving_user)
+        self.game.summon(self.moving_user, 0, 0)
+        self.game.end_turn(self.moving_user)
+        self.game.end_turn(self.waiting_user)
+
+        player_waiting_state = self.game.player_waiting_state
+        player_waiting_state.hp = 2
+        player_waiting_state.save()
+        self.game.attack_player(self.moving_user, 0, self.waiting_user.username)
+
+        self.game.refresh_from_db()
+        self.assertTrue(self.game.is_ended)
+        self.assertEqual(self.game.winner, self.moving_user)
+
+
+class StartGameTests(TestCase):
+
+    def test_start_game_creates_decks(self):
+        """
+        Starting a game gives each player their preferred deck, an empty hand and an empty field.
+        :return:
+        """
+        game = create_started_game(deck_size=4)
+
+        for player_state in (game.player_1_state, game.player_2_state):
+            self.assertEqual((player_state.hp, player_state.mana, player_state.max_mana), (30, 1, 1))
+            deck_cards = player_state.deckstate.cards.order_by('position')
+            self.assertEqual([deck_card.card.creator for deck_card in deck_cards], [player_state.user] * 4)
+            self.assertEqual([deck_card.position for deck_card in deck_cards], [0, 1, 2, 3])
+            self.assertEqual(player_state.handstate.cards.count(), 0)
+            self.assertEqual(player_state.fieldstate.cards.count(), 0)
+        self.assertEqual(MonsterCardState.objects.filter(game=game).count(), 8)
+
+    def test_start_game_queries_do_not_grow_with_decks(self):
+        """
+        Starting a game takes the same number of queries however large the decks are.
+        :return:
+        """
+        small_game = create_started_game(room_name='small', deck_size=2, usernames=('small_1', 'small_2'),
+                                         start=False)
+        large_game = create_started_game(room_name='large', deck_size=30, usernames=('large_1', 'large_2'),
+                                         start=False)
+
+        with self.assertNumQueries(19):
+            small_game.start_game()
+        with self.assertNumQueries(19):
+            large_game.start_game()
+
+
+class GameStateConcurrencyTests(TestCase):
+
+    def setUp(self):
+        self.game = create_started_game()
+        self.moving_user = self.game.player_moving_state.user
+
+    def test_stale_command_is_not_saved(self):
+        """
+        A command applied to a state that another command has since changed raises and writes nothing.
+        :return:
+        """
+        stale = self.game.load_engine()
+        GameState.objects.get(pk=self.game.pk).draw_card(self.moving_user)
+
+        stale.draw_card(self.moving_user.pk)
+        with self.assertRaises(exceptions.GameStateConflict):
+            self.game.save_engine(stale)
+
+        self.assertEqual(self.game.player_moving_state.handstate.cards.count(), 1)
+
+    def test_command_retries_after_conflict(self):
+        """
+        A command that loses a race is reloaded and applied again.
+        :return:
+        """
+        save_engine = GameState.save_engine
+        calls = []
+
+        def save_engine_after_other_command(game_state, game, *args):
+            calls.append(game)
+            # The first attempt races with another player's command
+            if len(calls) == 1:
+                other = GameState.objects.get(pk=game_state.pk).load_engine()
+                other.draw_card(self.moving_user.pk)
+                save_engine(game_state, other)
+            save_engine(game_state, game, *args)
+
+        with mock.patch.object(GameState, 'save_engine', save_engine_after_other_command):
+            self.game.draw_card(self.moving_user)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.game.player_moving_state.handstate.cards.count(), 2)
+
+
+class CommandLogTests(TestCase):
+
+    def setUp(self):
+        self.game = create_started_game()
+        self.moving_user = self.game.player_moving_state.user
+        self.waiting_user = self.game.player_waiting_state.user
+
+    def play(self):
+        self.game.draw_cards(self.moving_user, 2)
+        self.game.summon(self.moving_user, 0, 3)
+        self.game.end_turn(self.moving_user)
+        self.game.summon(self.waiting_user, 0, 1)
+        self.game.end_turn(self.waiting_user)
+        self.game.attack(self.moving_user, 3, 1)
+
+    def test_commands_are_logged(self):
+        """
+        Every accepted command is appended to the game's log with the version it brought the game to.
+        Rejected commands are not logged.
+        :return:
+        """
+        with self.assertRaises(exceptions.NotAuthorized):
+            self.game.summon(self.waiting_user, 0, 0)
+        self.game.draw_cards(self.moving_user, 2)
+        self.game.summon(self.moving_user, 1, 3)
+
+        events = self.game.events.order_by('version')
+        self.assertEqual([(event.version, event.command, event.arguments) for event in events],
+                         [(2, 'draw_cards', '[%d, 2]' % self.moving_user.pk),
+                          (3, 'summon', '[%d, 1, 3]' % self.moving_user.pk)])
+        self.assertEqual(list(self.game.snapshots.values_list('version', flat=True)), [1])
+
+    def test_rebuild_from_snapshot_and_log(self):
+        """
+        A game rebuilt from its latest snapshot and the commands after it is the game in the database.
+        :return:
+        """
+        with mock.patch('game.models.SNAPSHOT_INTERVAL', 4):
+            self.play()
+
+        self.assertEqual(list(self.game.snapshots.values_list('version', flat=True)), [1, 4])
+        rebuilt = self.game.rebuild_engine()
+        self.assertEqual(rebuilt.version, 7)
+        self.assertEqual(snapshot_values(rebuilt.snapshot()), snapshot_values(self.game.load_engine().snapshot()))
+
+    def test_recover(self):
+        """
+        Recovering a game overwrites rows left behind by a half-applied command.
+        :return:
+        """
+        self.play()
+        expected = snapshot_values(self.game.load_engine().snapshot())
+
+        # A crash in the middle of a turn
+        GameCard.objects.filter(game=self.game, zone=engine.FIELD).update(hp=99, zone=engine.GRAVEYARD,
+                                                                          position=None)
+        PlayerState.objects.filter(game_state=self.game).update(mana=0, is_moving=False)
+
+        self.game.recover()
+        self.assertEqual(snapshot_values(self.game.load_engine().snapshot()), expected)
+        self.assertEqual(self.game.version, 7)
+
+    def test_occupancy_is_checked(self):
+        """
+        A game whose saved occupancy disagrees with its cards is not loaded until it is recovered.
+        :return:
+        """
+        self.play()
+        expected = snapshot_values(self.game.load_engine().snapshot())
+
+        player_state = self.game.player_moving_state
+        models.FieldState.objects.filter(player_state=player_state).update(occupied=0b1111111)
+        with self.assertRaises(exceptions.OccupancyMismatch) as raised:
+            self.game.load_engine()
+        self.assertEqual(raised.exception.pk, player_state.pk)
+
+        self.game.recover()
+        self.assertEqual(snapshot_values(self.game.load_engine().snapshot()), expected)
+
+    def test_recover_swapped_positions(self):
+        """
+        Recovering a game whose rows hold each other's positions writes every row back to its own.
+        :return:
+        """
+        self.play()
+        expected = snapshot_values(self.game.load_engine().snapshot())
+
+        owner = self.game.player_moving_state
+        first, second = GameCard.objects.filter(owner=owner, zone=engine.DECK).order_by('position')[:2]
+        GameCard.objects.filter(pk=first.pk).update(position=None)
+        GameCard.objects.filter(pk=second.pk).update(position=first.position)
+        GameCard.objects.filter(pk=first.pk).update(position=second.position)
+
+        self.game.recover()
+        self.assertEqual(snapshot_values(self.game.load_engine().snapshot()), expected)
+
+
+class BatchCommandTests(TestCase):
+
+    def setUp(self):
+        self.game = create_started_game()
+        self.moving_user = self.game.player_moving_state.user
+        self.waiting_user = self.game.player_waiting_state.user
+        self.game.draw_cards(self.moving_user, 2)
+
+    def test_batch_is_logged_in_order(self):
+        """
+        A batch of commands is saved once, with each command logged at a version of its own.
+        :return:
+        """
+        pk = self.moving_user.pk
+        with mock.patch('game.models.SNAPSHOT_INTERVAL', 3):
+            game, error = self.game.run_commands([('summon', (pk, 0, 3)), ('draw_card', (pk,)),
+                                                  ('end_turn', (pk,))], atomic=False)
+        self.assertIsNone(error)
+        self.assertEqual(game.version, 5)
+        self.assertEqual(list(self.game.events.order_by('version').values_list('version', 'command')),
+                         [(2, 'draw_cards'), (3, 'summon'), (4, 'draw_card'), (5, 'end_turn')])
+        self.assertEqual(list(self.game.snapshots.values_list('version', flat=True)), [1, 5])
+        self.assertEqual(snapshot_values(self.game.rebuild_engine().snapshot()),
+                         snapshot_values(self.game.load_engine().snapshot()))
+
+    def test_atomic_batch_saves_nothing_on_error(self):
+        """
+        A command failing in an atomic batch fails the commands before it too.
+        :return:
+        """
+        pk = self.moving_user.pk
+        with self.assertRaises(exceptions.CommandFailed) as failure:
+            self.game.run_commands([('summon', (pk, 0, 3)), ('summon', (self.waiting_user.pk, 0, 3))])
+        self.assertEqual(failure.exception.index, 1)
+        self.assertIsInstance(failure.exception.error, exceptions.NotAuthorized)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.version, 2)
+        self.assertFalse(GameCard.objects.filter(game=self.game, zone=engine.FIELD).exists())
+
+    def test_batch_stops_at_first_error(self):
+        """
+        A batch that is not atomic keeps the commands before the one that failed, and drops those after it.
+        :return:
+        """
+        pk = self.moving_user.pk
+        game, error = self.game.run_commands([('summon', (pk, 0, 3)), ('summon', (pk, 0, 4)),
+                                              ('end_turn', (pk,))], atomic=False)
+        self.assertEqual(error.index, 1)
+        self.assertIsInstance(error.error, exceptions.InvalidCard)
+        self.assertEqual(game.version, 3)
+        self.assertEqual(list(GameCard.objects.filter(game=self.game, zone=engine.FIELD).values_list(
+            'position', flat=True)), [3])
+        self.assertEqual(self.game.player_moving_state.user, self.moving_user)
+
+    def test_consumer_batch(self):
+        """
+        The game consumer turns a client's batch into engine commands, and rejects malformed batches.
+        :return:
+        """
+        consumer = GameConsumer({'type': 'websocket'})
+        consumer.game = self.game
+        consumer.user = self.moving_user
+        consumer.batch({'commands': [
+            {'command': 'summon', 'handCardPosition': 0, 'fieldCardPosition': 2},
+            {'command': 'end_turn'},
+        ]})
+        self.assertEqual(self.game.player_moving_state.user, self.waiting_user)
+
+        for data in ({'commands': []}, {'commands': [{'command': 'start_game'}]},
+                     {'commands': [{'command': 'summon'}]}, {'commands': 'end_turn'}):
+            with self.assertRaises(exceptions.InvalidBatch):
+                consumer.batch(data)
+
+
+class GameSnapshotTests(TestCase):
+
+    def test_snapshot(self):
+        """
+        A snapshot holds both players' stats, deck counts, hands and fields.
+        :return:
+        """
+        game = create_started_game()
+        moving_user = game.player_moving_state.user
+        game.draw_card(moving_user)
+        game.draw_card(moving_user)
+        game.summon(moving_user, 1, 4)
+
+        snapshot = game.load_snapshot()
+        player = snapshot.player_of(moving_user.pk)
+        self.assertEqual(player.deck_count, 3)
+        self.assertEqual([hand_card.position for hand_card in player.hand], [0])
+        self.assertEqual([(field_card.position, field_card.hp) for field_card in player.field], [(4, 3)])
+        self.assertEqual(player.field[0].card.name, MonsterCardState.objects.get(pk=player.field[0].card.pk).name)
+        self.assertIsNone(snapshot.winner)
+
+    def test_snapshot_queries_do_not_grow_with_cards(self):
+        """
+        Loading a snapshot takes the same number of queries however many cards are in hands and fields.
+        :return:
+        """
+        small_game = create_started_game(room_name='small', deck_size=2, usernames=('small_1', 'small_2'))
+        large_game = create_started_game(room_name='large', deck_size=8, usernames=('large_1', 'large_2'))
+        for game in (small_game, large_game):
+            moving_user = game.player_moving_state.user
+            for _ in range(2):
+                game.draw_card(moving_user)
+            game.summon(moving_user, 0, 0)
+        large_moving_user = large_game.player_moving_state.user
+        for _ in range(4):
+            large_game.draw_card(large_moving_user)
+
+        with self.assertNumQueries(3):
+            small_game.load_snapshot()
+        with self.assertNumQueries(3):
+            large_game.load_snapshot()
+
+
+class EngineTests(TestCase):
+
+    def test_lowest_free_position(self):
+        """
+        The lowest free position is the lowest unset bit of an occupancy bitmask.
+        :return:
+        """
+        self.assertEqual(engine.lowest_free_position(0, 7), 0)
+        self.assertEqual(engine.lowest_free_position(0b1011, 7), 2)
+        self.assertIsNone(engine.lowest_free_position(0b1111111, 7))
+        self.assertEqual(engine.free_positions(0b1010, 5), [0, 2, 4])
+
+    def test_buffs_stop_at_largest_stat(self):
+        """
+        Buffs raise a stat no higher than its column holds.
+        :return:
+        """
+        game = create_engine_game()
+        card = game.players[0].field[0]
+        card.attack = effects.MAX_STAT - 1
+        effects.buff_attack(game, card, 5)
+        self.assertEqual(card.attack, effects.MAX_STAT)
+
+    def test_attack_removes_destroyed_cards(self):
+        """
+        Field cards whose hp reaches 0 go to the graveyard, without touching the database.
+        :return:
+        """
+        game = create_engine_game()
+        attacker = game.players[0].field[0]
+        defender = game.players[1].field[0]
+
+        with self.assertNumQueries(0):
+            game.attack(1, 0, 0)
+
+        self.assertEqual(game.players[0].field, {0: attacker})
+        self.assertEqual(game.players[1].field, {})
+        self.assertEqual(attacker.hp, 1)
+        self.assertEqual(game.players[1].graveyard, [defender])
+        self.assertEqual((defender.zone, defender.position), (engine.GRAVEYARD, None))
+
+    def test_compile_effect(self):
+        """
+        Effect text is compiled once, and cards with the same text share the handlers.
+        :return:
+        """
+        abilities = effects.compile_effect('summoned: draw 1\nturn_ended: heal_owner 2')
+        self.assertEqual(sorted(abilities), [effects.SUMMONED, effects.TURN_ENDED])
+        self.assertIs(effects.compile_effect('summoned: draw 1\nturn_ended: heal_owner 2'), abilities)
+        self.assertEqual(effects.compile_effect(''), {})
+        self.assertEqual(effects.compile_effect.cache_info().maxsize, effects.COMPILED_EFFECTS)
+
+        for text in ('summoned draw 1', 'attacked: draw 1', 'summoned: fly 1', 'summoned: draw one'):
+            with self.assertRaises(exceptions.InvalidEffect):
+                effects.compile_effect(text)
+
+    def test_dispatch_reaches_only_listeners(self):
+        """
+        Game events are indexed to the field cards with an ability for them.
+        :return:
+        """
+        game = create_engine_game(effects=('turn_ended: heal_owner 1', ''))
+        healer = game.players[0].field[0]
+        self.assertEqual(game.listeners, {effects.TURN_ENDED: [healer]})
+
+        game.end_turn(1)
+        game.end_turn(2)
+        self.assertEqual(game.players[0].hp, 32)
+        self.assertEqual(game.players[1].hp, 30)
+
+    def test_destroyed_ability(self):
+        """
+        A card destroyed in combat triggers its own ability, and leaves the index.
+        :return:
+        """
+        game = create_engine_game(effects=('', 'destroyed: damage_enemy_player 3\nturn_ended: heal_owner 1'))
+        defender = game.players[1].field[0]
+
+        game.attack(1, 0, 0)
+
+        self.assertEqual(game.players[0].hp, 27)
+        self.assertEqual(game.players[1].graveyard, [defender])
+        self.assertEqual(game.listeners, {effects.TURN_ENDED: []})
+
+    def test_attack_on_turn_summoned(self):
+        """
+        A monster cannot attack on the turn it was summoned unless it has charge.
+        :return:
+        """
+        game = create_engine_game()
+        game.players[0].field[0].turns_alive = 0
+
+        with self.assertRaises(exceptions.AttackOnTurnSummonedWithoutCharge):
+            game.attack(1, 0, 0)
+
+
+class SimulatorTests(TestCase):
+
+    def test_legal_actions(self):
+        """
+        The moving player can attack with monsters that have attacks left, and can always end their turn.
+        :return:
+        """
+        game = create_engine_game()
+        self.assertEqual(simulator.legal_actions(game),
+                         [('attack', (1, 0, 0)), ('attack_player', (1, 0, 'player_2')), ('end_turn', (1,))])
+
+    def test_simulate(self):
+        """
+        Simulated matches finish, and their results do not depend on how they are split into chunks.
+        :return:
+        """
+        deck = [engine.CardDefinition(pk=pk, name='card', description='', cost=pk % 4 + 1, picture_url=None,
+                                      attack=pk % 3 + 1, hp=pk % 5 + 1) for pk in range(15)]
+        results = simulator.simulate(deck, deck, 20, policies=('trade', 'random'), workers=1, seed=3)
+
+        self.assertEqual(results['games'], 20)
+        self.assertEqual(sum(results['wins']) + results['draws'], 20)
+        with mock.patch('game.simulator.CHUNK_SIZE', 6):
+            self.assertEqual(simulator.simulate(deck, deck, 20, policies=('trade', 'random'), workers=1, seed=3),
+                             results)
+
+    def test_simulate_command(self):
+        """
+        The simulate command evaluates a card in a deck and writes the results to a file.
+        :return:
+        """
+        user = create_user()
+        deck = Deck.objects.create(name='deck', user=user)
+        for i in range(10):
+            deck.monster_cards.add(MonsterCard.objects.create(creator=user, name='card_%d' % i, description='',
+                                                              cost=i % 3 + 1, attack=2, hp=2))
+        card = MonsterCard.objects.create(creator=user, name='new', description='', cost=1, attack=5, hp=5)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            call_command('simulate', deck.pk, card=card.pk, copies=3, games=10, workers=1, output=path,
+                         stdout=io.StringIO())
+            with open(path) as file:
+                results = json.load(file)
+        self.assertEqual(results['games'], 10)
+        self.assertEqual(results['card'], card.pk)
+
+
+class AnalyticsTests(TestCase):
+
+    def setUp(self):
+        # cost, attack, hp
+        self.pool = analytics.CardPool(pks=[1, 2, 3, 4], names=['a', 'b', 'c', 'd'], cost=[1, 2, 3, 0],
+                                       attack=[2, 3, 1, 0], hp=[4, 2, 6, 5])
+
+    def test_trade_matrix(self):
+        """
+        The monster that needs fewer hits to destroy the other wins the trade.
+        :return:
+        """
+        self.assertEqual(analytics.trade_matrix(self.pool).tolist(), [
+            [0, 1, 1, 1],
+            [-1, 0, 0, 1],
+            [-1, 0, 0, 1],
+            [-1, -1, -1, 0],
+        ])
+        wins, draws, losses = analytics.trade_summary(self.pool, block_size=3)
+        self.assertEqual((wins.tolist(), draws.tolist(), losses.tolist()),
+                         ([3, 1, 1, 0], [1, 2, 2, 1], [0, 1, 1, 3]))
+
+    def test_hero_kill_turns(self):
+        """
+        A monster attacks from the turn after the earliest turn its cost can be paid.
+        :return:
+        """
+        attacks, turns = analytics.hero_kill_turns(self.pool)
+        self.assertEqual(attacks.tolist(), [15, 10, 30, float('inf')])
+        self.assertEqual(turns.tolist(), [16, 12, 33, float('inf')])
+
+    def test_deck_tables(self):
+        """
+        Deck tables average over a random monster of each deck.
+        :return:
+        """
+        damage, outcome = analytics.deck_tables(self.pool, [[0, 1], [3]])
+        self.assertEqual(damage.tolist(), [[2.25, 2.5], [0.0, 0.0]])
+        self.assertEqual(outcome.tolist(), [[0.0, 1.0], [-1.0, 0.0]])
+
+        blocked = analytics.deck_tables(self.pool, [[0, 1], [3]], block_size=1)
+        self.assertEqual([table.tolist() for table in blocked], [damage.tolist(), outcome.tolist()])
+
+    def test_card_analytics_view(self):
+        """
+        The analytics endpoint is cached.
+        :return:
+        """
+        cache.clear()
+        user = create_user()
+        deck = Deck.objects.create(name='deck', user=user)
+        for attack, hp in ((2, 3), (1, 1)):
+            deck.monster_cards.add(MonsterCard.objects.create(creator=user, name='card', description='', cost=1,
+                                                              attack=attack, hp=hp))
+
+        response = self.client.get(reverse('game:card_analytics'))
+        data = response.json()
+        self.assertEqual([(card['wins'], card['losses']) for card in data['cards']], [(1, 0), (0, 1)])
+        self.assertEqual(data['decks']['pks'], [deck.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('game:card_analytics')).json(), data)
+
+        pks = ','.join(str(card['pk']) for card in data['cards'])
+        response = self.client.get(reverse('game:card_analytics'), {'cards': pks})
+        self.assertEqual(response.json()['trades'], [[0, 1], [-1, 0]])
+
+
+class BotTests(TestCase):
+
+    def test_clone_is_independent(self):
+        """
+        Playing on a clone of a game does not change the game.
+        :return:
+        """
+        game = create_engine_game()
+        before = snapshot_values(game.snapshot())
+        clone = game.clone()
+        clone.attack(1, 0, 0)
+        clone.end_turn(1)
+
+        self.assertEqual(snapshot_values(game.snapshot()), before)
+        self.assertEqual(game.player_waiting.field[0].hp, 2)
+        self.assertIsNone(clone.player_moving.field.get(0))
+
+    def test_search_finds_lethal(self):
+        """
+        The bot attacks the opposing player when that wins the game.
+        :return:
+        """
+        game = create_engine_game()
+        game.player_waiting.hp = 2
+        action = bot.search(game, 1, seconds=5, rng=random.Random(0), iterations=200)
+        self.assertEqual(action, ('attack_player', (1, 0, 'player_2')))
+
+    def test_lone_player_can_add_bot(self):
+        """
+        A player waiting alone in a room is offered a computer opponent.
+        :return:
+        """
+        game_state = GameState.objects.create(room_name='room')
+        game_state.create_player_states()
+        user = create_user()
+        UserSettings.objects.create(user=user)
+        game_state.register(user)
+        self.client.force_login(user)
+        # base.html comes from the project, so the page is not rendered here
+        with mock.patch('game.views.render', return_value=HttpResponse()) as render:
+            self.client.get(reverse('game:room', args=['room']))
+        request, template, context = render.call_args[0]
+        self.assertEqual(template, 'game/room.html')
+        self.assertFalse(context['is_spectator'])  # the game controls are shown
+        self.assertIsNone(context['player_1_settings' if context['player_2_name'] else 'player_2_settings'])
+
+    def test_bot_takes_its_turn(self):
+        """
+        A bot seated in a game plays until its turn ends.
+        :return:
+        """
+        game_state = create_started_game(usernames=('player_1',), start=False)
+        self.assertFalse(game_state.load_engine().has_bot)
+        bot_state = game_state.add_bot()
+        self.assertTrue(bot_state.is_bot)
+        self.assertIsNone(game_state.add_bot())
+        self.assertTrue(game_state.load_engine().has_bot)
+        self.assertTrue(engine.load_game(engine.dump_game(game_state.load_engine())).has_bot)
+
+        game_state.start_game()
+        human_state = game_state.playerstate_set.get(is_bot=False)
+        if human_state.is_moving:
+            game_state.run_command('end_turn', human_state.user_id)
+
+        with mock.patch('game.bot.THINKING_SECONDS', 0.01):
+            self.assertGreater(bot.take_turns(game_state), 0)
+        bot_state.refresh_from_db()
+        self.assertFalse(bot_state.is_moving)
+
+    def test_failing_bot_ends_its_turn(self):
+        """
+        A bot that fails is logged and gives up its turn rather than stall the game.
+        :return:
+        """
+        game_state = create_started_game(usernames=('player_1',), start=False)
+        bot_state = game_state.add_bot()
+        game_state.start_game()
+        if not game_state.playerstate_set.get(pk=bot_state.pk).is_moving:
+            game_state.run_command('end_turn', game_state.player_moving_state.user_id)
+
+        with mock.patch('game.bot.take_turns', side_effect=RuntimeError), \
+                mock.patch('game.bot.logger') as logger:
+            bot._drive(game_state.pk)
+        logger.exception.assert_called_once()
+        bot_state.refresh_from_db()
+        self.assertFalse(bot_state.is_moving)
+        self.assertNotIn(game_state.pk, bot._games_in_turn)
+
+    def test_bot_username_is_reserved(self):
+        """
+        Nobody can register the username of a bot, and an account that someone can log in as is never seated as one.
+        :return:
+        """
+        game_state = create_started_game(usernames=('player_1',), start=False)
+        username = models.BOT_USERNAME % game_state.room_name
+        with self.assertRaises(ValidationError):
+            User(username=username).clean_fields(exclude=['password'])
+
+        person = User.objects.create_user(username=username, password='password')
+        with self.assertRaises(exceptions.NotAuthorized):
+            game_state.add_bot()
+        self.assertFalse(UserSettings.objects.filter(user=person).exists())
+        self.assertFalse(game_state.playerstate_set.filter(user=person).exists())
+
+
+class ProtocolTests(TestCase):
+
+    def test_merge_patch(self):
+        """
+        Merging the diff of two states into the first gives the second.
+        :return:
+        """
+        old = {'turn': 1, 'hp': 30, 'hand_card_0_name': 'card', 'player': {'hp': 30, 'mana': 1}}
+        new = {'turn': 2, 'hp': 30, 'hand_card_1_name': 'card', 'player': {'hp': 28, 'mana': 1}}
+        patch = protocol.diff(old, new)
+        self.assertEqual(patch, {'turn': 2, 'hand_card_0_name': None, 'hand_card_1_name': 'card',
+                                 'player': {'hp': 28}})
+        self.assertEqual(protocol.merge(old, patch), new)
+        self.assertEqual(protocol.diff(new, new), {})
+
+    def test_stream(self):
+        """
+        A stream sends the whole state first and after a reset, and otherwise only what changed.
+        :return:
+        """
+        stream = protocol.Stream()
+        self.assertEqual(stream.message({'turn': 1, 'hp': 30}, 3), {'v': 2, 'seq': 3, 'state': {'turn': 1, 'hp': 30}})
+        self.assertEqual(stream.message({'turn': 2, 'hp': 30}, 5),
+                         {'v': 2, 'seq': 5, 'base': 3, 'patch': {'turn': 2}})
+        self.assertIsNone(stream.message({'turn': 2, 'hp': 30}, 6))
+        self.assertIsNone(stream.message({'turn': 1, 'hp': 30}, 4))
+        self.assertEqual(stream.message({'turn': 3, 'hp': 30}, 7),
+                         {'v': 2, 'seq': 7, 'base': 5, 'patch': {'turn': 3}})
+        stream.reset()
+        self.assertEqual(stream.message({'turn': 3, 'hp': 30}, 7), {'v': 2, 'seq': 7, 'state': {'turn': 3, 'hp': 30}})
+
+    def test_command_sends_small_patch(self):
+        """
+        Summoning a card only changes the keys of that card and of the summoner's mana.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+        before = protocol.build_state(game_state.load_snapshot(), moving.user.username)
+        self.assertEqual(set(before['hand']), {'0', '1'})
+        self.assertNotIn('i', before['hand']['0'])
+
+        game_state.run_command('summon', moving.user_id, 1, 4)
+        after = protocol.build_state(game_state.load_snapshot(), moving.user.username)
+        patch = protocol.diff(before, after)
+        number = '1' if moving.is_first else '2'
+        self.assertEqual(patch, {
+            'hand': {'1': None},
+            'players': {number: {'mana': 0, 'field': {'4': dict(before['hand']['1'], a=2, h=3)}}},
+        })
+        self.assertEqual(protocol.merge(before, patch), after)
+
+
+    def test_update_event_needs_no_queries(self):
+        """
+        Consumers receiving an update build their client's state out of the group message alone.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+        snapshot = game_state.load_snapshot()
+        event = protocol.update_event(snapshot)
+
+        consumer = GameConsumer({'type': 'websocket'})
+        consumer.game = game_state
+        consumer.user = moving.user
+        consumer.stream = protocol.Stream()
+        consumer.subprotocol = None
+        consumer.spectator = False
+        consumer.room_name = 'room'
+
+        async def update():
+            await consumer.update_client(event)
+            await consumer.outbox.join()
+
+        with mock.patch.object(consumer, 'send') as send, self.assertNumQueries(0):
+            consumer.outbox = protocol.Outbox(consumer.send, consumer.too_slow)
+            async_to_sync(update)()
+        message = json.loads(send.call_args[1]['text_data'])
+        self.assertEqual(message['state'], protocol.build_state(snapshot, moving.user.username))
+        self.assertEqual(set(message['state']['hand']), {'0', '1'})
+
+        # Spectators see no hand
+        self.assertNotIn('hand', protocol.state_for(event, 'spectator'))
+
+    def test_msgpack_subprotocol(self):
+        """
+        Clients that ask for MessagePack get binary frames, and the others JSON.
+        :return:
+        """
+        message = {'v': 2, 'seq': 3, 'base': 1, 'patch': {'turn': 2, 'hand': {'0': None}}}
+        self.assertEqual(protocol.choose_subprotocol(['msgpack', 'json']), protocol.MSGPACK)
+        self.assertEqual(protocol.choose_subprotocol(['json']), protocol.JSON)
+        self.assertIsNone(protocol.choose_subprotocol([]))
+
+        frame = protocol.encode(message, protocol.MSGPACK)
+        self.assertEqual(protocol.decode(bytes_data=frame['bytes_data']), message)
+        self.assertLess(len(frame['bytes_data']), len(protocol.encode(message)['text_data']))
+        self.assertEqual(protocol.decode(**protocol.encode(message)), message)
+        with mock.patch('game.protocol.msgpack', None):
+            self.assertEqual(protocol.choose_subprotocol(['msgpack', 'json']), protocol.JSON)
+
+
+    def test_outbox_keeps_latest_frame(self):
+        """
+        Updates coming while a frame is being sent supersede each other, and a client too far behind is given up on.
+        :return:
+        """
+        async def session():
+            sent = []
+            release = asyncio.Event()
+            given_up = []
+
+            async def send(text_data):
+                sent.append(text_data)
+                await release.wait()
+
+            async def give_up():
+                given_up.append(True)
+
+            outbox = protocol.Outbox(send, give_up, high_water=3)
+            await outbox.put(lambda: {'text_data': 1})
+            await asyncio.sleep(0)
+            for frame in (2, 3):
+                await outbox.put(lambda frame=frame: {'text_data': frame})
+            release.set()
+            await outbox.join()
+
+            release.clear()
+            await outbox.put(lambda: {'text_data': 4})
+            await asyncio.sleep(0)
+            for frame in range(4):
+                await outbox.put(lambda: {'text_data': 5})
+            return sent, given_up, outbox.task
+
+        sent, given_up, task = async_to_sync(session)()
+        self.assertEqual(sent, [1, 3, 4])
+        self.assertEqual(given_up, [True])
+        self.assertIsNone(task)
+
+    def test_outbox_owns_its_task(self):
+        """
+        A task sending to a client that was closed lets go of the outbox, and leaves alone the task sending after it.
+        :return:
+        """
+        async def session():
+            sent = []
+            release = asyncio.Event()
+
+            async def send(text_data):
+                sent.append(text_data)
+                await release.wait()
+
+            async def give_up():
+                pass
+
+            outbox = protocol.Outbox(send, give_up)
+            await outbox.put(lambda: {'text_data': 1})
+            await asyncio.sleep(0)
+            closed = outbox.task
+            outbox.close()
+            await outbox.put(lambda: {'text_data': 2})
+            task = outbox.task
+            await asyncio.sleep(0)
+            owned = outbox.task is task and task is not closed and closed.cancelled()
+            release.set()
+            await outbox.join()
+            return sent, owned, outbox.task
+
+        sent, owned, task = async_to_sync(session)()
+        self.assertEqual(sent, [1, 2])
+        self.assertTrue(owned)
+        self.assertIsNone(task)
+
+
+class GameConsumerTests(TransactionTestCase):
+
+    def test_room_gone(self):
+        """
+        A client of a room with no game is closed with a code telling it not to reconnect.
+        :return:
+        """
+        user = create_user('player')
+
+        async def session():
+            client = WebsocketCommunicator(GameConsumer, '/ws/game/game/gone/')
+            client.scope['user'] = user
+            client.scope['url_route'] = {'kwargs': {'room_name': 'gone'}}
+            connected, subprotocol = await client.connect()
+            closed = await client.receive_output()
+            await client.wait()
+            return connected, closed
+
+        connected, closed = async_to_sync(session)()
+        self.assertTrue(connected)
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': protocol.ROOM_GONE})
+
+    def test_failed_batch_is_reported(self):
+        """
+        A client whose batch fails is sent an error naming the command that failed, and the game is updated with
+        whatever was kept.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+        summon = {'command': 'summon', 'handCardPosition': 0, 'fieldCardPosition': 2}
+
+        async def session():
+            player = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            player.scope['user'] = moving.user
+            player.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            await player.connect()
+            await player.receive_json_from()
+
+            frames = []
+            for atomic in (True, False):
+                await player.send_json_to({'command': 'batch', 'atomic': atomic,
+                                           'commands': [summon, summon, {'command': 'end_turn'}]})
+                frames.append(await player.receive_json_from())
+            patch = await player.receive_json_from()
+            await player.send_json_to({'command': 'batch', 'commands': [{'command': 'start_game'}]})
+            frames.append(await player.receive_json_from())
+            await player.disconnect()
+            return frames, patch
+
+        with mock.patch('game.consumers.logger'):
+            frames, patch = async_to_sync(session)()
+        self.assertEqual(frames, [{'v': 2, 'error': 'InvalidCard', 'index': 1}] * 2 +
+                         [{'v': 2, 'error': 'InvalidBatch'}])
+        self.assertIn('field', patch['patch']['players']['1' if moving.is_first else '2'])
+        self.assertEqual(GameState.objects.get(pk=game_state.pk).player_moving_state.user, moving.user)
+
+
+    def test_failed_command_is_reported(self):
+        """
+        A client whose command fails is told so and stays connected. Deleting the game closes every client of it.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        waiting = game_state.playerstate_set.select_related('user').get(is_moving=False)
+
+        def communicator_of(user):
+            communicator = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            return communicator
+
+        async def session():
+            player, opponent = communicator_of(waiting.user), communicator_of(moving.user)
+            for communicator in (player, opponent):
+                await communicator.connect()
+                await communicator.receive_json_from()
+
+            frames = []
+            for command in ({'command': 'end_turn'}, {'command': 'summon'}, {'command': 'fly'}):
+                await player.send_json_to(command)
+                frames.append(await player.receive_json_from())
+
+            await player.send_json_to({'command': 'delete_game'})
+            closed = [await communicator.receive_output() for communicator in (player, opponent)]
+            return frames, closed
+
+        with mock.patch('game.consumers.logger'):
+            frames, closed = async_to_sync(session)()
+        self.assertEqual(frames, [{'v': 2, 'error': 'NotAuthorized'}, {'v': 2, 'error': 'KeyError'},
+                                  {'v': 2, 'error': 'InvalidCommand'}])
+        self.assertEqual(closed, [{'type': 'websocket.close', 'code': protocol.ROOM_GONE}] * 2)
+        self.assertFalse(GameState.objects.filter(pk=game_state.pk).exists())
+
+
+class SpectatorTests(TransactionTestCase):
+
+    def test_anonymous_user_spectates(self):
+        """
+        An anonymous user connecting to a game with a free seat spectates it rather than taking the seat.
+        :return:
+        """
+        game_state = GameState.objects.create(room_name='room')
+        game_state.create_player_states()
+        game_state.register(create_user('player'))
+
+        async def session():
+            client = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            client.scope['user'] = AnonymousUser()
+            client.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            await client.connect()
+            spectators = consumers.spectator_feeds[game_state.pk].spectators
+            await client.disconnect()
+            return spectators
+
+        self.assertEqual(async_to_sync(session)(), 1)
+
+    def test_feed(self):
+        """
+        A feed sends the whole state to spectators who are new or behind, the last patch to the others, and encodes
+        each frame once.
+        :return:
+        """
+        feed = protocol.Feed()
+        self.assertIsNone(feed.frame(None))
+        feed.update({'turn': 1, 'hp': 30}, 1)
+        first = feed.frame(None)
+        self.assertEqual(json.loads(first['text_data']), {'v': 2, 'seq': 1, 'state': {'turn': 1, 'hp': 30}})
+        self.assertIs(feed.frame(0), first)
+        self.assertIsNone(feed.frame(1))
+
+        feed.update({'turn': 2, 'hp': 30}, 3)
+        feed.update({'turn': 1, 'hp': 30}, 2)  # older than what the feed has
+        self.assertEqual(json.loads(feed.frame(1)['text_data']), {'v': 2, 'seq': 3, 'base': 1, 'patch': {'turn': 2}})
+        self.assertIs(feed.frame(1), feed.frame(1))
+        self.assertEqual(json.loads(feed.frame(0)['text_data'])['state'], {'turn': 2, 'hp': 30})
+
+    def test_spectators_share_public_frames(self):
+        """
+        Users without a seat are sent the public state, the same frames for all of them, and cannot send commands.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+        spectators = [create_user('spectator_%s' % index) for index in range(2)]
+
+        def communicator_of(user):
+            communicator = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            return communicator
+
+        async def session():
+            player = communicator_of(moving.user)
+            await player.connect()
+            await player.receive_from()
+            watching = []
+            for user in spectators:
+                communicator = communicator_of(user)
+                await communicator.connect()
+                watching.append(communicator)
+            states = [await communicator.receive_json_from() for communicator in watching]
+
+            await watching[0].send_json_to({'command': 'end_turn'})
+            await player.send_json_to({'command': 'summon', 'handCardPosition': 0, 'fieldCardPosition': 2})
+            await player.receive_from()
+            patches = [await communicator.receive_json_from() for communicator in watching]
+            ignored = await watching[0].receive_nothing()
+
+            for communicator in watching + [player]:
+                await communicator.disconnect()
+            return states, patches, ignored
+
+        with mock.patch('game.protocol.encode', wraps=protocol.encode) as encode:
+            states, patches, ignored = async_to_sync(session)()
+        self.assertEqual(states[0], states[1])
+        self.assertNotIn('hand', states[0]['state'])
+        self.assertEqual(patches[0], patches[1])
+        self.assertEqual(patches[0]['base'], states[0]['seq'])
+        self.assertIn('field', patches[0]['patch']['players']['1' if moving.is_first else '2'])
+        self.assertTrue(ignored)
+        # Once for the player and once for the spectators, at connect and after the summon
+        self.assertEqual(encode.call_count, 4)
+        self.assertEqual(GameState.objects.get(pk=game_state.pk).player_moving_state.user, moving.user)
+        self.assertNotIn(game_state.pk, consumers.spectator_feeds)
+
+
+class ReplayTests(TransactionTestCase):
+
+    def test_replay(self):
+        """
+        A replay keeps the last events of the games used last, in version order, and only vouches for the last one
+        while the game has connections.
+        :return:
+        """
+        replay = protocol.Replay(size=2, max_games=2)
+        for version in (1, 2, 4, 3):
+            replay.add('a', {'version': version})
+        self.assertIsNone(replay.event('a', 1))
+        self.assertEqual(replay.event('a', 2), {'version': 2})
+        self.assertIsNone(replay.latest('a'))
+        replay.connect('a')
+        self.assertEqual(replay.latest('a'), {'version': 4})
+        replay.disconnect('a')
+        self.assertIsNone(replay.latest('a'))
+
+        replay.add('b', {'version': 1})
+        replay.add('c', {'version': 1})
+        self.assertIsNone(replay.event('a', 4))
+
+    def test_reconnect_resumes(self):
+        """
+        A player who reconnects is sent one patch of what they missed, read from memory while the other player is
+        connected, or the whole state when what they last saw is no longer kept.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        waiting = game_state.playerstate_set.select_related('user').get(is_moving=False)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+
+        def communicator_of(user, query=''):
+            communicator = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/' + query)
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            return communicator
+
+        async def session():
+            player = communicator_of(moving.user)
+            await player.connect()
+            await player.receive_json_from()
+            leaving = communicator_of(waiting.user)
+            await leaving.connect()
+            first = await leaving.receive_json_from()
+            await leaving.disconnect()
+
+            await player.send_json_to({'command': 'summon', 'handCardPosition': 0, 'fieldCardPosition': 2})
+            await player.receive_json_from()
+
+            frames = []
+            for query in ('?seq=%d' % first['seq'], '?seq=0'):
+                returning = communicator_of(waiting.user, query)
+                await returning.connect()
+                frames.append(await returning.receive_json_from())
+                await returning.disconnect()
+            await player.disconnect()
+            return first, frames
+
+        with mock.patch('game.protocol.replay', protocol.Replay()), \
+                mock.patch.object(GameState, 'load_engine', autospec=True,
+                                  side_effect=GameState.load_engine) as load_engine:
+            first, (resumed, restarted) = async_to_sync(session)()
+        current = protocol.build_state(game_state.load_snapshot(), waiting.user.username)
+        self.assertEqual(resumed['base'], first['seq'])
+        self.assertEqual(protocol.merge(first['state'], resumed['patch']), current)
+        self.assertEqual(restarted['state'], current)
+        # On the first connect, and to run the summon and send its update. Reconnecting loads nothing.
+        self.assertEqual(load_engine.call_count, 3)
+
+
+class ShardTests(TransactionTestCase):
+
+    def test_ring(self):
+        """
+        Rooms spread evenly across shards, and a new shard only takes rooms from the others.
+        :return:
+        """
+        rooms = ['room_%s' % index for index in range(2000)]
+        ring = shards.Ring(shards.channel_names(4))
+        owners = {room: ring.channel_for(room) for room in rooms}
+        for channel in shards.channel_names(4):
+            self.assertGreater(list(owners.values()).count(channel), 300)
+
+        grown = shards.Ring(shards.channel_names(5))
+        moved = [room for room in rooms if grown.channel_for(room) != owners[room]]
+        self.assertEqual({grown.channel_for(room) for room in moved}, {'game-shard-4'})
+        self.assertLess(len(moved), 600)
+
+        self.assertIsNone(shards.shard_for('room'))
+        with override_settings(GAME_SHARDS=4):
+            self.assertEqual(shards.shard_for('room_1'), owners['room_1'])
+
+    @override_settings(GAME_SHARDS=2)
+    def test_commands_run_in_shard(self):
+        """
+        Commands are forwarded to the shard of their room, which keeps the game in memory between commands and
+        updates every client.
+        :return:
+        """
+        game_state = create_started_game()
+        moving = game_state.playerstate_set.select_related('user').get(is_moving=True)
+        game_state.run_command('draw_cards', moving.user_id, 2)
+        shard = shards.shard_for('room')
+
+        async def session():
+            layer = get_channel_layer()
+            player = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            player.scope['user'] = moving.user
+            player.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            await player.connect()
+            first = await player.receive_json_from()
+
+            worker = ApplicationCommunicator(GameShardConsumer, {'type': 'channel', 'channel': shard})
+            frames = []
+            for command in ({'command': 'summon', 'handCardPosition': 0, 'fieldCardPosition': 2},
+                            {'command': 'end_turn'}):
+                await player.send_json_to(command)
+                await worker.send_input(await layer.receive(shard))
+                frames.append(await player.receive_json_from())
+            await player.disconnect()
+            await worker.wait()
+            return first, frames
+
+        with mock.patch('game.bot.schedule') as schedule, \
+                mock.patch.object(GameState, 'load_engine', autospec=True,
+                                  side_effect=GameState.load_engine) as load_engine:
+            first, (summoned, ended) = async_to_sync(session)()
+        # Once for the player connecting, and once for the shard's first command
+        self.assertEqual(load_engine.call_count, 2)
+        self.assertEqual(summoned['base'], first['seq'])
+        self.assertEqual(ended['base'], summoned['seq'])
+        self.assertEqual(protocol.merge(protocol.merge(first['state'], summoned['patch']), ended['patch']),
+                         protocol.build_state(game_state.load_snapshot(), moving.user.username))
+        # No bot plays in the game, so none is given the turn
+        schedule.assert_not_called()
+        self.assertNotEqual(GameState.objects.get(pk=game_state.pk).player_moving_state.user_id, moving.user_id)
+
+    @override_settings(GAME_SHARDS=2)
+    def test_shard_replies_with_errors(self):
+        """
+        A command failing in a shard is logged, and the client that sent it is told, while the shard keeps running.
+        A deleted game is dropped from the shard, and its clients are closed.
+        :return:
+        """
+        game_state = create_started_game()
+        waiting = game_state.playerstate_set.select_related('user').get(is_moving=False)
+        shard = shards.shard_for('room')
+        instances = []
+
+        def shard_consumer(scope):
+            instances.append(GameShardConsumer(scope))
+            return instances[-1]
+
+        async def session():
+            layer = get_channel_layer()
+            player = WebsocketCommunicator(GameConsumer, '/ws/game/game/room/')
+            player.scope['user'] = waiting.user
+            player.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            await player.connect()
+            await player.receive_json_from()
+
+            worker = ApplicationCommunicator(shard_consumer, {'type': 'channel', 'channel': shard})
+            frames = []
+            for command in ({'command': 'end_turn'}, {'command': 'batch', 'commands': [{'command': 'draw'}]}):
+                await player.send_json_to(command)
+                await worker.send_input(await layer.receive(shard))
+                frames.append(await player.receive_json_from())
+
+            # The game is deleted, dropped from the shard, and its clients are closed
+            await player.send_json_to({'command': 'delete_game'})
+            await worker.send_input(await layer.receive(shard))
+            closed = await player.receive_output()
+            games = dict(instances[0].games)
+            await worker.wait()
+            return frames, closed, games
+
+        with mock.patch('game.consumers.logger') as logger:
+            frames, closed, games = async_to_sync(session)()
+        self.assertEqual(frames, [{'v': 2, 'error': 'NotAuthorized'}, {'v': 2, 'error': 'InvalidBatch'}])
+        self.assertEqual(logger.exception.call_count, 2)
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': protocol.ROOM_GONE})
+        self.assertEqual(games, {})
+        self.assertFalse(GameState.objects.filter(pk=game_state.pk).exists())
+
+
+class ChatTests(TransactionTestCase):
+
+    def test_token_bucket(self):
+        """
+        A token bucket allows a burst, then refills at its rate.
+        :return:
+        """
+        now = [0.0]
+        bucket = chat.TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        self.assertEqual(bucket.wait(), 0.5)
+        now[0] = 0.5
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_messages_are_coalesced_and_limited(self):
+        """
+        Messages sent within the coalescing window reach the room as one frame, and messages over the limit are
+        dropped with a notice.
+        :return:
+        """
+        user = create_user()
+        GameState.objects.create(room_name='room')
+
+        async def chat_session():
+            communicator = WebsocketCommunicator(AsyncChatConsumer, '/ws/game/chat/room/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+
+            for index in range(chat.BURST + 2):
+                await communicator.send_json_to({'message': 'line %d' % index})
+            notice = await communicator.receive_json_from()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return notice, frame
+
+        with mock.patch('game.chat.history', chat.History()):
+            notice, frame = async_to_sync(chat_session)()
+        self.assertEqual(notice['notice'], 'dropped')
+        self.assertEqual([message['message'] for message in frame['messages']],
+                         ['line %d' % index for index in range(chat.BURST)])
+
+    def test_coalescer_windows(self):
+        """
+        Items are handed over when their window ends, and an item added while they are being handed over opens a
+        window of its own.
+        :return:
+        """
+        async def session():
+            flushed = []
+            release = asyncio.Event()
+
+            async def flush(items):
+                flushed.append(items)
+                await release.wait()
+
+            coalescer = chat.Coalescer(flush, window=0.01, max_items=10)
+            await coalescer.add(1)
+            await coalescer.add(2)
+            while not flushed:
+                await asyncio.sleep(0.01)
+            await coalescer.add(3)
+            release.set()
+            await asyncio.sleep(0.05)
+            return flushed, coalescer.task
+
+        flushed, task = async_to_sync(session)()
+        self.assertEqual(flushed, [[1, 2], [3]])
+        self.assertIsNone(task)
+
+
+    def test_history_ring_buffer(self):
+        """
+        A history keeps the last messages of the rooms used last, each message once.
+        :return:
+        """
+        history = chat.History(size=2, max_rooms=2)
+        for index in range(3):
+            history.add('a', {'id': index, 'message': index})
+        self.assertFalse(history.add('a', {'id': 2, 'message': 2}))
+        self.assertEqual([message['id'] for message in history.recent('a')], [1, 2])
+
+        history.add('b', {'id': 0})
+        history.recent('a')
+        history.add('c', {'id': 0})
+        self.assertIsNone(history.recent('b'))
+        self.assertEqual(len(history.recent('a')), 2)
+
+    def test_history_is_written_behind_and_replayed(self):
+        """
+        Chat messages are written to the database in one insert, and replayed to users joining the room later, from
+        memory or from the database.
+        :return:
+        """
+        user = create_user()
+        game = GameState.objects.create(room_name='history')
+
+        async def join(send=()):
+            communicator = WebsocketCommunicator(AsyncChatConsumer, '/ws/game/chat/history/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_name': 'history'}}
+            await communicator.connect()
+            frames = []
+            for message in send:
+                await communicator.send_json_to({'message': message})
+            if send:
+                frames.append(await communicator.receive_json_from())
+            if not await communicator.receive_nothing():
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        async def join_while_present():
+            present = WebsocketCommunicator(AsyncChatConsumer, '/ws/game/chat/history/')
+            present.scope['user'] = user
+            present.scope['url_route'] = {'kwargs': {'room_name': 'history'}}
+            await present.connect()
+            await present.receive_json_from()
+            frames = await join()
+            await present.disconnect()
+            return frames
+
+        with mock.patch('game.chat.history', chat.History()):
+            self.assertEqual(async_to_sync(join)(['hello', 'there']),
+                             [{'messages': [mock.ANY, mock.ANY]}])
+            self.assertEqual(list(ChatMessage.objects.filter(game=game).values_list('author', 'message')),
+                             [('username', 'hello'), ('username', 'there'),
+                              ('Server', 'username has disconnected.')])
+
+            # Nobody stayed in the room, so its history was dropped and is read from the database
+            loads = []
+            load_history = AsyncChatConsumer.__dict__['load_history']
+
+            async def counted_load_history(consumer):
+                loads.append(consumer)
+                return await load_history(consumer)
+
+            with mock.patch.object(AsyncChatConsumer, 'load_history', counted_load_history):
+                frames = async_to_sync(join)()
+                self.assertEqual(len(loads), 1)
+                self.assertTrue(frames[0]['history'])
+                self.assertEqual([message['message'] for message in frames[0]['messages']],
+                                 ['hello', 'there', 'username has disconnected.'])
+
+                # While someone is in the room, the history is read from memory
+                frames = async_to_sync(join_while_present)()
+                self.assertEqual(len(loads), 2)
+            self.assertEqual([message['message'] for message in frames[0]['messages']],
+                             ['hello', 'there'] + ['username has disconnected.'] * 2)
+            self.assertEqual(chat.history.rooms, {})
+
+    def test_chat_history_view(self):
+        """
+        A room's chat history is read a page at a time, newest first.
+        :return:
+        """
+        user = create_user()
+        game = GameState.objects.create(room_name='room')
+        ChatMessage.objects.bulk_create([ChatMessage(game=game, author='username', message=str(index))
+                                         for index in range(5)])
+        self.client.force_login(user)
+        url = reverse('game:chat_history', args=['room'])
+
+        pages = []
+        data = self.client.get(url, {'limit': 2}).json()
+        pages.append([message['message'] for message in data['messages']])
+        while data['before'] is not None:
+            data = self.client.get(url, {'limit': 2, 'before': data['before']}).json()
+            pages.append([message['message'] for message in data['messages']])
+        self.assertEqual(pages, [['4', '3'], ['2', '1'], ['0']])
+        self.assertEqual(self.client.get(url, {'limit': 'x'}).status_code, 400)
+
+
+def snapshot_values(snapshot):
+    """
+    engine.GameSnapshot with each CardDefinition replaced by its pk, so snapshots of separate loads compare equal.
+    """
+    def cards(card_snapshots):
+        return tuple(card._replace(card=card.card.pk) for card in card_snapshots)
+    return snapshot._replace(players=tuple(player._replace(hand=cards(player.hand), field=cards(player.field))
+                                           for player in snapshot.players))
+
 
 def create_user(username='username', password='password'):
     user = User.objects.create(username=username)
     user.set_password(password)
     user.save()
     return user
+
+
+def create_started_game(room_name='room', deck_size=5, usernames=('player_1', 'player_2'), start=True):
+    """
+    Creates a started game between two Users whose preferred decks hold deck_size monster cards each.
+    :return: GameState
+    """
+    game = GameState.objects.create(room_name=room_name)
+    game.create_player_states()
+    for username in usernames:
+        user = create_user(username=username)
+        deck = Deck.objects.create(name=username + '_deck', user=user)
+        for index in range(deck_size):
+            deck.monster_cards.add(MonsterCard.objects.create(creator=user, name='card_%s' % index, description='',
+                                                              cost=1, attack=2, hp=3))
+        UserSettings.objects.create(user=user, preferred_deck=deck)
+        game.register(user)
+    if start:
+        game.start_game()
+    return game
+
+
+def create_engine_game(effects=('', '')):
+    """
+    Creates an engine.Game where player 1 (user pk 1) is moving and each player has one monster on the field.
+    :param effects: effect text of each player's monster
+    :return: engine.Game
+    """
+    players = [
+        engine.Player(pk=1, user_id=1, username='player_1', is_moving=True, is_first=True, hp=30, mana=1, max_mana=1),
+        engine.Player(pk=2, user_id=2, username='player_2', is_moving=False, is_first=False, hp=30, mana=1,
+                      max_mana=1),
+    ]
+    for pk, (player, effect) in enumerate(zip(players, effects), 1):
+        definition = engine.CardDefinition(pk=pk, name='card', description='', cost=1, picture_url=None, attack=2,
+                                           hp=3, effect=effect)
+        player.place(engine.CardInstance(definition, player, engine.FIELD, attack=2, hp=3, turns_alive=1,
+                                         attacks_left=1), engine.FIELD, 0)
+    players[1].field[0].hp = 2
+    return engine.Game(pk=1, room_name='room', turn=0, is_started=True, is_ended=False, winner_id=None,
+                       players=players)
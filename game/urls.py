@@ -12,11 +12,12 @@ Class-based views
 
 from django.urls import path
 from .views import home_view, public_card_list_view, private_card_list_view, card_search_view, card_query_view,\
+    card_analytics_view, \
     deck_list_view, deck_detail_view, DeckCreateView,\
     MonsterCardCreateView, monster_card_update_view,\
     spell_card_create_view, monster_card_detail_view, spell_card_detail_view, \
     deck_add_monster_card_view, \
-    room_list_view, room_view, host_view, \
+    room_list_view, room_view, host_view, chat_history_view, \
     register_view, \
     user_settings_view
 
@@ -37,6 +38,7 @@ urlpatterns = [
     path('private_card_list/', private_card_list_view, name='private_card_list'),
     path('card_search/', card_search_view, name='card_search'),
     path('card_query', card_query_view, name='card_query'),
+    path('card_analytics/', card_analytics_view, name='card_analytics'),
 
     # Deck
     path('deck_create/', DeckCreateView.as_view(), name='deck_create'),
@@ -50,6 +52,7 @@ urlpatterns = [
     path('room_list/', room_list_view, name='room_list'),
     # TODO: <slug> potentially dangerous
     path('room/<slug:room_name>/', room_view, name='room'),
+    path('room/<slug:room_name>/chat_history/', chat_history_view, name='chat_history'),
 
     # UserSettings
     path('user_settings/', user_settings_view, name='user_settings'),
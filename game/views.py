@@ -1,14 +1,15 @@
-from django.shortcuts import render, redirect, reverse
+from django.shortcuts import render, redirect, reverse, get_object_or_404
 from django.views.generic import ListView, CreateView
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from game.models import Card
-from game.models import MonsterCard, SpellCard, GameState, Deck, UserSettings
+from game.models import MonsterCard, SpellCard, GameState, Deck, UserSettings, ChatMessage
 from game.forms import MonsterCardForm, SpellCardForm, DeckForm, GameStateForm, UserSettingsForm
 
 
 from django.http import JsonResponse
+from django.views.decorators.cache import cache_page
 
 from django.contrib import messages
 
@@ -78,6 +79,7 @@ def monster_card_update_view(request, pk):
             card.picture = form.cleaned_data['picture']
             card.hp = form.cleaned_data['hp']
             card.attack = form.cleaned_data['attack']
+            card.effect = form.cleaned_data['effect']
 
             card.save()
     else:
@@ -251,6 +253,42 @@ def card_query_view(request):
     # Send data as JSON
     return JsonResponse(data)
 
+
+# Seconds a card analytics response is cached for
+ANALYTICS_CACHE_SECONDS = 15 * 60
+
+# Cards a pairwise trade matrix can be asked for
+ANALYTICS_MAX_MATRIX_CARDS = 200
+
+
+@cache_page(ANALYTICS_CACHE_SECONDS)
+def card_analytics_view(request):
+    """
+    Card pool analytics as JSON, see analytics.report.
+    With ?cards=pk,pk,..., the pairwise trade matrix of those MonsterCards instead.
+    :param request:
+    :return:
+    """
+    # Imported here, so that NumPy is only needed by the sites that serve analytics
+    from game import analytics
+
+    cards = request.GET.get('cards')
+    if not cards:
+        return JsonResponse(analytics.report())
+
+    try:
+        pks = sorted({int(pk) for pk in cards.split(',')})
+    except ValueError:
+        return JsonResponse({'error': 'cards must be a comma separated list of pks'}, status=400)
+    if len(pks) > ANALYTICS_MAX_MATRIX_CARDS:
+        return JsonResponse({'error': 'at most %d cards' % ANALYTICS_MAX_MATRIX_CARDS}, status=400)
+
+    pool = analytics.CardPool.load(MonsterCard.objects.filter(pk__in=pks))
+    return JsonResponse({
+        'pks': pool.pks.tolist(),
+        'trades': analytics.trade_matrix(pool).tolist(),
+    })
+
 # Deck Views
 
 class DeckCreateView(LoginRequiredMixin, CreateView):
@@ -380,16 +418,18 @@ def room_list_view(request):
     :param request:
     :return:
     """
-    games = GameState.objects.all()
+    games = GameState.objects.prefetch_related('playerstate_set__user')
     rooms = []
 
     for game in games:
-        player_1 = game.player_1_state.user
+        # Use the prefetched player states instead of querying for each one
+        player_states = {player_state.is_first: player_state for player_state in game.playerstate_set.all()}
+        player_1 = player_states[True].user
         if player_1 is None:
             player_1_name = 'Free'
         else:
             player_1_name = player_1.username
-        player_2 = game.player_2_state.user
+        player_2 = player_states[False].user
         if player_2 is None:
             player_2_name = 'Free'
         else:
@@ -424,22 +464,30 @@ def room_view(request, room_name):
 
     # Attempt to retrieve the game
     try:
-        player_1_settings = UserSettings.objects.get(user=game.player_1_state.user)
-        player_2_settings = UserSettings.objects.get(user=game.player_2_state.user)
+        snapshot = game.load_snapshot()
+        player_1 = snapshot.player_1
+        player_2 = snapshot.player_2
+
+        # Both players' settings in one query. A seat nobody has taken yet has no settings.
+        user_settings = {settings.user_id: settings for settings in
+                         UserSettings.objects.filter(user_id__in=[player_1.user_id, player_2.user_id])}
+        player_1_settings = user_settings.get(player_1.user_id)
+        player_2_settings = user_settings.get(player_2.user_id)
 
         context = {
             'room_name': room_name,
-            'is_started': game.is_started,
+            'is_started': snapshot.is_started,
             'player_1_settings': player_1_settings,
             'player_2_settings': player_2_settings,
-            'player_1_name': game.player_1_state.user.username,
-            'player_2_name': game.player_2_state.user.username,
-            'player_1_hp': game.player_1_state.hp,
-            'player_2_hp': game.player_2_state.hp,
-            'player_1_mana': game.player_1_state.mana,
-            'player_2_mana': game.player_2_state.mana,
-            'player_1_max_mana': game.player_1_state.max_mana,
-            'player_2_max_mana': game.player_2_state.max_mana,
+            'player_1_name': player_1.username,
+            'player_2_name': player_2.username,
+            'player_1_hp': player_1.hp,
+            'player_2_hp': player_2.hp,
+            'player_1_mana': player_1.mana,
+            'player_2_mana': player_2.mana,
+            'player_1_max_mana': player_1.max_mana,
+            'player_2_max_mana': player_2.max_mana,
+            'is_spectator': request.user.pk not in (player_1.user_id, player_2.user_id),
         }
     except Exception:
         messages.add_message(request, messages.ERROR, 'Unable to join room.')
@@ -448,6 +496,45 @@ def room_view(request, room_name):
     return render(request, 'game/room.html', context)
 
 
+# Chat messages in one page of a room's chat history, by default and at most
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+
+@login_required
+def chat_history_view(request, room_name):
+    """
+    A page of a room's chat history as JSON, newest first.
+    Pages are keyed by the id of the last message of the page before, ?before=id, and ?limit= sets the page size.
+    Messages still waiting to be written behind the chat are not in the history yet.
+    :param request:
+    :param room_name:
+    :return:
+    """
+    game = get_object_or_404(GameState, room_name=room_name)
+    try:
+        limit = min(int(request.GET.get('limit', CHAT_HISTORY_PAGE_SIZE)), CHAT_HISTORY_MAX_PAGE_SIZE)
+        before = request.GET.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return JsonResponse({'error': 'before and limit must be integers'}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'limit must be positive'}, status=400)
+
+    chat_messages = ChatMessage.objects.filter(game=game).order_by('-id')
+    if before is not None:
+        chat_messages = chat_messages.filter(id__lt=before)
+    # One more than the page, to tell whether there is a page after it
+    chat_messages = list(chat_messages[:limit + 1])
+    page = chat_messages[:limit]
+
+    return JsonResponse({
+        'messages': [dict(chat_message.to_message(), id=chat_message.pk, created=chat_message.created.isoformat())
+                     for chat_message in page],
+        'before': page[-1].pk if len(chat_messages) > limit else None,
+    })
+
+
 @login_required
 def user_settings_view(request):
     """